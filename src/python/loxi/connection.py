@@ -7,6 +7,10 @@ This class creates a thread which continually parses OpenFlow messages off the
 supplied socket and places them in a queue. The class has methods for reading messages
 from the RX queue, sending messages, and higher level operations like request-response
 and multipart transactions.
+
+To talk to many switches without a thread per connection, create a
+ConnectionManager and pass it to connect() or connect_unix(). All of its
+connections are then read by the manager's single thread.
 """
 
 import loxi
@@ -17,10 +21,19 @@ import socket
 import errno
 import os
 import select
-from threading import Condition, Lock, Thread
+import struct
+from collections import OrderedDict, deque
+from threading import Condition, Lock, RLock, Thread
 
 DEFAULT_TIMEOUT = 1
 
+# Reads start at RECV_SIZE_MIN bytes and double while they come back full,
+# up to the socket's receive buffer size (or RECV_SIZE_MAX if unknown)
+RECV_SIZE_MIN = 4096
+RECV_SIZE_MAX = 262144
+
+OFP_HEADER = struct.Struct("!BBHL")
+
 class TransactionError(Exception):
     def __str__(self):
         return self.args[0]
@@ -29,58 +42,154 @@ class TransactionError(Exception):
     def msg(self):
         return self.args[1]
 
+class Waiter(object):
+    """
+    A thread blocked in Connection.recv
+
+    Each waiter has its own condition variable on the RX lock, so handing
+    it a message wakes only that thread.  A waiter may be registered
+    under several keys of one registry, such as every xid of a multipart
+    fan-out; it is removed from all of them when it gets a message.
+    """
+    def __init__(self, lock, predicate=None, keys=()):
+        self.cv = Condition(lock)
+        self.predicate = predicate
+        self.keys = keys
+        self.msg = None
+
 class Connection(Thread):
     def __init__(self, sock):
         Thread.__init__(self)
         self.sock = sock
         self.logger = logging.getLogger("connection")
-        self.rx = []
+
+        # Received messages nobody was waiting for, protected by rx_cv.
+        # rx maps an arrival sequence number to the message, in arrival
+        # order.  rx_by_xid and rx_by_class map an xid or exact message
+        # class to a deque of the sequence numbers of matching messages.
+        # Messages taken through one index are left in the others and
+        # skipped when they reach the front.
+        self.rx = OrderedDict()
+        self.rx_by_xid = {}
+        self.rx_by_class = {}
+        self.rx_seq = 0
         self.rx_cv = Condition()
+
+        # Threads blocked in recv, protected by rx_cv.  Each maps a key (an
+        # xid, a class, or None for arbitrary predicates) to a list of
+        # Waiters in the order they started waiting.
+        self.xid_waiters = {}
+        self.class_waiters = {}
+        self.predicate_waiters = {}
         self.tx_lock = Lock()
         self.next_xid = 1
         self.wakeup_rd, self.wakeup_wr = os.pipe()
         self.finished = False
-        self.read_buffer = None
+        self.closed = False # The peer closed the connection
+        self.manager = None
+
+        # Received bytes; read_buffer[read_start:read_end] is not yet
+        # parsed
+        self.read_buffer = bytearray(2 * RECV_SIZE_MIN)
+        self.read_start = 0
+        self.read_end = 0
+        self.recv_size = RECV_SIZE_MIN
+        self.recv_size_max = None
+
+    def running(self):
+        """
+        Return True if messages are being read off the socket, either by
+        this connection's thread or by its ConnectionManager
+
+        Once the peer has closed the connection this returns False.
+        """
+        if self.manager:
+            return not self.finished and not self.closed
+        return self.is_alive()
+
+    def started(self):
+        """
+        Return True if the connection was started, by start() or by adding
+        it to a ConnectionManager, and has not been stopped
+
+        Unlike running() this stays True once the peer has closed the
+        connection, so that messages received before the close can still
+        be read.
+        """
+        return (self.manager is not None or self.ident is not None) and \
+            not self.finished
 
     def run(self):
         while not self.finished:
             rd, wr, err = select.select([self.sock, self.wakeup_rd], [], [])
             if self.sock in rd:
-                self.process_read()
+                if self.process_read() == 0:
+                    self.logger.debug("Connection closed by peer")
+                    self._peer_closed()
+                    break
             if self.wakeup_rd in rd:
                 os.read(self.wakeup_rd, 1)
         self.logger.debug("Exited event loop")
 
+    def _peer_closed(self):
+        """
+        Note that nothing more will be received and wake every thread
+        blocked in recv
+        """
+        with self.rx_cv:
+            self.closed = True
+            for registry in (self.xid_waiters, self.class_waiters,
+                             self.predicate_waiters):
+                for waiters in registry.values():
+                    for waiter in waiters:
+                        waiter.cv.notify()
+
     def process_read(self):
-        recvd = self.sock.recv(4096)
+        """
+        Read once from the socket and queue the complete messages
 
-        self.logger.debug("Received %d bytes", len(recvd))
+        @returns The number of bytes read; 0 means the peer closed the
+        connection
+        """
+        if self.recv_size_max is None:
+            self.recv_size_max = self._socket_buffer_size()
 
-        buf = self.read_buffer
-        if buf:
-            buf += recvd
-        else:
-            buf = recvd
+        self._reserve(self.recv_size)
+        recvd = self.sock.recv_into(memoryview(self.read_buffer)[self.read_end:],
+                                    self.recv_size)
+        self.read_end += recvd
 
-        offset = 0
-        while offset < len(buf):
-            if offset + 8 > len(buf):
-                # Not enough data for the OpenFlow header
-                break
+        self.logger.debug("Received %d bytes", recvd)
 
+        # Read more at once under sustained load, less when mostly idle
+        if recvd == self.recv_size:
+            self.recv_size = min(self.recv_size * 2, self.recv_size_max)
+        elif recvd < self.recv_size / 8:
+            self.recv_size = max(self.recv_size / 2, RECV_SIZE_MIN)
+
+        buf = self.read_buffer
+        view = memoryview(buf)
+        offset = self.read_start
+        while self.read_end - offset >= OFP_HEADER.size:
             # Parse the header to get type
-            hdr_version, hdr_type, hdr_msglen, hdr_xid = loxi.of14.message.parse_header(buf[offset:])
+            hdr_version, hdr_type, hdr_msglen, hdr_xid = OFP_HEADER.unpack_from(buf, offset)
 
-            # Use loxi to resolve ofp of matching version
-            ofp = loxi.protocol(hdr_version)
+            if hdr_msglen < OFP_HEADER.size:
+                self.logger.error("Invalid message length %d, discarding %d bytes",
+                                  hdr_msglen, self.read_end - offset)
+                offset = self.read_end
+                break
 
             # Extract the raw message bytes
-            if (offset + hdr_msglen) > len(buf):
+            if (offset + hdr_msglen) > self.read_end:
                 # Not enough data for the body
                 break
-            rawmsg = buf[offset : offset + hdr_msglen]
+            rawmsg = view[offset : offset + hdr_msglen].tobytes()
             offset += hdr_msglen
 
+            # Use loxi to resolve ofp of matching version
+            ofp = loxi.protocol(hdr_version)
+
             msg = ofp.message.parse_message(rawmsg)
             if not msg:
                 self.logger.warn("Could not parse message")
@@ -90,34 +199,142 @@ class Connection(Thread):
                               type(msg).__module__, type(msg).__name__, hdr_xid, hdr_msglen)
 
             with self.rx_cv:
-                self.rx.append(msg)
-                self.rx_cv.notify_all()
+                if not self._hand_off(msg):
+                    self._enqueue(msg)
 
-        if offset == len(buf):
-            self.read_buffer = None
+        if offset == self.read_end:
+            self.read_start = self.read_end = 0
         else:
-            self.read_buffer = buf[offset:]
-            self.logger.debug("%d bytes remaining", len(self.read_buffer))
+            self.read_start = offset
+            self.logger.debug("%d bytes remaining", self.read_end - offset)
+
+        return recvd
+
+    def _reserve(self, nbytes):
+        """
+        Make room for nbytes after the received data
+
+        The unparsed bytes are moved to the front of the buffer only when
+        the space after them runs out, and the buffer only grows when they
+        do not fit at all.
+        """
+        if len(self.read_buffer) - self.read_end >= nbytes:
+            return
+        pending = self.read_end - self.read_start
+        if pending + nbytes > len(self.read_buffer):
+            newbuf = bytearray(max(2 * len(self.read_buffer), pending + nbytes))
+            newbuf[:pending] = self.read_buffer[self.read_start:self.read_end]
+            self.read_buffer = newbuf
+        else:
+            self.read_buffer[:pending] = self.read_buffer[self.read_start:self.read_end]
+        self.read_start = 0
+        self.read_end = pending
+
+    def _socket_buffer_size(self):
+        try:
+            return max(self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF),
+                       RECV_SIZE_MIN)
+        except (AttributeError, socket.error):
+            return RECV_SIZE_MAX
+
+    def _enqueue(self, msg):
+        """
+        Add a message to the RX queue; rx_cv must be held
+        """
+        seq = self.rx_seq
+        self.rx_seq += 1
+        self.rx[seq] = msg
+        self.rx_by_xid.setdefault(msg.xid, deque()).append(seq)
+        self.rx_by_class.setdefault(type(msg), deque()).append(seq)
+
+    def _head(self, index, key):
+        """
+        Return the sequence number of the first queued message in an
+        index entry, dropping stale ones; rx_cv must be held
+        """
+        seqs = index.get(key)
+        while seqs and seqs[0] not in self.rx:
+            seqs.popleft()
+        if not seqs:
+            index.pop(key, None)
+            return None
+        return seqs[0]
+
+    def _take(self, seq):
+        """
+        Remove and return a queued message; rx_cv must be held
+        """
+        msg = self.rx.pop(seq)
+        self._head(self.rx_by_xid, msg.xid)
+        self._head(self.rx_by_class, type(msg))
+        return msg
+
+    def _hand_off(self, msg):
+        """
+        Give a received message to the first thread waiting for it
+
+        @returns True if a waiter took the message
+        """
+        waiters = self.xid_waiters.get(msg.xid)
+        if waiters:
+            return self._wake(self.xid_waiters, waiters[0], msg)
+        if self.class_waiters:
+            for klass in type(msg).__mro__:
+                waiters = self.class_waiters.get(klass)
+                if waiters:
+                    return self._wake(self.class_waiters, waiters[0], msg)
+        for waiter in self.predicate_waiters.get(None, []):
+            if waiter.predicate(msg):
+                return self._wake(self.predicate_waiters, waiter, msg)
+        return False
+
+    def _wake(self, registry, waiter, msg):
+        self._unregister(registry, waiter)
+        waiter.msg = msg
+        waiter.cv.notify()
+        return True
+
+    def _unregister(self, registry, waiter):
+        for key in waiter.keys:
+            waiters = registry[key]
+            waiters.remove(waiter)
+            if not waiters:
+                del registry[key]
+
+    def _wait(self, registry, keys, predicate, timeout):
+        """
+        Block until the receive thread hands over a message, the timeout
+        expires or the connection is closed; rx_cv must be held
+
+        @param keys The keys to register the waiter under in registry
+        """
+        waiter = Waiter(self.rx_cv, predicate, keys)
+        for key in keys:
+            registry.setdefault(key, []).append(waiter)
+        deadline = time.time() + timeout
+        while waiter.msg is None:
+            now = time.time()
+            if now > deadline or self.closed or self.finished:
+                self._unregister(registry, waiter)
+                break
+            waiter.cv.wait(deadline - now)
+        return waiter.msg
 
     def recv(self, predicate, timeout=DEFAULT_TIMEOUT):
         """
         Remove and return the first message in the RX queue for
         which 'predicate' returns true
-        """
-        assert self.is_alive()
 
-        deadline = time.time() + timeout
-        while True:
-            with self.rx_cv:
-                for i, msg in enumerate(self.rx):
-                    if predicate(msg):
-                        return self.rx.pop(i)
+        Messages received before the peer closed the connection are still
+        returned; once none is left the recv functions return None at once.
+        """
+        assert self.started()
 
-                now = time.time()
-                if now > deadline:
-                    return None
-                else:
-                    self.rx_cv.wait(deadline - now)
+        with self.rx_cv:
+            for seq, msg in self.rx.iteritems():
+                if predicate(msg):
+                    return self._take(seq)
+            return self._wait(self.predicate_waiters, [None], predicate, timeout)
 
     def recv_any(self, timeout=DEFAULT_TIMEOUT):
         """
@@ -129,19 +346,48 @@ class Connection(Thread):
         """
         Return the first message in the RX queue with XID 'xid'
         """
-        return self.recv(lambda msg: msg.xid == xid, timeout)
+        assert self.started()
+
+        with self.rx_cv:
+            seq = self._head(self.rx_by_xid, xid)
+            if seq is not None:
+                return self._take(seq)
+            return self._wait(self.xid_waiters, [xid], None, timeout)
+
+    def recv_xids(self, xids, timeout=DEFAULT_TIMEOUT):
+        """
+        Return the first message in the RX queue with an XID in 'xids'
+        """
+        assert self.started()
+
+        with self.rx_cv:
+            seqs = [self._head(self.rx_by_xid, xid) for xid in xids]
+            seqs = [seq for seq in seqs if seq is not None]
+            if seqs:
+                return self._take(min(seqs))
+            # Wait in the xid index, so that replies to these requests go
+            # to this thread ahead of recv_class and recv waiters
+            return self._wait(self.xid_waiters, list(set(xids)), None, timeout)
 
     def recv_class(self, klass, timeout=DEFAULT_TIMEOUT):
         """
         Return the first message in the RX queue which is an instance of 'klass'
         """
-        return self.recv(lambda msg: isinstance(msg, klass), timeout)
+        assert self.started()
+
+        with self.rx_cv:
+            seqs = [self._head(self.rx_by_class, cls)
+                    for cls in self.rx_by_class.keys() if issubclass(cls, klass)]
+            seqs = [seq for seq in seqs if seq is not None]
+            if seqs:
+                return self._take(min(seqs))
+            return self._wait(self.class_waiters, [klass], None, timeout)
 
     def send_raw(self, buf):
         """
         Send raw bytes on the socket
         """
-        assert self.is_alive()
+        assert self.started()
         self.logger.debug("Sending raw message length %d", len(buf))
         with self.tx_lock:
             if self.sock.sendall(buf) is not None:
@@ -151,7 +397,7 @@ class Connection(Thread):
         """
         Send a message
         """
-        assert self.is_alive()
+        assert self.started()
 
         if msg.xid is None:
             msg.xid = self._gen_xid()
@@ -178,17 +424,43 @@ class Connection(Thread):
         """
         Send a multipart request and yield each entry from the replies
         """
-        self.send(msg)
-        finished = False
-        while not finished:
-            reply = self.recv_xid(msg.xid, timeout)
+        for (_, entry) in self.transact_multipart_fanout([msg], timeout):
+            yield entry
+
+    def transact_multipart_fanout(self, msgs, timeout=DEFAULT_TIMEOUT):
+        """
+        Send several multipart requests at once and yield a (request, entry)
+        pair for each entry from the replies
+
+        All requests are sent before any reply is read, and entries are
+        yielded in the order their replies arrive, so the time to collect
+        everything is bounded by the largest reply rather than the sum.
+        'timeout' applies to each reply message.
+        """
+        pending = {}
+        for msg in msgs:
+            if msg.xid is None:
+                msg.xid = self._gen_xid()
+            if msg.xid in pending:
+                raise ValueError("duplicate xid %d" % msg.xid)
+            pending[msg.xid] = msg
+
+        for msg in msgs:
+            self.send(msg)
+
+        while pending:
+            reply = self.recv_xids(pending.keys(), timeout)
             if reply is None:
-                raise TransactionError("no reply for %s" % type(msg).__name__, None)
-            elif not isinstance(reply, loxi.protocol(reply.version).message.stats_reply):
+                raise TransactionError("no reply for %s" % ", ".join(
+                    sorted([type(msg).__name__ for msg in pending.values()])), None)
+            msg = pending[reply.xid]
+            ofp = loxi.protocol(reply.version)
+            if not isinstance(reply, ofp.message.stats_reply):
                 raise TransactionError("received %s in response to %s" % (type(reply).__name__, type(msg).__name__), reply)
             for entry in reply.entries:
-                yield entry
-            finished = reply.flags & loxi.protocol(reply.version).OFPSF_REPLY_MORE == 0
+                yield (msg, entry)
+            if reply.flags & ofp.OFPSF_REPLY_MORE == 0:
+                del pending[reply.xid]
 
     def transact_multipart(self, msg, timeout=DEFAULT_TIMEOUT):
         """
@@ -199,6 +471,16 @@ class Connection(Thread):
             entries.append(entry)
         return entries
 
+    def transact_multipart_many(self, msgs, timeout=DEFAULT_TIMEOUT):
+        """
+        Send several multipart requests at once and return a list of the
+        entries from the replies to each, in the order of 'msgs'
+        """
+        entries = dict((id(msg), []) for msg in msgs)
+        for (msg, entry) in self.transact_multipart_fanout(msgs, timeout):
+            entries[id(msg)].append(entry)
+        return [entries[id(msg)] for msg in msgs]
+
     def stop(self):
         """
         Signal the thread to exit and wait for it
@@ -206,8 +488,11 @@ class Connection(Thread):
         assert not self.finished
         self.logger.debug("Stopping connection")
         self.finished = True
-        os.write(self.wakeup_wr, "x")
-        self.join()
+        if self.manager:
+            self.manager.remove(self)
+        else:
+            os.write(self.wakeup_wr, "x")
+            self.join()
         self.sock.close()
         os.close(self.wakeup_rd)
         os.close(self.wakeup_wr)
@@ -218,17 +503,119 @@ class Connection(Thread):
         self.next_xid += 1
         return xid
 
-def connect(ip, port=6653, daemon=True, ofp=loxi.of14):
+class ConnectionManager(Thread):
+    """
+    Read any number of connections from a single thread
+
+    The sockets are multiplexed with epoll where available, otherwise
+    poll.  The manager's thread is started when the first connection is
+    added.  Connections added to a manager are not started as threads of
+    their own; their send, recv and transact methods work as usual.
+    Stopping a connection removes it from its manager.
+    """
+
+    def __init__(self):
+        Thread.__init__(self)
+        self.daemon = True
+        self.logger = logging.getLogger("connection")
+        if hasattr(select, "epoll"):
+            self.poller = select.epoll()
+            self.events = select.EPOLLIN
+        else:
+            self.poller = select.poll()
+            self.events = select.POLLIN
+        self.lock = RLock()
+        self.connections = {} # fd -> Connection
+        self.wakeup_rd, self.wakeup_wr = os.pipe()
+        self.poller.register(self.wakeup_rd, self.events)
+        self.finished = False
+
+    def add(self, cxn):
+        """
+        Start reading a connection
+        """
+        assert not self.finished
+        with self.lock:
+            if self.ident is None:
+                self.start()
+            cxn.manager = self
+            fd = cxn.sock.fileno()
+            self.connections[fd] = cxn
+            self.poller.register(fd, self.events)
+        os.write(self.wakeup_wr, "x")
+
+    def remove(self, cxn):
+        """
+        Stop reading a connection
+
+        Once this returns the manager no longer touches the connection's
+        socket, so it may be closed.
+        """
+        with self.lock:
+            self._unregister(cxn)
+
+    def _unregister(self, cxn):
+        for (fd, other) in self.connections.items():
+            if other is cxn:
+                del self.connections[fd]
+                self.poller.unregister(fd)
+
+    def run(self):
+        while not self.finished:
+            events = self.poller.poll()
+            with self.lock:
+                for (fd, event) in events:
+                    if fd == self.wakeup_rd:
+                        os.read(self.wakeup_rd, 4096)
+                        continue
+                    cxn = self.connections.get(fd)
+                    if cxn is None:
+                        continue # Removed since poll returned
+                    try:
+                        if cxn.process_read() == 0:
+                            self.logger.debug("Connection closed by peer")
+                            self._unregister(cxn)
+                            cxn._peer_closed()
+                    except Exception:
+                        self.logger.exception("Error reading connection")
+                        self._unregister(cxn)
+                        cxn._peer_closed()
+        self.logger.debug("Exited connection manager event loop")
+
+    def stop(self):
+        """
+        Signal the thread to exit and wait for it
+
+        Connections still added are no longer read; stop them first.
+        """
+        assert not self.finished
+        self.finished = True
+        os.write(self.wakeup_wr, "x")
+        self.join()
+        self.poller.close()
+        os.close(self.wakeup_rd)
+        os.close(self.wakeup_wr)
+
+def _start(cxn, daemon, manager):
+    cxn.daemon = daemon
+    if manager:
+        manager.add(cxn)
+    else:
+        cxn.start()
+
+def connect(ip, port=6653, daemon=True, ofp=loxi.of14, manager=None):
     """
     Actively connect to a switch
+
+    @param manager If not None, a ConnectionManager to read the connection
+    instead of a thread of its own
     """
     soc = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     soc.connect((ip, port))
     soc.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, True)
     cxn = Connection(soc)
-    cxn.daemon = daemon
     cxn.logger.debug("Connected to %s:%d", ip, port)
-    cxn.start()
+    _start(cxn, daemon, manager)
 
     cxn.send(ofp.message.hello())
     if not cxn.recv(lambda msg: msg.type == ofp.OFPT_HELLO):
@@ -236,16 +623,17 @@ def connect(ip, port=6653, daemon=True, ofp=loxi.of14):
 
     return cxn
 
-def connect_unix(path, daemon=True, ofp=loxi.of14):
+def connect_unix(path, daemon=True, ofp=loxi.of14, manager=None):
     """
     Connect over a unix domain socket
+
+    @param manager See connect
     """
     soc = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
     soc.connect(path)
     cxn = loxi.connection.Connection(soc)
-    cxn.daemon = daemon
     cxn.logger.debug("Connected to %s", path)
-    cxn.start()
+    _start(cxn, daemon, manager)
 
     cxn.send(ofp.message.hello())
     if not cxn.recv(lambda msg: msg.type == ofp.OFPT_HELLO):
@@ -11,6 +11,15 @@ config = {}
 # Populated by oft.
 dataplane_instance = None
 
+# Controller kept connected across tests when config["persistent_controller"]
+# is set. Created by base_tests.SimpleProtocol, shut down by oft.
+controller_instance = None
+
+# Tables that flows tagged with config["flow_cookie"] were added to since
+# they were last cleaned up. Starts as OFPTT_ALL so that the first cleanup
+# also catches flows left by an earlier run.
+flow_tables = set([0xff])
+
 def open_logfile(name):
     """
     (Re)open logfile
@@ -26,45 +26,106 @@ class BaseTest(unittest.TestCase):
     def tearDown(self):
         logging.info("** END TEST CASE " + str(self))
 
+def shutdown_persistent_controller():
+    """
+    Shut down the controller kept connected across tests, if any
+    """
+    ctrl = oftest.controller_instance
+    if ctrl:
+        oftest.controller_instance = None
+        ctrl.shutdown()
+        ctrl.join()
+
 class SimpleProtocol(BaseTest):
     """
     Root class for setting up the controller
+
+    With config["persistent_controller"] set, the connection made for the
+    first test is kept in oftest.controller_instance and reset for each
+    following test instead of waiting for the switch to reconnect.  Tests
+    decorated with testutils.fresh_controller still get a connection of
+    their own.
+
+    With config["flow_cookie"] set (OpenFlow 1.1+), every flow_add is
+    tagged with it and testutils.delete_all_flows only deletes tagged
+    flows, from the tables they were added to.  The tagged flows are also
+    deleted when the test ends.
     """
 
     def setUp(self):
         BaseTest.setUp(self)
 
-        self.controller = controller.Controller(
-            switch=config["switch_ip"],
-            host=config["controller_host"],
-            port=config["controller_port"])
-        self.controller.start()
+        persistent = config["persistent_controller"] and \
+            not getattr(self, "_fresh_controller", False)
+        ctrl = oftest.controller_instance
+        if ctrl and not (persistent and ctrl.active and ctrl.switch_socket):
+            # The switch has to reconnect for a fresh connection
+            shutdown_persistent_controller()
+            ctrl = None
+
+        if ctrl:
+            logging.info("Reusing connection " + str(ctrl.switch_addr))
+            ctrl.reset()
+            self.controller = ctrl
+        else:
+            self.controller = controller.Controller(
+                switch=config["switch_ip"],
+                host=config["controller_host"],
+                port=config["controller_port"],
+                max_auxiliary=config["auxiliary_connections"],
+                tx_coalesce=config["tx_coalesce"])
+        if config["log_dir"] != None:
+            filename = os.path.join(config["log_dir"], str(self)) + ".ofp.pcap"
+            self.controller.start_pcap(filename)
 
         try:
-            #@todo Add an option to wait for a pkt transaction to ensure version
-            # compatibilty?
-            self.controller.connect(timeout=20)
+            if not ctrl:
+                self.controller.start()
+                #@todo Add an option to wait for a pkt transaction to ensure version
+                # compatibilty?
+                self.controller.connect(timeout=20)
 
             # By default, respond to echo requests
             self.controller.keep_alive = True
 
+            if config["flow_cookie"] is not None and ofp.OFP_VERSION >= 2:
+                self.controller.flow_cookie = \
+                    config["flow_cookie"] << 56 & controller.FLOW_COOKIE_MASK
+                self.controller.flow_tables = oftest.flow_tables
+
             if not self.controller.active:
                 raise Exception("Controller startup failed")
             if self.controller.switch_addr is None:
                 raise Exception("Controller startup failed (no switch addr)")
             logging.info("Connected " + str(self.controller.switch_addr))
-            request = ofp.message.features_request()
-            reply, pkt = self.controller.transact(request)
+            reply = self.controller.capabilities.get("features", refresh=True)
             self.assertTrue(reply is not None,
                             "Did not complete features_request for handshake")
             if reply.version == 1:
                 self.supported_actions = reply.actions
                 logging.info("Supported actions: " + hex(self.supported_actions))
+
+            if persistent:
+                if ctrl and config["persistent_cleanup"]:
+                    self.cleanup_switch()
+                oftest.controller_instance = self.controller
         except:
+            if oftest.controller_instance is self.controller:
+                oftest.controller_instance = None
             self.controller.kill()
+            self.controller.stop_pcap()
             del self.controller
             raise
 
+    def cleanup_switch(self):
+        """
+        Delete the flows and groups left behind by earlier tests
+        """
+        import oftest.testutils as testutils
+        testutils.delete_all_flows(self.controller)
+        if ofp.OFP_VERSION >= 2:
+            testutils.delete_all_groups(self.controller)
+
     def inheritSetup(self, parent):
         """
         Inherit the setup of a parent
@@ -86,8 +147,23 @@ class SimpleProtocol(BaseTest):
         self.supported_actions = parent.supported_actions
         
     def tearDown(self):
-        self.controller.shutdown()
-        self.controller.join()
+        if self.controller.flow_cookie is not None and \
+                (self.controller.flow_tables or
+                 self.controller.flow_untagged) and \
+                self.controller.switch_socket:
+            try:
+                import oftest.testutils as testutils
+                testutils.delete_session_flows(self.controller)
+            except:
+                logging.warning("Could not delete the flows of this test")
+        if self.controller is oftest.controller_instance:
+            self.controller.stop_pcap()
+        else:
+            self.controller.shutdown()
+            self.controller.join()
+        if config["log_dir"] != None:
+            filename = os.path.join(config["log_dir"], str(self)) + ".metrics.json"
+            self.controller.metrics.dump(filename)
         del self.controller
         BaseTest.tearDown(self)
 
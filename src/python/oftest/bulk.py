@@ -0,0 +1,155 @@
+"""
+Bulk installation of flow, group and meter mods
+
+Sending each message followed by a barrier costs a full round trip per
+message.  BulkInstaller instead streams messages with a sliding window of
+unacknowledged ones and a barrier every few messages, and attributes any
+error replies to the message that caused them by xid.
+
+    installer = BulkInstaller(self.controller, window=4096, barrier_interval=256)
+    result = installer.install(flow_mods)
+    self.assertEqual(result.errors, [])
+    logging.info("Installed %d flows at %.0f/s", result.count, result.rate)
+"""
+
+import time
+import logging
+from collections import deque
+
+import loxi
+import ofp
+
+class BulkResult(object):
+    """
+    Outcome of BulkInstaller.install
+
+    @var count Number of messages sent
+    @var errors List of (msg, error_msg) pairs for rejected messages
+    @var elapsed Seconds from the first send to the last barrier reply
+    @var rate Messages installed per second
+    @var window_latencies Seconds from the first message of each barrier
+    interval being sent to its barrier reply
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.errors = []
+        self.elapsed = 0.0
+        self.rate = 0.0
+        self.window_latencies = []
+
+    def __str__(self):
+        return "%d messages, %d errors, %.3fs, %.0f msgs/s" % \
+            (self.count, len(self.errors), self.elapsed, self.rate)
+
+class BulkInstaller(object):
+    """
+    Stream messages to the switch with a bounded number outstanding
+
+    @param ctrl The controller to send through
+    @param window Maximum number of messages sent but not yet confirmed
+    by a barrier reply
+    @param barrier_interval Number of messages between barriers
+    @param timeout Seconds to wait for each barrier reply; if -1 use the
+    default
+    """
+
+    def __init__(self, ctrl, window=1024, barrier_interval=128, timeout=-1):
+        if barrier_interval > window:
+            raise ValueError("barrier_interval must not exceed window")
+        self.ctrl = ctrl
+        self.window = window
+        self.barrier_interval = barrier_interval
+        self.timeout = timeout
+        self.logger = logging.getLogger("bulk")
+
+    def install(self, msgs):
+        """
+        Send all messages and wait until the switch has processed them
+
+        Each message is sent as an asynchronous transaction so that an
+        error reply completes it.  A message still pending when the
+        following barrier reply arrives was accepted.
+
+        @param msgs Iterable of messages; messages without an xid are
+        given a fresh one
+        @returns A BulkResult
+        """
+        result = BulkResult()
+        intervals = deque() # (barrier future, pending, start time)
+        pending = [] # (msg, future) pairs sent since the last barrier
+        unacked = 0
+        interval_start = None
+
+        start_time = time.time()
+        try:
+            for msg in msgs:
+                while unacked >= self.window:
+                    unacked -= self._complete(intervals.popleft(), result)
+
+                if not pending:
+                    interval_start = time.time()
+                future = self.ctrl.send_async(msg, multipart=False)
+                pending.append((msg, future))
+                result.count += 1
+                unacked += 1
+
+                if len(pending) >= self.barrier_interval:
+                    intervals.append(self._barrier(pending, interval_start))
+                    pending = []
+
+            if pending:
+                intervals.append(self._barrier(pending, interval_start))
+                pending = []
+            while intervals:
+                self._complete(intervals.popleft(), result)
+        except:
+            # Release the xids of everything still in the window
+            for (barrier, interval_pending, _) in intervals:
+                self._cancel(barrier, interval_pending)
+            self._cancel(None, pending)
+            raise
+
+        result.elapsed = time.time() - start_time
+        if result.elapsed > 0:
+            result.rate = result.count / result.elapsed
+        self.logger.info("Bulk install: %s", result)
+        return result
+
+    def _barrier(self, pending, interval_start):
+        barrier = self.ctrl.send_async(ofp.message.barrier_request(),
+                                       multipart=False)
+        return (barrier, pending, interval_start)
+
+    def _complete(self, interval, result):
+        """
+        Wait for an interval's barrier and collect its errors
+
+        @returns Number of messages in the interval
+        """
+        (barrier, pending, interval_start) = interval
+        if barrier.result(self.timeout) is None:
+            self._cancel(barrier, pending)
+            raise AssertionError("barrier failed")
+        result.window_latencies.append(time.time() - interval_start)
+
+        for (msg, future) in pending:
+            if future.done():
+                (reply, _) = future.value
+                ofp_reply = loxi.protocol(reply.version)
+                if isinstance(reply, ofp_reply.message.error_msg):
+                    self.logger.debug("Message xid %d failed: %s",
+                                      msg.xid, type(reply).__name__)
+                    result.errors.append((msg, reply))
+            else:
+                future.cancel()
+        return len(pending)
+
+    def _cancel(self, barrier, pending):
+        """
+        Cancel a barrier and the messages it covers
+        """
+        if barrier is not None:
+            barrier.cancel()
+        for (_, future) in pending:
+            future.cancel()
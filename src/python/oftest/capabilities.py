@@ -0,0 +1,187 @@
+"""
+Cache of what the switch reports about itself
+
+The switch's features, port descriptions, description, table, group and
+meter features and switch configuration are asked for many times per
+session by test setup and helpers.  CapabilityCache keeps the replies for
+the life of the connection:
+
+    features = self.controller.capabilities.get("features")
+    port = self.controller.capabilities.port(port_no)
+
+Entries are fetched on first use, and fill() fetches several with the
+requests outstanding at the same time.  The controller drops the port
+entries when a port_status arrives or a port_mod is sent, the
+configuration when a set_config is sent, and everything when the switch
+reconnects.
+"""
+
+import logging
+from threading import Lock
+
+import loxi
+import ofp as cfg_ofp
+
+# Entry name -> request message class name
+REQUESTS = {
+    "features": "features_request",
+    "config": "get_config_request",
+    "desc": "desc_stats_request",
+    "port_desc": "port_desc_stats_request",
+    "table_features": "table_features_stats_request",
+    "group_features": "group_features_stats_request",
+    "meter_features": "meter_features_stats_request",
+}
+
+# Entries that describe the ports
+PORT_ENTRIES = ("features", "port_desc")
+
+class CapabilityCache(object):
+    """
+    Replies to the switch description requests of one connection
+
+    get and fill return the reply message for each entry, except that
+    port_desc and table_features return the list of entries from all reply
+    parts.  Before OpenFlow 1.3, port_desc is taken from the ports in the
+    features reply.  An entry is None if this OpenFlow version has no such
+    request or the switch answered with an error; both are cached.  Entries
+    that time out are not.
+
+    @var values Map from request name to the cached reply, or None
+    @var generation Incremented on every invalidation, so that a reply
+    to a request sent before it is not cached
+    """
+
+    def __init__(self, controller):
+        self.controller = controller
+        self.logger = logging.getLogger("capabilities")
+        self.lock = Lock()
+        self.values = {}
+        self.generation = 0
+
+        # Message types that invalidate entries when sent
+        self.tx_invalidates = {
+            cfg_ofp.OFPT_PORT_MOD: PORT_ENTRIES,
+            cfg_ofp.OFPT_SET_CONFIG: ("config",),
+        }
+
+    def _source(self, name):
+        """
+        Return the request an entry is taken from, or None if unsupported
+        """
+        if name not in REQUESTS:
+            raise KeyError("Unknown capability %r" % name)
+        ofp = loxi.protocol(cfg_ofp.OFP_VERSION)
+        if name == "port_desc" and \
+                not hasattr(ofp.message, REQUESTS["port_desc"]):
+            return "features"
+        if not hasattr(ofp.message, REQUESTS[name]):
+            return None
+        return name
+
+    def _value(self, name, reply):
+        if reply is None:
+            return None
+        if name == "port_desc":
+            if self._source(name) == "features":
+                return reply.ports
+            return reply.entries
+        if name == "table_features":
+            return reply.entries
+        return reply
+
+    def fill(self, names=None, timeout=-1, refresh=False):
+        """
+        Fetch the entries not yet cached, with all requests outstanding at
+        once
+
+        @param names List of entry names; by default all of them
+        @param timeout Total number of seconds to wait; if -1 use default.
+        @param refresh If true, fetch the entries even if cached
+        @returns Map from entry name to its value
+        """
+        if names is None:
+            names = REQUESTS.keys()
+        sources = set([self._source(name) for name in names]) - set([None])
+
+        with self.lock:
+            generation = self.generation
+            replies = dict([(source, self.values[source])
+                            for source in sources
+                            if source in self.values and not refresh])
+
+        ofp = loxi.protocol(cfg_ofp.OFP_VERSION)
+        requests = []
+        for source in sources:
+            if source not in replies:
+                request = getattr(ofp.message, REQUESTS[source])()
+                self.logger.debug("Requesting %s", REQUESTS[source])
+                requests.append((source, self.controller.send_async(request)))
+
+        results = self.controller.gather(
+            [future for (_, future) in requests], timeout)
+
+        with self.lock:
+            for ((source, future), result) in zip(requests, results):
+                if result is None:
+                    self.logger.warning("No reply to %s", REQUESTS[source])
+                    future.cancel()
+                    continue
+                (reply, _) = result
+                if isinstance(reply, ofp.message.error_msg):
+                    self.logger.info("%s failed: type %d code %d",
+                                     REQUESTS[source], reply.err_type,
+                                     reply.code)
+                    reply = None
+                replies[source] = reply
+                if self.generation == generation:
+                    self.values[source] = reply
+
+        return dict([(name, self._value(name, replies.get(self._source(name))))
+                     for name in names])
+
+    def get(self, name, timeout=-1, refresh=False):
+        """
+        Return one entry, fetching it if not cached
+
+        @param name Entry name, one of the keys of REQUESTS
+        @param timeout Number of seconds to wait; if -1 use default.
+        @param refresh If true, fetch the entry even if cached
+        """
+        source = self._source(name)
+        if not refresh:
+            with self.lock:
+                if source is None or source in self.values:
+                    return self._value(name, self.values.get(source))
+        return self.fill([name], timeout, refresh)[name]
+
+    def port(self, port_no, timeout=-1):
+        """
+        Return the port description for a port, or None if not found
+        """
+        for port in self.get("port_desc", timeout) or []:
+            if port.port_no == port_no:
+                return port
+        return None
+
+    def invalidate(self, names=None):
+        """
+        Drop cached entries
+
+        @param names List of entry names; by default all of them
+        """
+        with self.lock:
+            self.generation += 1
+            if names is None:
+                self.values = {}
+            else:
+                for name in names:
+                    self.values.pop(self._source(name), None)
+
+    def message_sent(self, msg):
+        """
+        Called by the controller for every message sent
+        """
+        names = self.tx_invalidates.get(msg.type)
+        if names:
+            self.invalidate(names)
@@ -9,13 +9,21 @@ Class inherits from thread so as to run in background allowing
 asynchronous callbacks (if needed, not required).  Also supports
 polling.
 
-The controller thread maintains a queue.  Incoming messages that
-are not handled by a callback function are placed in this queue for 
-poll calls.  
+The controller thread maintains a queue for each message type.  Incoming
+messages that are not handled by a callback function are placed in these
+queues for poll calls.  Each queue is bounded separately, so a flood of
+one message type never evicts messages of another type.
 
-Callbacks and polling support specifying the message type
+Callbacks and polling support specifying the message type.  A
+subscription takes all future messages of a class as a stream.
+
+Queued packet ins are also indexed by in_port, reason and a hash of the
+start of the packet, so poll_packet_in finds the one it expects without
+consuming the others.
+
+Transactions are tracked by xid, so any number of them may be outstanding
+at once.  A reply is handed directly to the thread waiting on its xid.
 
-@todo Support transaction semantics via xid
 @todo Support select and listen on an administrative socket (or
 use a timeout to support clean shutdown).
 
@@ -33,11 +41,19 @@ import time
 import struct
 import select
 import logging
+import copy
+from collections import deque
 from threading import Thread
 from threading import Lock
 from threading import Condition
+from threading import local
 
 import ofutils
+import framing
+import metrics
+import ingress
+import capabilities
+from pcap_writer import TcpStreamPcapWriter
 import loxi
 
 # Configured openflow version
@@ -64,7 +80,371 @@ def hex_dump_buffer(src, length=16):
 
 ##@todo Find a better home for these identifiers (controller)
 RCV_SIZE_DEFAULT = 32768
+RCV_BUF_READS = 8 # Socket receive buffer size in units of rcv_size
 LISTEN_QUEUE_SIZE = 1
+TX_COALESCE_DEFAULT = 0 # Seconds an outgoing message may wait for others
+TX_BATCH_BYTES = 65536 # Write pending messages once this much is queued
+HANDLER_QUEUE_SIZE = 256 # Messages waiting per handler worker
+PKT_IN_PREFIX = 32 # Bytes of packet in data hashed for the packet in index
+PKT_IN_COMPACT_SLACK = 256 # Stale packet in entries allowed before compacting
+FLOW_COOKIE_MASK = 0xff << 56 # Cookie bits holding the session tag
+FLOW_TABLES_ALL = 0xff # OFPTT_ALL
+
+def packet_in_port(msg):
+    """
+    Return the in_port of a packet in message, or None if it has none
+    """
+    if msg.version <= 2:
+        return msg.in_port
+    ofp = loxi.protocol(msg.version)
+    for oxm in msg.match.oxm_list:
+        if isinstance(oxm, ofp.oxm.in_port):
+            return oxm.value
+    return None
+
+def packet_in_key(data, in_port, reason):
+    """
+    Return the packet in index key for a packet
+
+    The switch may truncate the data or pad it to the minimum frame size,
+    so only the first PKT_IN_PREFIX bytes are hashed.  Data shorter than
+    that is given a hash of None.
+    """
+    if len(data) < PKT_IN_PREFIX:
+        return (in_port, reason, None)
+    return (in_port, reason, hash(data[:PKT_IN_PREFIX]))
+
+def packet_in_data_match(data, expected):
+    """
+    Check that one of two packets is a prefix of the other
+    """
+    compare_len = min(len(data), len(expected))
+    return data[:compare_len] == expected[:compare_len]
+
+class Transaction(ofutils.Future):
+    """
+    Future for the reply to a request sent to the switch
+
+    The result is a pair (msg, pkt) like the one returned by
+    Controller.transact, or None if the transaction was cancelled or
+    timed out.
+
+    If multipart is true, stats replies with OFPSF_REPLY_MORE set are
+    collected until the final part arrives.  The result message is then
+    the first reply with the entries of all parts, and pkt is the
+    concatenation of the raw parts.  If the final message is not a stats
+    reply, e.g. an error, it is the result as is.  Each part is also kept
+    in 'replies'.
+
+    The time from creation to the final reply is recorded in the
+    controller's metrics under the request's class name.
+    """
+
+    def __init__(self, controller, xid, multipart=False, name=None):
+        ofutils.Future.__init__(self)
+        self.controller = controller
+        self.xid = xid
+        self.multipart = multipart
+        self.name = name
+        self.start_time = time.time()
+        self.replies = []
+
+    def deliver(self, msg, rawmsg):
+        """
+        Called by the controller thread for each message with our xid
+
+        @returns True if the transaction is complete
+        """
+        self.replies.append((msg, rawmsg))
+        if self.multipart:
+            ofp = loxi.protocol(msg.version)
+            if isinstance(msg, ofp.message.stats_reply) and \
+                    msg.flags & ofp.OFPSF_REPLY_MORE:
+                return False
+        if self.name:
+            self.controller.metrics.record_rtt(self.name,
+                                               time.time() - self.start_time)
+        ofp = loxi.protocol(msg.version)
+        if len(self.replies) == 1 or \
+                not isinstance(msg, ofp.message.stats_reply):
+            self.set_result((msg, rawmsg))
+        else:
+            (first, _) = self.replies[0]
+            for (part, _) in self.replies[1:]:
+                first.entries.extend(part.entries)
+            first.flags &= ~ofp.OFPSF_REPLY_MORE
+            self.set_result((first, ''.join([pkt for (_, pkt) in self.replies])))
+        return True
+
+    def cancel(self):
+        """
+        Stop waiting for the reply and wake up any waiters
+        """
+        with self.controller.xid_lock:
+            if self.controller.transactions.get(self.xid) is self:
+                del self.controller.transactions[self.xid]
+        ofutils.Future.cancel(self)
+
+class MultipartStream(Transaction):
+    """
+    Replies to a multipart request, handed out as they arrive
+
+    Created by Controller.send_multipart.  The controller thread routes
+    every reply with the request's xid straight to the stream, so replies
+    to other requests are never mixed in.  Iterating yields each (msg, pkt)
+    reply part and stops after the part without OFPSF_REPLY_MORE.  Parts
+    are released as they are consumed, so only the parts not yet read are
+    held in memory.
+
+    If no part arrives within 'timeout' seconds the stream is cancelled and
+    iteration stops with 'timed_out' set.  Cancelling the stream drops the
+    parts not yet read and any still to come.
+
+    As a future, the stream is done when the final part has arrived and
+    its result is the final (msg, pkt) part.
+    """
+
+    def __init__(self, controller, xid, name=None, timeout=-1):
+        Transaction.__init__(self, controller, xid, True, name)
+        self.timeout = timeout
+        self.parts = deque()
+        self.timed_out = False
+
+    def deliver(self, msg, rawmsg):
+        """
+        Called by the controller thread for each message with our xid
+
+        @returns True if this was the final part
+        """
+        with self.cv:
+            self.parts.append((msg, rawmsg))
+            self.cv.notify_all()
+        ofp = loxi.protocol(msg.version)
+        if isinstance(msg, ofp.message.stats_reply) and \
+                msg.flags & ofp.OFPSF_REPLY_MORE:
+            return False
+        if self.name:
+            self.controller.metrics.record_rtt(self.name,
+                                               time.time() - self.start_time)
+        self.set_result((msg, rawmsg))
+        return True
+
+    def get(self, timeout=-1):
+        """
+        Wait for the next reply part
+
+        @param timeout Maximum number of seconds to wait; if -1 use default.
+        @returns A (msg, pkt) pair, or (None, None) after the final part,
+        on timeout or if cancelled
+        """
+        def grab():
+            if self.parts:
+                return self.parts.popleft()
+            elif self.finished:
+                return ()
+            return None
+
+        with self.cv:
+            ret = ofutils.timed_wait(self.cv, grab, timeout=timeout)
+        if ret is None:
+            self.controller.logger.warning(
+                "Timed out waiting for multipart reply %d" % self.xid)
+            self.timed_out = True
+            self.cancel()
+        return ret or (None, None)
+
+    def __iter__(self):
+        while True:
+            (msg, pkt) = self.get(self.timeout)
+            if msg is None:
+                return
+            yield (msg, pkt)
+
+    def cancel(self):
+        """
+        Stop receiving replies and wake up any waiters
+        """
+        Transaction.cancel(self)
+        with self.cv:
+            self.parts.clear()
+
+class Subscription(object):
+    """
+    Stream of received messages of one class
+
+    Created by Controller.subscribe.  Matching messages not taken by a
+    transaction or handler are delivered here instead of to the poll
+    queue.  Iterating yields (msg, pkt) pairs as they arrive and stops
+    when no message arrives within 'timeout' seconds or the subscription
+    is closed.
+    """
+
+    def __init__(self, controller, klass, timeout=-1):
+        self.controller = controller
+        self.klass = klass
+        self.timeout = timeout
+        self.messages = deque()
+        self.cv = Condition()
+        self.closed = False
+
+    def deliver(self, msg, rawmsg):
+        with self.cv:
+            self.messages.append((msg, rawmsg))
+            self.cv.notify_all()
+
+    def get(self, timeout=-1):
+        """
+        Wait for the next message
+
+        @param timeout Maximum number of seconds to wait; if -1 use default.
+        @returns A (msg, pkt) pair, or (None, None) on timeout or close
+        """
+        def grab():
+            if self.messages:
+                return self.messages.popleft()
+            elif self.closed:
+                return ()
+            return None
+
+        with self.cv:
+            ret = ofutils.timed_wait(self.cv, grab, timeout=timeout)
+        return ret or (None, None)
+
+    def __iter__(self):
+        while True:
+            (msg, pkt) = self.get(self.timeout)
+            if msg is None:
+                return
+            yield (msg, pkt)
+
+    def close(self):
+        """
+        Stop receiving messages and wake up any waiters
+
+        Messages already delivered can still be read with get.
+        """
+        self.controller.unsubscribe(self)
+        with self.cv:
+            self.closed = True
+            self.cv.notify_all()
+
+class PacketInWaiter(object):
+    """
+    A thread blocked in Controller.poll_packet_in
+
+    Each waiter has its own condition variable on the packets lock, so a
+    matching packet in wakes only that thread.
+    """
+
+    def __init__(self, lock, data, in_port, reason):
+        self.cv = Condition(lock)
+        self.data = data
+        self.in_port = in_port
+        self.reason = reason
+        self.entry = None
+
+    def match(self, key, msg):
+        return (self.in_port is None or self.in_port == key[0]) and \
+            (self.reason is None or self.reason == key[1]) and \
+            packet_in_data_match(msg.data, self.data)
+
+class AuxiliaryChannel(Thread):
+    """
+    Auxiliary connection from the switch (OpenFlow 1.3 and later)
+
+    Each auxiliary connection has its own socket, receive buffer and reader
+    thread.  Messages received on it are handled exactly like those on the
+    main connection, so packet-ins still end up in the controller's
+    receive queues, but reading and decoding them never delays the main
+    connection.
+
+    The channel sends a hello and a features request when it starts and
+    registers itself with the controller once the features reply gives its
+    auxiliary_id.
+
+    @var auxiliary_id The auxiliary_id from the features reply, or None
+    until it has arrived
+    @var datapath_id The datapath_id from the features reply
+    """
+
+    def __init__(self, controller, sock, addr):
+        Thread.__init__(self)
+        self.daemon = True
+        self.controller = controller
+        self.sock = sock
+        self.addr = addr
+        self.rx_buffer = framing.FrameBuffer(2 * controller.rcv_size)
+        self.tx_lock = Lock()
+        self.auxiliary_id = None
+        self.datapath_id = None
+        self.active = True
+        self.logger = controller.logger
+
+    def send(self, outpkt):
+        """
+        Write a packed message to the channel
+        """
+        with self.tx_lock:
+            self._capture(outpkt, True)
+            self.sock.sendall(outpkt)
+
+    def _capture(self, data, outgoing):
+        """
+        Add data sent or received to the controller's capture, if any
+        """
+        writer = self.controller.pcap_writer
+        if writer is None:
+            return
+        if not writer.has_stream(self.addr):
+            try:
+                writer.add_stream(self.addr, self.sock.getsockname(),
+                                  self.sock.getpeername())
+            except socket.error:
+                writer.add_stream(self.addr, None, self.addr)
+        writer.write(data, time.time(), outgoing, self.addr)
+
+    def run(self):
+        ctrl = self.controller
+        features = None
+        try:
+            self.send(cfg_ofp.message.hello(xid=ofutils.gen_xid()).pack())
+            request = cfg_ofp.message.features_request(xid=ofutils.gen_xid())
+            features = ctrl._transaction_start(request)
+            self.send(request.pack())
+
+            while self.active:
+                count = self.rx_buffer.recv_into(self.sock, ctrl.rcv_size)
+                if count == 0:
+                    break
+                self._capture(self.rx_buffer.tail(count), False)
+                ctrl._pkt_handle(channel=self)
+
+                if self.auxiliary_id is None and features.done():
+                    (reply, _) = features.value
+                    if reply is None or not reply.auxiliary_id:
+                        self.logger.warning("Connection from %s is not an "
+                                            "auxiliary connection; closing"
+                                            % str(self.addr))
+                        break
+                    self.auxiliary_id = reply.auxiliary_id
+                    self.datapath_id = reply.datapath_id
+                    ctrl._aux_register(self)
+        except (socket.error, ValueError), e:
+            if self.active:
+                self.logger.warning("Auxiliary connection %s: %s"
+                                    % (str(self.addr), str(e)))
+        finally:
+            if features:
+                features.cancel()
+            ctrl._aux_unregister(self)
+            self.sock.close()
+
+    def close(self):
+        self.active = False
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
 
 class Controller(Thread):
     """
@@ -80,10 +460,12 @@ class Controller(Thread):
     byte order.
 
     @todo Consider using SocketServer for listening socket
-    @todo Test transaction code
 
-    @var rcv_size The receive size to use for receive calls
-    @var max_pkts The max size of the receive queue
+    @var rcv_size The receive size to use for receive calls.  The socket
+    receive buffer (SO_RCVBUF) is sized to RCV_BUF_READS of these.
+    @var max_pkts The default max size of each message type's receive queue
+    @var queue_limits Map from message type to a queue size overriding
+    max_pkts
     @var keep_alive If true, listen for echo requests and respond w/
     echo replies
     @var initial_hello If true, will send a hello message immediately
@@ -91,16 +473,49 @@ class Controller(Thread):
     @var switch If not None, do an active connection to the switch
     @var host The host to use for connect
     @var port The port to connect on 
+    @var handler_workers If nonzero, run message handlers on this many
+    worker threads instead of the controller thread.  Messages of one type
+    are always handled in arrival order by the same worker.  Messages
+    without a handler are still queued by the controller thread.
+    @var max_auxiliary Number of OpenFlow 1.3+ auxiliary connections to
+    accept from the switch once the main connection is up.  Packet-outs
+    are sent over them, spread by in_port.
+    @var aux_channels Map from auxiliary_id to AuxiliaryChannel
+    @var tx_coalesce Maximum number of seconds an outgoing message is held
+    so that it can be written together with the messages that follow it.
+    Zero, the default, sends every message immediately.  reset sets it
+    back to the value given to the constructor.
     @var packets_total Total number of packets received
     @var packets_expired Number of packets popped from queue as queue full
+    @var expired_by_type Map from message type to number of packets expired
     @var packets_handled Number of packets handled by something
+    @var handler_drops Number of messages queued without calling their
+    handler because its worker was backlogged
+    @var metrics ControlChannelMetrics with per message type counters and
+    transaction latencies
+    @var pcap_writer If not None, TcpStreamPcapWriter capturing the control
+    channel
+    @var capabilities CapabilityCache of the switch's replies to
+    description requests on this connection
+    @var flow_cookie If not None, the tag put in the FLOW_COOKIE_MASK bits
+    of the cookie of every flow_add sent whose cookie has none.  Only the
+    copy sent to the switch is tagged, and the tag is removed from the
+    cookies of received flow_removed messages and flow stats, so tests
+    see the cookies they chose.
+    @var flow_tables Set of tables tagged flows were added to since the
+    last cleanup; see testutils.delete_session_flows
+    @var flow_untagged Set of (table_id, cookie) of flows added since the
+    last cleanup that could not be tagged because their cookie already
+    used the FLOW_COOKIE_MASK bits
     @var dbg_state Debug indication of state
     """
 
-    def __init__(self, switch=None, host='127.0.0.1', port=6653, max_pkts=1024):
+    def __init__(self, switch=None, host='127.0.0.1', port=6653, max_pkts=1024,
+                 rcv_size=RCV_SIZE_DEFAULT, handler_workers=0, max_auxiliary=0,
+                 tx_coalesce=TX_COALESCE_DEFAULT):
         Thread.__init__(self)
         # Socket related
-        self.rcv_size = RCV_SIZE_DEFAULT
+        self.rcv_size = rcv_size
         self.listen_socket = None
         self.switch_socket = None
         self.switch_addr = None
@@ -108,53 +523,124 @@ class Controller(Thread):
         self.message_cv = Condition()
         self.tx_lock = Lock()
 
+        # Outgoing messages not yet written to the socket
+        # Protected by tx_lock
+        #   tx_pending: List of packed messages
+        #   tx_deadline: Time by which tx_pending must be written
+        self.tx_pending = []
+        self.tx_pending_bytes = 0
+        self.tx_deadline = None
+        self.tx_coalesce_default = tx_coalesce
+        self.tx_coalesce = tx_coalesce
+
+        # Auxiliary connections
+        # Protected by aux_lock
+        #   aux_pending: Channels still waiting for their features reply
+        #   aux_channels: Map from auxiliary_id to AuxiliaryChannel
+        self.max_auxiliary = max_auxiliary
+        if cfg_ofp.OFP_VERSION < 4:
+            self.max_auxiliary = 0
+        self.aux_lock = Lock()
+        self.aux_pending = []
+        self.aux_channels = {}
+
+        # Control channel capture, see start_pcap
+        # Protected by tx_lock
+        self.pcap_filename = None
+        self.pcap_writer = None
+
         # Used to wake up the event loop from another thread
         self.waker = ofutils.EventDescriptor()
 
         # Counters
+        # parse_errors, packets_total, packets_handled and handler_drops
+        # are updated by every reader thread and handler worker, as is the
+        # packet in rate limit state in filter_packet; protected by
+        # counter_lock
+        self.counter_lock = Lock()
         self.socket_errors = 0
         self.parse_errors = 0
         self.packets_total = 0
         self.packets_expired = 0
         self.packets_handled = 0
+        self.handler_drops = 0
         self.poll_discards = 0
+        self.metrics = metrics.ControlChannelMetrics()
+        self.capabilities = capabilities.CapabilityCache(self)
 
         # State
         self.sync = Lock()
         self.handlers = {}
+        self.tx_monitors = []
+        self.handler_workers = handler_workers
+        if handler_workers:
+            self.handler_pool = ofutils.OrderedExecutor(
+                handler_workers, HANDLER_QUEUE_SIZE, "controller-handler")
+        else:
+            self.handler_pool = None
         self.keep_alive = False
         self.active = True
         self.initial_hello = True
+        self.flow_cookie = None
+        self.flow_tables = set([FLOW_TABLES_ALL])
+        self.flow_untagged = set()
 
-        # OpenFlow message/packet queue
+        # OpenFlow message/packet queues
         # Protected by the packets_cv lock / condition variable
-        self.packets = []
+        #   queues: Map from message type to a deque of (seq, msg, rawmsg)
+        #   rx_seq: Arrival sequence number given to the next queued message
+        self.queues = {}
+        self.rx_seq = 0
         self.packets_cv = Condition()
+        self.expired_by_type = {}
+
+        # Map from message type to list of Subscriptions
+        # Protected by the packets_cv lock
+        self.subscriptions = {}
         self.packet_in_count = 0
 
+        # Packet in index, protected by the packets_cv lock
+        #   pkt_in_live: Map from seq to index key of each queued packet in
+        #   pkt_in_index: Map from index key to a deque of queue entries
+        #   pkt_in_indexed: Number of entries in pkt_in_index
+        #   pkt_in_waiters: Map from index key, or None for waiters that
+        #   cannot be indexed, to a list of PacketInWaiters
+        # A packet in taken through the queue or the index is removed from
+        # pkt_in_live only; the other structure skips it later.
+        self.pkt_in_live = {}
+        self.pkt_in_index = {}
+        self.pkt_in_indexed = 0
+        self.pkt_in_waiters = {}
+
         # Settings
         self.max_pkts = max_pkts
+        self.queue_limits = {}
         self.switch = switch
         self.passive = not self.switch
         self.host = host
         self.port = port
         self.dbg_state = "init"
         self.logger = logging.getLogger("controller")
+        self.ingress = ingress.IngressPolicy() # Rate limits and sampling
         self.filter_packet_in = False # Drop "excessive" packet ins
-        self.pkt_in_run = 0 # Count on run of packet ins
-        self.pkt_in_filter_limit = 50 # Count on run of packet ins
+        self.pkt_in_run = 0 # Count on run of dropped packet ins
+        self.pkt_in_filter_limit = 50 # Packet ins per second when filtering
+        self.pkt_in_bucket = None
         self.pkt_in_dropped = 0 # Total dropped packet ins
         self.transact_to = 15 # Transact timeout default value; add to config
 
-        # Transaction and message type waiting variables 
-        #   xid_cv: Condition variable (semaphore) for packet waiters
-        #   xid: Transaction ID being waited on
-        #   xid_response: Transaction response message
-        self.xid_cv = Condition()
-        self.xid = None
-        self.xid_response = None
+        # Outstanding transactions
+        #   xid_lock: Protects the transactions table
+        #   transactions: Map from xid to the Transaction waiting on the reply
+        self.xid_lock = Lock()
+        self.transactions = {}
 
-        self.buffered_input = ""
+        # Transactions started by send_async, per calling thread; see
+        # wait_all
+        self.async_started = local()
+
+        # Received bytes not yet framed into messages
+        self.rx_buffer = framing.FrameBuffer(2 * self.rcv_size)
 
         # Create listen socket
         if self.passive:
@@ -170,32 +656,52 @@ class Controller(Thread):
             self.listen_socket.bind(sockaddr)
             self.listen_socket.listen(LISTEN_QUEUE_SIZE)
 
-    def filter_packet(self, rawmsg, hdr):
+    def filter_packet(self, rawmsg, hdr_version, hdr_type):
         """
         Check if packet should be filtered
 
-        Currently filters packet in messages
+        Applies the ingress policy, then, if filter_packet_in is set, limits
+        packet ins to pkt_in_filter_limit per second.  Only the header and
+        the packet in in_port are looked at, so the message need not be
+        parsed.  Messages of other types are only dropped if the ingress
+        policy was configured for them.
+
+        @param rawmsg Buffer holding the complete raw message
         @return Boolean, True if packet should be dropped
         """
-        # XXX didn't actually check for packet-in...
-        return False
-        # Add check for packet in and rate limit
-        if self.filter_packet_in:
+        drop = self.ingress.check(rawmsg, hdr_version, hdr_type)
+        if hdr_type != ingress.OFPT_PACKET_IN:
+            return drop
+
+        run = 0
+        with self.counter_lock:
+            if not drop and self.filter_packet_in:
+                if self.pkt_in_bucket is None or \
+                        self.pkt_in_bucket.rate != self.pkt_in_filter_limit:
+                    self.pkt_in_bucket = ingress.TokenBucket(
+                        self.pkt_in_filter_limit, self.pkt_in_filter_limit)
+                drop = not self.pkt_in_bucket.take()
+
+            if drop:
+                self.pkt_in_run += 1
+                self.pkt_in_dropped += 1
+            elif self.pkt_in_run:
+                (run, self.pkt_in_run) = (self.pkt_in_run, 0)
+            total = self.pkt_in_dropped
+
+        if run:
             # If we were dropping packets, report number dropped
-            # TODO dont drop expected packet ins
-            if self.pkt_in_run > self.pkt_in_filter_limit:
-                self.logger.debug("Dropped %d packet ins (%d total)"
-                            % ((self.pkt_in_run - 
-                                self.pkt_in_filter_limit),
-                                self.pkt_in_dropped))
-            self.pkt_in_run = 0
+            self.logger.debug("Dropped %d packet ins (%d total)"
+                              % (run, total))
 
-        return False
+        return drop
 
-    def _pkt_handle(self, pkt):
+    def _pkt_handle(self, pkt=None, channel=None):
         """
         Check for all packet handling conditions
 
+        Answer echo requests from the raw message if keep_alive is set
+        Drop messages rejected by the ingress policy
         Parse and verify message 
         Check if XID matches something waiting
         Check if message is being expected for a poll operation
@@ -205,66 +711,82 @@ class Controller(Thread):
 
         an echo request in case keep_alive is true, followed by
         registered message handlers.
-        @param pkt The raw packet (string) which may contain multiple OF msgs
+        @param pkt The raw packet (string) which may contain multiple OF msgs,
+        or None if the data was already received into rx_buffer.  Any
+        partial message is kept for the next call.
+        @param channel The AuxiliaryChannel the data was received on, or
+        None for the main connection
         """
 
-        # snag any left over data from last read()
-        pkt = self.buffered_input + pkt
-        self.buffered_input = ""
+        rx_buffer = channel and channel.rx_buffer or self.rx_buffer
+        if pkt:
+            rx_buffer.feed(pkt)
+
+        # First look only at the header of each complete message.  Echo
+        # requests are answered before anything else in this read is
+        # decoded, so keepalives never wait behind large messages.
+        messages = []
+        for (hdr_version, hdr_type, hdr_length, hdr_xid, frame) in \
+                rx_buffer.frames():
+            if self.keep_alive and hdr_type == framing.OFPT_ECHO_REQUEST:
+                self._echo_reply(frame, channel)
+                continue
 
-        # Process each of the OF msgs inside the pkt
-        offset = 0
-        while offset < len(pkt):
-            if offset + 8 > len(pkt):
-                break
+            # Replies to outstanding transactions are never filtered
+            if hdr_xid not in self.transactions and \
+                    self.filter_packet(frame, hdr_version, hdr_type):
+                continue
 
-            # Parse the header to get type
-            hdr_version, hdr_type, hdr_length, hdr_xid = cfg_ofp.message.parse_header(pkt[offset:])
+            # Copy the message out of the buffer before it is reused
+            messages.append((hdr_version, hdr_type, hdr_length, hdr_xid,
+                             frame.tobytes()))
 
+        # Process the remaining OF msgs in arrival order.  Transaction
+        # replies are not moved ahead of earlier messages, so that e.g. an
+        # error is queued before the barrier reply that follows it.
+        for (hdr_version, hdr_type, hdr_length, hdr_xid, rawmsg) in messages:
             # Use loxi to resolve to ofp of matching version
             ofp = loxi.protocol(hdr_version)
 
-            # Extract the raw message bytes
-            if (offset + hdr_length) > len(pkt):
-                break
-            rawmsg = pkt[offset : offset + hdr_length]
-            offset += hdr_length
-
-            #if self.filter_packet(rawmsg, hdr):
-            #    continue
-
+            decode_start = time.time()
             msg = ofp.message.parse_message(rawmsg)
+            self.metrics.record_stage("decode", time.time() - decode_start)
             if not msg:
-                self.parse_errors += 1
+                with self.counter_lock:
+                    self.parse_errors += 1
                 self.logger.warn("Could not parse message")
                 continue
+            self.metrics.record_rx(type(msg).__name__, hdr_length)
 
             self.logger.debug("Msg in: version %d class %s len %d xid %d",
                               hdr_version, type(msg).__name__, hdr_length, hdr_xid)
 
-            with self.sync:
-                # Check if transaction is waiting
-                with self.xid_cv:
-                    if self.xid and hdr_xid == self.xid:
-                        self.logger.debug("Matched expected XID " + str(hdr_xid))
-                        self.xid_response = (msg, rawmsg)
-                        self.xid = None
-                        self.xid_cv.notify()
-                        continue
-
-                # Check if keep alive is set; if so, respond to echo requests
-                if self.keep_alive:
-                    if hdr_type == ofp.OFPT_ECHO_REQUEST:
-                        self.logger.debug("Responding to echo request")
-                        rep = ofp.message.echo_reply()
-                        rep.xid = hdr_xid
-                        # Ignoring additional data
-                        self.message_send(rep)
-                        continue
+            if self.flow_cookie is not None:
+                self._untag_flows(msg)
+
+            # Check if transaction is waiting
+            failed = False
+            with self.xid_lock:
+                future = self.transactions.get(hdr_xid)
+                try:
+                    if future and future.deliver(msg, rawmsg):
+                        del self.transactions[hdr_xid]
+                except:
+                    self.logger.exception("Transaction %d failed" % hdr_xid)
+                    failed = True
+            if failed:
+                # Wake the waiter rather than ending this thread
+                future.cancel()
+            if future:
+                self.logger.debug("Matched expected XID " + str(hdr_xid))
+                continue
 
+            with self.sync:
                 # Generalize to counters for all packet types?
                 if msg.type == ofp.OFPT_PACKET_IN:
                     self.packet_in_count += 1
+                elif msg.type == ofp.OFPT_PORT_STATUS:
+                    self.capabilities.invalidate(capabilities.PORT_ENTRIES)
 
                 # Log error messages
                 if isinstance(msg, ofp.message.error_msg):
@@ -298,30 +820,209 @@ class Controller(Thread):
                     if msg.version >= 3 and isinstance(msg, ofp.message.bsn_error):
                         self.logger.warn("BSN error, msg '%s'", msg.err_msg)
 
-                # Now check for message handlers; preference is given to
-                # handlers for a specific packet
-                handled = False
-                if hdr_type in self.handlers.keys():
-                    handled = self.handlers[hdr_type](self, msg, rawmsg)
-                if not handled and ("all" in self.handlers.keys()):
-                    handled = self.handlers["all"](self, msg, rawmsg)
-
-                if not handled: # Not handled, enqueue
-                    with self.packets_cv:
-                        if len(self.packets) >= self.max_pkts:
-                            self.packets.pop(0)
-                            self.packets_expired += 1
-                        self.packets.append((msg, rawmsg))
-                        self.packets_cv.notify_all()
-                    self.packets_total += 1
-                else:
-                    self.packets_handled += 1
-                    self.logger.debug("Message handled by callback")
+                # Only messages a handler may take go to the workers, so
+                # the rest are queued in arrival order
+                pooled = self.handler_pool is not None and \
+                    (hdr_type in self.handlers or "all" in self.handlers)
+                if not pooled:
+                    self._dispatch(hdr_type, msg, rawmsg)
+
+            if pooled:
+                # Never wait for a worker: its handler may be waiting on
+                # a reply that this thread has yet to read
+                key = "all" in self.handlers and "all" or hdr_type
+                if not self.handler_pool.submit(key, self._dispatch,
+                                                hdr_type, msg, rawmsg):
+                    self.logger.warning("Handler backlogged; queueing %s"
+                                        % type(msg).__name__)
+                    self._enqueue(hdr_type, msg, rawmsg)
+                    with self.counter_lock:
+                        self.handler_drops += 1
+                        self.packets_total += 1
+
+    def _dispatch(self, hdr_type, msg, rawmsg):
+        """
+        Pass a message to the registered handlers
 
-        # end of 'while offset < len(pkt)'
-        #   note that if offset = len(pkt), this is
-        #   appends a harmless empty string
-        self.buffered_input += pkt[offset:]
+        Enqueue the message for poll if no handler wants it.
+        """
+        # Now check for message handlers; preference is given to
+        # handlers for a specific packet
+        handled = False
+        handler_start = time.time()
+        if hdr_type in self.handlers.keys():
+            handled = self.handlers[hdr_type](self, msg, rawmsg)
+        if not handled and ("all" in self.handlers.keys()):
+            handled = self.handlers["all"](self, msg, rawmsg)
+        self.metrics.record_stage("handler", time.time() - handler_start)
+
+        if not handled: # Not handled, enqueue
+            self._enqueue(hdr_type, msg, rawmsg)
+            with self.counter_lock:
+                self.packets_total += 1
+        else:
+            with self.counter_lock:
+                self.packets_handled += 1
+            self.logger.debug("Message handled by callback")
+
+    def _echo_reply(self, frame, channel=None):
+        """
+        Answer an echo request without parsing it
+
+        The reply is the request with its type changed, so it keeps the
+        xid and echoes the payload.
+        """
+        self.logger.debug("Responding to echo request")
+        reply = bytearray(frame)
+        reply[1] = framing.OFPT_ECHO_REPLY
+        self.metrics.record_rx("echo_request", len(reply))
+        self.metrics.record_tx("echo_reply", len(reply))
+        if channel:
+            channel.send(str(reply))
+        else:
+            self._transmit(str(reply), flush=True)
+
+    def _enqueue(self, hdr_type, msg, rawmsg):
+        """
+        Append a message to the queue for its type
+
+        If a subscription wants the message it is delivered there instead.
+        If the queue is full the oldest message of the same type is dropped.
+        """
+        with self.packets_cv:
+            for subscription in self.subscriptions.get(hdr_type, []):
+                if isinstance(msg, subscription.klass):
+                    subscription.deliver(msg, rawmsg)
+                    return
+
+            is_pkt_in = hdr_type == ingress.OFPT_PACKET_IN
+            if is_pkt_in:
+                key = packet_in_key(msg.data, packet_in_port(msg), msg.reason)
+                if self._pkt_in_hand_off(key, msg, rawmsg):
+                    return
+                self._pkt_in_trim()
+
+            queue = self.queues.get(hdr_type)
+            if queue is None:
+                queue = self.queues[hdr_type] = deque()
+            depth = len(self.pkt_in_live) if is_pkt_in else len(queue)
+            if depth >= self.queue_limits.get(hdr_type, self.max_pkts):
+                entry = queue.popleft()
+                self.pkt_in_live.pop(entry[0], None)
+                self.packets_expired += 1
+                self.expired_by_type[hdr_type] = \
+                    self.expired_by_type.get(hdr_type, 0) + 1
+                depth -= 1
+            entry = (self.rx_seq, msg, rawmsg)
+            queue.append(entry)
+            self.rx_seq += 1
+            if is_pkt_in:
+                self._pkt_in_add(entry, key)
+            self.metrics.record_queue_depth(type(msg).__name__, depth + 1)
+            self.packets_cv.notify_all()
+
+    def _pkt_in_add(self, entry, key):
+        """
+        Add a queued packet in to the index; packets_cv must be held
+        """
+        self.pkt_in_live[entry[0]] = key
+        self.pkt_in_index.setdefault(key, deque()).append(entry)
+        self.pkt_in_indexed += 1
+
+        queue = self.queues[ingress.OFPT_PACKET_IN]
+        limit = 2 * len(self.pkt_in_live) + PKT_IN_COMPACT_SLACK
+        if len(queue) > limit or self.pkt_in_indexed > limit:
+            self._pkt_in_compact()
+
+    def _pkt_in_compact(self):
+        """
+        Drop taken packet ins from the queue and rebuild the index;
+        packets_cv must be held
+        """
+        queue = self.queues.get(ingress.OFPT_PACKET_IN, ())
+        live = deque([entry for entry in queue if entry[0] in self.pkt_in_live])
+        self.queues[ingress.OFPT_PACKET_IN] = live
+        self.pkt_in_index = {}
+        for entry in live:
+            key = self.pkt_in_live[entry[0]]
+            self.pkt_in_index.setdefault(key, deque()).append(entry)
+        self.pkt_in_indexed = len(live)
+
+    def _pkt_in_trim(self):
+        """
+        Drop taken packet ins from the front of the queue; packets_cv must
+        be held
+        """
+        queue = self.queues.get(ingress.OFPT_PACKET_IN)
+        while queue and queue[0][0] not in self.pkt_in_live:
+            queue.popleft()
+
+    def _pkt_in_hand_off(self, key, msg, rawmsg):
+        """
+        Give a received packet in to the first thread waiting for it;
+        packets_cv must be held
+
+        @returns True if a waiter took the packet in
+        """
+        if key[2] is None:
+            # Too short to hash, so any waiter may match
+            candidates = [w for waiters in self.pkt_in_waiters.values()
+                          for w in waiters]
+        else:
+            candidates = self.pkt_in_waiters.get(key, []) + \
+                self.pkt_in_waiters.get(None, [])
+        for waiter in candidates:
+            if waiter.match(key, msg):
+                self._pkt_in_unregister(waiter)
+                waiter.entry = (msg, rawmsg)
+                waiter.cv.notify()
+                return True
+        return False
+
+    def _pkt_in_unregister(self, waiter):
+        for (key, waiters) in self.pkt_in_waiters.items():
+            if waiter in waiters:
+                waiters.remove(waiter)
+                if not waiters:
+                    del self.pkt_in_waiters[key]
+                return
+
+    def _pkt_in_find(self, key, data, in_port, reason):
+        """
+        Remove and return the first queued packet in matching the
+        arguments, or None; packets_cv must be held
+
+        @param key Index key of the expected packet, or None to search the
+        whole queue
+        """
+        if key is None:
+            candidates = self.queues.get(ingress.OFPT_PACKET_IN, ())
+        else:
+            candidates = []
+            for bucket_key in (key, (in_port, reason, None)):
+                entries = self.pkt_in_index.get(bucket_key)
+                while entries and entries[0][0] not in self.pkt_in_live:
+                    entries.popleft()
+                    self.pkt_in_indexed -= 1
+                if entries:
+                    candidates.extend(entries)
+                elif entries is not None:
+                    del self.pkt_in_index[bucket_key]
+            if len(candidates) > 1:
+                candidates.sort()
+
+        for entry in candidates:
+            (seq, msg, rawmsg) = entry
+            entry_key = self.pkt_in_live.get(seq)
+            if entry_key is None:
+                continue
+            if (in_port is None or in_port == entry_key[0]) and \
+                    (reason is None or reason == entry_key[1]) and \
+                    packet_in_data_match(msg.data, data):
+                del self.pkt_in_live[seq]
+                self._pkt_in_trim()
+                return entry
+        return None
 
     def _socket_ready_handle(self, s):
         """
@@ -333,9 +1034,19 @@ class Controller(Thread):
 
         if self.passive and s and s == self.listen_socket:
             if self.switch_socket:
-                self.logger.warning("Ignoring incoming connection; already connected to switch")
                 (sock, addr) = self.listen_socket.accept()
-                sock.close()
+                with self.aux_lock:
+                    count = len(self.aux_pending) + len(self.aux_channels)
+                if count >= self.max_auxiliary:
+                    self.logger.warning("Ignoring incoming connection; already connected to switch")
+                    sock.close()
+                    return 0
+                self.logger.info("Auxiliary connection from " + str(addr))
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, True)
+                channel = AuxiliaryChannel(self, sock, addr)
+                with self.aux_lock:
+                    self.aux_pending.append(channel)
+                channel.start()
                 return 0
 
             try:
@@ -347,19 +1058,20 @@ class Controller(Thread):
 
             with self.connect_cv:
                 (self.switch_socket, self.switch_addr) = (sock, addr)
-                self.switch_socket.setsockopt(socket.IPPROTO_TCP,
-                                              socket.TCP_NODELAY, True)
+                self._socket_setup(self.switch_socket)
                 if self.initial_hello:
                     self.message_send(cfg_ofp.message.hello())
                 self.connect_cv.notify() # Notify anyone waiting
 
-            # Prevent further connections
-            self.listen_socket.close()
-            self.listen_socket = None
+            # Prevent further connections, unless they may be auxiliary
+            if not self.max_auxiliary:
+                self.listen_socket.close()
+                self.listen_socket = None
         elif s and s == self.switch_socket:
             for idx in range(3): # debug: try a couple of times
                 try:
-                    pkt = self.switch_socket.recv(self.rcv_size)
+                    count = self.rx_buffer.recv_into(self.switch_socket,
+                                                     self.rcv_size)
                 except:
                     self.logger.warning("Error on switch read")
                     return -1
@@ -367,17 +1079,25 @@ class Controller(Thread):
                 if not self.active:
                     return 0
       
-                if len(pkt) == 0:
+                if count == 0:
                     self.logger.warning("Zero-length switch read, %d" % idx)
                 else:
                     break
 
-            if len(pkt) == 0: # Still no packet
+            if count == 0: # Still no packet
                 self.logger.warning("Zero-length switch read; closing cxn")
                 self.logger.info(str(self))
                 return -1
 
-            self._pkt_handle(pkt)
+            writer = self.pcap_writer
+            if writer:
+                writer.write(self.rx_buffer.tail(count), time.time(), False)
+
+            try:
+                self._pkt_handle()
+            except ValueError, e:
+                self.logger.error("Bad message framing: %s; closing cxn" % e)
+                return -1
         elif s and s == self.waker:
             self.waker.wait()
         else:
@@ -396,7 +1116,7 @@ class Controller(Thread):
             soc.connect((self.switch, self.port))
             self.logger.info("Connected to " + self.switch + " on " +
                          str(self.port))
-            soc.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, True)
+            self._socket_setup(soc)
             self.switch_addr = (self.switch, self.port)
             return soc
         except (StandardError, socket.error), e:
@@ -404,6 +1124,104 @@ class Controller(Thread):
                               (self.switch, self.port, str(e)))
         return None
 
+    def _socket_setup(self, soc):
+        """
+        Set options on a newly connected switch socket
+        """
+        soc.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, True)
+        try:
+            soc.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF,
+                           RCV_BUF_READS * self.rcv_size)
+        except socket.error, e:
+            self.logger.warning("Could not set receive buffer size: %s" % e)
+        self.rx_buffer.clear()
+        self.capabilities.invalidate()
+        with self.tx_lock:
+            self._pcap_open(soc)
+
+    def start_pcap(self, filename):
+        """
+        Capture the control channel to a pcap file
+
+        Messages are written as a TCP stream between the controller and
+        switch addresses, one segment per socket read or write.  If not yet
+        connected, the capture starts with the connection.  Auxiliary
+        connections are written to the same file as further streams.
+        """
+        with self.tx_lock:
+            assert(self.pcap_writer == None)
+            self.pcap_filename = filename
+            if self.switch_socket:
+                self._pcap_open(self.switch_socket)
+
+    def stop_pcap(self):
+        with self.tx_lock:
+            writer = self.pcap_writer
+            self.pcap_writer = None
+            self.pcap_filename = None
+        if writer:
+            writer.close()
+            if writer.dropped:
+                self.logger.warning("Control channel capture dropped %d writes"
+                                    % writer.dropped)
+
+    def _pcap_open(self, soc):
+        """
+        Open the capture file for a new connection; tx_lock must be held
+        """
+        if self.pcap_filename is None or self.pcap_writer is not None:
+            return
+        try:
+            (local_addr, remote_addr) = (soc.getsockname(), soc.getpeername())
+        except socket.error:
+            (local_addr, remote_addr) = (None, None)
+        self.pcap_writer = TcpStreamPcapWriter(self.pcap_filename,
+                                               local_addr, remote_addr)
+
+    def _aux_register(self, channel):
+        with self.aux_lock:
+            if channel in self.aux_pending:
+                self.aux_pending.remove(channel)
+            old = self.aux_channels.get(channel.auxiliary_id)
+            self.aux_channels[channel.auxiliary_id] = channel
+        if old:
+            old.close()
+        self.logger.info("Auxiliary connection %d from %s ready" %
+                         (channel.auxiliary_id, str(channel.addr)))
+
+    def _aux_unregister(self, channel):
+        with self.aux_lock:
+            if channel in self.aux_pending:
+                self.aux_pending.remove(channel)
+            if self.aux_channels.get(channel.auxiliary_id) is channel:
+                del self.aux_channels[channel.auxiliary_id]
+
+    def _aux_close(self):
+        """
+        Close all auxiliary connections
+        """
+        with self.aux_lock:
+            channels = self.aux_pending + self.aux_channels.values()
+            self.aux_pending = []
+            self.aux_channels = {}
+        for channel in channels:
+            channel.close()
+
+    def _aux_channel_for(self, msg):
+        """
+        Pick the auxiliary connection to send msg on
+
+        @returns An AuxiliaryChannel, or None to use the main connection
+        """
+        if not self.aux_channels or msg.type != cfg_ofp.OFPT_PACKET_OUT:
+            return None
+        with self.aux_lock:
+            ids = sorted(self.aux_channels.keys())
+            if not ids:
+                return None
+            # Keep the packet-outs for one port in order
+            return self.aux_channels[ids[msg.in_port % len(ids)]]
+
     def wakeup(self):
         """
         Wake up the event loop, presumably from another thread.
@@ -435,9 +1253,14 @@ class Controller(Thread):
         self.dbg_state = "running"
 
         while self.active:
+            timeout = 1
+            deadline = self.tx_deadline
+            if deadline is not None:
+                timeout = max(min(deadline - time.time(), timeout), 0)
+
             try:
                 sel_in, sel_out, sel_err = \
-                    select.select(self.sockets(), [], self.sockets(), 1)
+                    select.select(self.sockets(), [], self.sockets(), timeout)
             except:
                 print sys.exc_info()
                 self.logger.error("Select error, disconnecting")
@@ -451,6 +1274,14 @@ class Controller(Thread):
                 if self._socket_ready_handle(s) == -1:
                     self.disconnect()
 
+            deadline = self.tx_deadline
+            if deadline is not None and time.time() >= deadline:
+                try:
+                    self.flush()
+                except:
+                    self.logger.error("Error writing to switch, disconnecting")
+                    self.disconnect()
+
         # End of main loop
         self.dbg_state = "closing"
         self.logger.info("Exiting controller thread")
@@ -493,11 +1324,17 @@ class Controller(Thread):
         If connected to a switch, disconnect.
         """
         if self.switch_socket:
+            with self.tx_lock:
+                self.tx_pending = []
+                self.tx_pending_bytes = 0
+                self.tx_deadline = None
             self.switch_socket.close()
             self.switch_socket = None
             self.switch_addr = None
+            self._aux_close()
+            self.capabilities.invalidate()
             with self.packets_cv:
-                self.packets = []
+                self._clear_queues()
             with self.connect_cv:
                 self.connect_cv.notifyAll()
 
@@ -529,6 +1366,12 @@ class Controller(Thread):
         """
 
         self.active = False
+        try:
+            self.flush()
+        except:
+            self.logger.info("Ignoring error writing pending messages")
+        self.stop_pcap()
+        self._aux_close()
         try:
             self.switch_socket.shutdown(socket.SHUT_RDWR)
         except:
@@ -541,9 +1384,17 @@ class Controller(Thread):
             self.logger.info("Ignoring listen soc shutdown error")
         self.listen_socket = None
 
+        if self.handler_pool:
+            self.handler_pool.shutdown()
+
+        # Wake up any threads waiting on a transaction
+        with self.xid_lock:
+            futures = self.transactions.values()
+            self.transactions = {}
+        for future in futures:
+            future.cancel()
+
         # Wakeup condition variables on which controller may be wait
-        with self.xid_cv:
-            self.xid_cv.notifyAll()
 
         with self.connect_cv:
             self.connect_cv.notifyAll()
@@ -557,8 +1408,14 @@ class Controller(Thread):
 
         Only one handler may be registered for a given message type.
 
-        WARNING:  A lock is held during the handler call back, so 
-        the handler should not make any blocking calls
+        WARNING:  Unless the controller was created with handler_workers,
+        a lock is held during the handler call back, so the handler should
+        not make any blocking calls.  With handler_workers, a slow handler
+        only delays later messages of the same type, or of all types for
+        the "all" handler.  A message its handler does not take is queued
+        when the handler returns, possibly after later messages.  While a
+        worker has HANDLER_QUEUE_SIZE messages waiting, further messages
+        for it are queued without calling the handler; see handler_drops.
 
         @param msg_type The type of message to receive.  May be DEFAULT 
         for all non-handled packets.  The special type, the string "all"
@@ -572,6 +1429,18 @@ class Controller(Thread):
             return
         self.handlers[msg_type] = handler
 
+    def add_tx_monitor(self, monitor):
+        """
+        Call monitor(msg) for every message object sent with message_send
+
+        Monitors are called from the sending thread, after the message has
+        been packed and before it is written.
+        """
+        self.tx_monitors = self.tx_monitors + [monitor]
+
+    def remove_tx_monitor(self, monitor):
+        self.tx_monitors = [m for m in self.tx_monitors if m != monitor]
+
     def poll(self, exp_msg=None, timeout=-1):
         """
         Wait for the next OF message received from the switch.
@@ -593,23 +1462,43 @@ class Controller(Thread):
         if exp_msg is None:
             self.logger.warn("DEPRECATED polling for any message class")
             klass = None
-        elif isinstance(exp_msg, int):
-            klass = cfg_ofp.message.message.subtypes[exp_msg]
-        elif issubclass(exp_msg, loxi.OFObject):
-            klass = exp_msg
         else:
-            raise ValueError("Unexpected exp_msg argument %r" % exp_msg)
+            klass = self._message_class(exp_msg)
 
-        self.logger.debug("Polling for %s", klass.__name__)
+        self.logger.debug("Polling for %s", klass.__name__ if klass else "Any")
+        self.flush()
 
         # Take the packet from the queue
         def grab():
-            for i, (msg, pkt) in enumerate(self.packets):
-                if klass is None or isinstance(msg, klass):
+            self._pkt_in_trim()
+            if klass is None or not hasattr(klass, "type"):
+                # Oldest message of any type
+                queue = None
+                for q in self.queues.values():
+                    if q and (queue is None or q[0][0] < queue[0][0]):
+                        queue = q
+                if queue is not None:
+                    (seq, msg, pkt) = queue.popleft()
+                    self.pkt_in_live.pop(seq, None)
                     self.logger.debug("Got %s message", msg.__class__.__name__)
-                    return self.packets.pop(i)
+                    return (msg, pkt)
+            else:
+                queue = self.queues.get(klass.type)
+                if queue:
+                    # The head matches unless polling for a subclass, such
+                    # as one kind of stats reply
+                    pkt_in = klass.type == ingress.OFPT_PACKET_IN
+                    for i, (seq, msg, pkt) in enumerate(queue):
+                        if pkt_in and seq not in self.pkt_in_live:
+                            continue
+                        if isinstance(msg, klass):
+                            del queue[i]
+                            self.pkt_in_live.pop(seq, None)
+                            self.logger.debug("Got %s message", msg.__class__.__name__)
+                            return (msg, pkt)
             # Not found
-            self.logger.debug("%s message not in queue", klass.__name__)
+            self.logger.debug("%s message not in queue",
+                              klass.__name__ if klass else "Any")
             return None
 
         with self.packets_cv:
@@ -621,13 +1510,110 @@ class Controller(Thread):
         else:
             return (None, None)
 
+    def poll_packet_in(self, data, in_port=None, reason=None, timeout=-1):
+        """
+        Wait for a packet in carrying a given packet
+
+        Unlike poll, packet ins that do not match stay queued.  The
+        received data may be truncated or padded, so it matches if one of
+        it and data is a prefix of the other.  With in_port, reason and at
+        least PKT_IN_PREFIX bytes of data the queued packet ins are found
+        through the packet in index and the waiting thread is only woken
+        by a matching one; otherwise every packet in is compared.
+
+        @param data String expected as the packet in data
+        @param in_port OpenFlow port number expected, or None for any
+        @param reason OFPR_* reason expected, or None for any
+        @param timeout Maximum number of seconds to wait; if -1 use default.
+        @retval A pair (msg, pkt) as for poll, or (None, None) on timeout
+        """
+        key = packet_in_key(data, in_port, reason)
+        if in_port is None or reason is None or key[2] is None:
+            key = None
+        self.flush()
+
+        with self.packets_cv:
+            entry = self._pkt_in_find(key, data, in_port, reason)
+            if entry is not None:
+                return entry[1:]
+
+            waiter = PacketInWaiter(self.packets_cv, data, in_port, reason)
+            self.pkt_in_waiters.setdefault(key, []).append(waiter)
+            ret = ofutils.timed_wait(waiter.cv, lambda: waiter.entry,
+                                     timeout=timeout)
+            if ret is None:
+                self._pkt_in_unregister(waiter)
+                return (None, None)
+            return ret
+
+    def subscribe(self, exp_msg, timeout=-1):
+        """
+        Receive all messages of a class as a stream
+
+        Messages of that class already in the poll queue are moved to the
+        subscription, and new ones bypass the queue until it is closed.
+
+        for (msg, pkt) in ctrl.subscribe(ofp.message.packet_in):
+            ...
+
+        @param exp_msg Message type or class, as for poll
+        @param timeout Seconds iteration waits for each message; if -1
+        use default
+        @returns A Subscription
+        """
+
+        klass = self._message_class(exp_msg)
+        if not hasattr(klass, "type"):
+            raise ValueError("Cannot subscribe to %s" % klass.__name__)
+
+        subscription = Subscription(self, klass, timeout)
+        with self.packets_cv:
+            queue = self.queues.get(klass.type)
+            if queue:
+                pkt_in = klass.type == ingress.OFPT_PACKET_IN
+                keep = deque()
+                for entry in queue:
+                    if pkt_in and entry[0] not in self.pkt_in_live:
+                        continue # Already taken through the index
+                    if isinstance(entry[1], klass):
+                        self.pkt_in_live.pop(entry[0], None)
+                        subscription.deliver(entry[1], entry[2])
+                    else:
+                        keep.append(entry)
+                self.queues[klass.type] = keep
+                if pkt_in:
+                    self._pkt_in_compact()
+            self.subscriptions.setdefault(klass.type, []).append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """
+        Remove a subscription; new messages go to the poll queue again
+        """
+        with self.packets_cv:
+            subscriptions = self.subscriptions.get(subscription.klass.type, [])
+            if subscription in subscriptions:
+                subscriptions.remove(subscription)
+
+    def _message_class(self, exp_msg):
+        """
+        Resolve a message type number or class to a message class
+        """
+        if isinstance(exp_msg, int):
+            return cfg_ofp.message.message.subtypes[exp_msg]
+        elif issubclass(exp_msg, loxi.OFObject):
+            return exp_msg
+        else:
+            raise ValueError("Unexpected exp_msg argument %r" % exp_msg)
+
     def transact(self, msg, timeout=-1):
         """
         Run a message transaction with the switch
 
         Send the message in msg and wait for a reply with a matching
         transaction id.  Transactions have the highest priority in
-        received message handling.
+        received message handling.  Several threads may run transactions
+        concurrently as long as their xids differ.
 
         @param msg The message object to send; must not be a string
         @param timeout The timeout in seconds; if -1 use default.
@@ -638,34 +1624,176 @@ class Controller(Thread):
 
         self.logger.debug("Running transaction %d" % msg.xid)
 
-        with self.xid_cv:
-            if self.xid:
-                self.logger.error("Can only run one transaction at a time")
-                return (None, None)
+        future = self._transaction_start(msg)
+        if future is None:
+            return (None, None)
 
-            self.xid = msg.xid
-            self.xid_response = None
-            self.message_send(msg)
+        try:
+            self.message_send(msg, flush=True)
 
             self.logger.debug("Waiting for transaction %d" % msg.xid)
-            ofutils.timed_wait(self.xid_cv, lambda: self.xid_response, timeout=timeout)
+            response = future.result(timeout)
+        finally:
+            with self.xid_lock:
+                if self.transactions.get(msg.xid) is future:
+                    del self.transactions[msg.xid]
+
+        if response is None:
+            self.logger.warning("No response for xid " + str(msg.xid))
+            return (None, None)
+        return response
 
-            if self.xid_response:
-                (resp, pkt) = self.xid_response
-                self.xid_response = None
-            else:
-                (resp, pkt) = (None, None)
+    def send_async(self, msg, multipart=True):
+        """
+        Send a request to the switch without waiting for the reply
+
+        Any number of requests may be outstanding, so replies to pipelined
+        requests overlap on the control channel.
+
+        @param msg The message object to send
+        @param multipart If true, collect OFPSF_REPLY_MORE continuations
+        into a single result
+        @returns A Transaction whose result is the (msg, pkt) reply pair.
+        Cancel it if no reply is expected after all.
+        """
+
+        if msg.xid == None:
+            msg.xid = ofutils.gen_xid()
+
+        self.logger.debug("Starting async transaction %d" % msg.xid)
+
+        future = self._transaction_start(msg, multipart)
+        if future is None:
+            raise ValueError("Transaction %d already outstanding" % msg.xid)
+
+        try:
+            self.message_send(msg)
+        except:
+            future.cancel()
+            raise
+
+        futures = self._async_futures()
+        futures[:] = [other for other in futures if not other.done()]
+        futures.append(future)
+        return future
+
+    def _async_futures(self):
+        """
+        Return the calling thread's list of transactions started by
+        send_async and not yet waited for by wait_all
+        """
+        if not hasattr(self.async_started, "futures"):
+            self.async_started.futures = []
+        return self.async_started.futures
+
+    def gather(self, futures, timeout=-1):
+        """
+        Wait for a list of transactions
+
+        This is the primitive for waiting on pipelined requests; wait_all
+        is a shorthand for the calling thread's outstanding ones.
+
+        Transactions that do not complete in time are cancelled, so their
+        xids are released and late replies are queued like any other
+        message.
+
+        @param futures Transactions as returned by send_async
+        @param timeout Total time in seconds to wait for all of them;
+        if -1 use default.
+        @returns A list with the (msg, pkt) result of each transaction, or
+        None for those that did not complete in time
+        """
+
+        if timeout == -1:
+            timeout = ofutils.default_timeout
+        end_time = time.time() + timeout
+        self.flush()
+
+        results = []
+        for future in futures:
+            results.append(future.result(max(end_time - time.time(), 0)))
+        for future in futures:
+            if not future.done():
+                future.cancel()
+        return results
+
+    def wait_all(self, timeout=-1):
+        """
+        Wait for the transactions this thread started with send_async
+
+        Only transactions still outstanding when wait_all is called are
+        waited for, and those that do not complete in time are cancelled
+        as by gather.  Transactions of other threads, such as a concurrent
+        transact, are left alone.
+
+        @param timeout Total time in seconds to wait; if -1 use default.
+        @returns Boolean, True if all of them completed in time
+        """
+
+        futures = [future for future in self._async_futures()
+                   if not future.done()]
+        self.async_started.futures = []
+        results = self.gather(futures, timeout)
+        return None not in results
+
+    def send_multipart(self, msg, timeout=-1):
+        """
+        Send a multipart request and stream its replies
+
+        @param msg The multipart (stats) request to send
+        @param timeout Maximum number of seconds to wait for each reply
+        part while iterating the stream; if -1 use default.
+        @returns A MultipartStream.  Cancel it to stop early.
+        """
+
+        if msg.xid == None:
+            msg.xid = ofutils.gen_xid()
+
+        self.logger.debug("Starting multipart transaction %d" % msg.xid)
+
+        stream = MultipartStream(self, msg.xid, type(msg).__name__, timeout)
+        if self._transaction_start(msg, future=stream) is None:
+            raise ValueError("Transaction %d already outstanding" % msg.xid)
+
+        try:
+            self.message_send(msg, flush=True)
+        except:
+            stream.cancel()
+            raise
 
-        if resp is None:
-            self.logger.warning("No response for xid " + str(self.xid))
-        return (resp, pkt)
+        return stream
 
-    def message_send(self, msg):
+    def _transaction_start(self, msg, multipart=False, future=None):
+        """
+        Register a transaction for the xid of msg
+
+        @param future The future to register; by default a new Transaction
+        @returns The future, or None if xid is already in use
+        """
+        xid = msg.xid
+        if future is None:
+            future = Transaction(self, xid, multipart, type(msg).__name__)
+        with self.xid_lock:
+            if xid in self.transactions:
+                self.logger.error("Transaction %d already outstanding" % xid)
+                return None
+            self.transactions[xid] = future
+        return future
+
+    def message_send(self, msg, flush=False):
         """
         Send the message to the switch
 
+        If tx_coalesce is set, messages may be held for up to that many
+        seconds so that a burst of them goes out in a single write.  Hello,
+        echo and barrier messages, any message sent with flush set, and
+        messages sent while the controller thread is not running are
+        written at once together with everything queued before them, as
+        are held messages when the sender goes on to poll or gather.
+
         @param msg A string or OpenFlow message object to be forwarded to
         the switch.
+        @param flush If true, write the message without waiting
         """
 
         if not self.switch_socket:
@@ -675,32 +1803,232 @@ class Controller(Thread):
         if msg.xid == None:
             msg.xid = ofutils.gen_xid()
 
-        outpkt = msg.pack()
+        outmsg = msg
+        if self.flow_cookie is not None and \
+                isinstance(msg, (cfg_ofp.message.flow_mod,
+                                 cfg_ofp.message.flow_stats_request,
+                                 cfg_ofp.message.aggregate_stats_request)):
+            outmsg = self._tag_flow(msg)
+
+        outpkt = outmsg.pack()
 
         self.logger.debug("Msg out: version %d class %s len %d xid %d",
                           msg.version, type(msg).__name__, len(outpkt), msg.xid)
+        self.metrics.record_tx(type(msg).__name__, len(outpkt))
+        self.capabilities.message_sent(msg)
+        for monitor in self.tx_monitors:
+            monitor(msg)
+
+        channel = self._aux_channel_for(msg)
+        if channel:
+            # Don't overtake anything held back on the main connection
+            self.flush()
+            channel.send(outpkt)
+        else:
+            self._transmit(outpkt, flush or self._latency_sensitive(msg))
+        return 0 # for backwards compatibility
+
+    def _tag_flow(self, msg):
+        """
+        Return the message to send for a flow_mod or flow stats request
+
+        A flow_add gets the session tag in its cookie and its table is
+        remembered.  Other messages get the tag if they select flows by
+        the tag bits of the cookie, so that they find the tagged flows.
+        The caller's message is never changed; a tagged copy is returned.
+        """
+        if isinstance(msg, cfg_ofp.message.flow_add):
+            tag = msg.cookie & FLOW_COOKIE_MASK
+            if tag == self.flow_cookie:
+                self.flow_tables.add(msg.table_id)
+                return msg
+            if tag:
+                self.logger.warning("Flow cookie %#x uses the session tag "
+                                    "bits; flow left untagged", msg.cookie)
+                self.flow_untagged.add((msg.table_id, msg.cookie))
+                return msg
+            self.flow_tables.add(msg.table_id)
+        elif not msg.cookie_mask & FLOW_COOKIE_MASK or \
+                msg.cookie & FLOW_COOKIE_MASK:
+            return msg
+        tagged = copy.copy(msg)
+        tagged.cookie = msg.cookie | self.flow_cookie
+        return tagged
+
+    def _untag_flows(self, msg):
+        """
+        Remove the session tag from the flow cookies of a received message
+
+        The raw message still carries the tagged cookies.
+        """
+        ofp = loxi.protocol(msg.version)
+        if isinstance(msg, ofp.message.flow_removed):
+            flows = [msg]
+        elif isinstance(msg, ofp.message.flow_stats_reply):
+            flows = msg.entries
+        else:
+            return
+        for flow in flows:
+            if flow.cookie & FLOW_COOKIE_MASK == self.flow_cookie:
+                flow.cookie &= ~FLOW_COOKIE_MASK
 
+    def _transmit(self, outpkt, flush=False):
+        """
+        Queue a packed message for writing, coalescing unless flush is set
+        """
+        wake = False
         with self.tx_lock:
-            if self.switch_socket.sendall(outpkt) is not None:
-                raise AssertionError("failed to send message to switch")
+            self.tx_pending.append(outpkt)
+            self.tx_pending_bytes += len(outpkt)
+            if flush or self.tx_coalesce <= 0 or not self.is_alive() or \
+                    self.tx_pending_bytes >= TX_BATCH_BYTES:
+                self._flush()
+            elif self.tx_deadline is None:
+                self.tx_deadline = time.time() + self.tx_coalesce
+                wake = True
+
+        if wake:
+            # Let the event loop recompute its select timeout
+            self.wakeup()
+
+    def flush(self):
+        """
+        Write any messages held back by message_send
+        """
+        with self.tx_lock:
+            self._flush()
 
-        return 0 # for backwards compatibility
+    def _flush(self):
+        """
+        Write the pending messages to the switch; tx_lock must be held
+        """
+        pending = self.tx_pending
+        self.tx_pending = []
+        self.tx_pending_bytes = 0
+        self.tx_deadline = None
+
+        if not pending:
+            return
+        if not self.switch_socket:
+            raise Exception("no socket")
+        if self.pcap_writer:
+            self.pcap_writer.write(''.join(pending), time.time(), True)
+
+        if len(pending) > 1 and hasattr(self.switch_socket, "sendmsg"):
+            # Scatter/gather write, then fall back for any remainder
+            sent = self.switch_socket.sendmsg(pending)
+            remaining = ''.join(pending)[sent:]
+        else:
+            remaining = ''.join(pending)
+        if remaining and self.switch_socket.sendall(remaining) is not None:
+            raise AssertionError("failed to send message to switch")
+
+    def _latency_sensitive(self, msg):
+        """
+        Return True if msg must not be held back for coalescing
+        """
+        try:
+            ofp = loxi.protocol(msg.version)
+        except ValueError:
+            return True
+        return msg.type in (ofp.OFPT_HELLO, ofp.OFPT_ECHO_REQUEST,
+                            ofp.OFPT_ECHO_REPLY, ofp.OFPT_BARRIER_REQUEST)
 
     def clear_queue(self):
         """
         Clear the input queue and report the number of messages
         that were in it
         """
-        enqueued_pkt_count = len(self.packets)
         with self.packets_cv:
-            self.packets = []
+            enqueued_pkt_count = self.queued_count()
+            self._clear_queues()
         return enqueued_pkt_count
 
+    def _clear_queues(self):
+        """
+        Drop all queued messages; packets_cv must be held
+        """
+        self.queues = {}
+        self.pkt_in_live = {}
+        self.pkt_in_index = {}
+        self.pkt_in_indexed = 0
+
+    def reset(self):
+        """
+        Return to the state of a newly connected controller
+
+        Used to keep one connection across tests.  Handlers, subscriptions,
+        keep_alive, packet in filtering, queue limits, the ingress policy
+        and message coalescing are set back to their defaults, outstanding
+        transactions are cancelled, queued messages are discarded and the
+        metrics restart.  The connection and the switch state are left
+        alone.
+        """
+        try:
+            self.flush()
+        except:
+            self.logger.info("Ignoring error writing pending messages")
+
+        self.keep_alive = False
+        self.handlers = {}
+        self.tx_monitors = []
+        self.tx_coalesce = self.tx_coalesce_default
+        self.ingress = ingress.IngressPolicy()
+        self.filter_packet_in = False
+        self.pkt_in_filter_limit = 50
+        with self.counter_lock:
+            self.pkt_in_bucket = None
+            self.pkt_in_run = 0
+            self.pkt_in_dropped = 0
+        self.packet_in_count = 0
+
+        with self.xid_lock:
+            futures = self.transactions.values()
+            self.transactions = {}
+        for future in futures:
+            future.cancel()
+
+        with self.packets_cv:
+            subscriptions = sum(self.subscriptions.values(), [])
+        for subscription in subscriptions:
+            subscription.close()
+
+        with self.packets_cv:
+            self._clear_queues()
+            self.queue_limits = {}
+            self.expired_by_type = {}
+            self.packets_expired = 0
+        self.metrics.reset()
+
+    def queued_count(self):
+        """
+        Return the number of messages waiting in all queues
+        """
+        return sum([len(queue) for (hdr_type, queue) in self.queues.items()
+                    if hdr_type != ingress.OFPT_PACKET_IN]) + \
+            len(self.pkt_in_live)
+
+    @property
+    def packets(self):
+        """
+        Snapshot of the queued (msg, pkt) pairs in arrival order
+        """
+        with self.packets_cv:
+            entries = []
+            for (hdr_type, queue) in self.queues.items():
+                if hdr_type == ingress.OFPT_PACKET_IN:
+                    entries.extend([entry for entry in queue
+                                    if entry[0] in self.pkt_in_live])
+                else:
+                    entries.extend(queue)
+        entries.sort()
+        return [(msg, pkt) for (_, msg, pkt) in entries]
+
     def __str__(self):
         string = "Controller:\n"
         string += "  state           " + self.dbg_state + "\n"
         string += "  switch_addr     " + str(self.switch_addr) + "\n"
-        string += "  pending pkts    " + str(len(self.packets)) + "\n"
+        string += "  pending pkts    " + str(self.queued_count()) + "\n"
         string += "  total pkts      " + str(self.packets_total) + "\n"
         string += "  expired pkts    " + str(self.packets_expired) + "\n"
         string += "  handled pkts    " + str(self.packets_handled) + "\n"
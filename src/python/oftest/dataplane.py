@@ -10,6 +10,10 @@ See the class dataplaneport for more details.  This class wraps
 a set of those objects allowing general calls and parsing
 configuration.
 
+Tests can wait for a packet either by polling or by registering an
+expectation, a future which the background thread completes when the
+packet arrives.
+
 @todo Add "filters" for matching packets.  Actions supported
 for filters should include a callback or a counter
 """
@@ -45,6 +49,38 @@ def match_exp_pkt(exp_pkt, pkt):
         p = p[:len(e)]
     return e == p
 
+class Expectation(ofutils.Future):
+    """
+    Future for the arrival of a packet on the dataplane
+
+    Created by DataPlane.expect.  The result is the triple
+    (port_number, packet, pkt_time) as returned by DataPlane.poll.
+    Waiting for the result and timing out cancels the expectation, so a
+    late packet stays in the queue.
+    """
+
+    def __init__(self, dataplane, exp_pkt, port_number):
+        ofutils.Future.__init__(self)
+        self.dataplane = dataplane
+        self.exp_pkt = exp_pkt
+        self.port_number = port_number
+
+    def matches(self, port_number, pkt):
+        return (self.port_number is None or self.port_number == port_number) \
+            and match_exp_pkt(self.exp_pkt, pkt)
+
+    def result(self, timeout=-1):
+        value = ofutils.Future.result(self, timeout)
+        if value is None:
+            self.cancel()
+            value = self.value
+        return value
+
+    def cancel(self):
+        with self.dataplane.cvar:
+            if self in self.dataplane.expectations:
+                self.dataplane.expectations.remove(self)
+        ofutils.Future.cancel(self)
 
 class DataPlanePortLinux:
     """
@@ -158,6 +194,9 @@ class DataPlane(Thread):
         # as a condition variable
         self.cvar = Condition()
 
+        # Pending Expectations, protected by cvar
+        self.expectations = []
+
         # Used to wake up the event loop from another thread
         self.waker = ofutils.EventDescriptor()
         self.killed = False
@@ -215,6 +254,8 @@ class DataPlane(Thread):
                                           len(pkt), port_number)
                         if self.pcap_writer:
                             self.pcap_writer.write(pkt, timestamp, port_number)
+                        if self._fulfil(port_number, pkt, timestamp):
+                            continue
                         queue = self.packet_queues[port_number]
                         if len(queue) >= self.MAX_QUEUE_LEN:
                             # Queue full, throw away oldest
@@ -330,6 +371,45 @@ class DataPlane(Thread):
             self.logger.debug("Poll time out, no packet from " + str(port_number))
             return (None, None, None)
 
+    def expect(self, exp_pkt, port_number=None):
+        """
+        Register interest in a packet without blocking
+
+        A matching packet already queued completes the expectation at once.
+        Otherwise the background thread completes it when the packet
+        arrives, and the packet is not queued for poll.  Other packets are
+        left alone, so any number of expectations can be outstanding.
+
+        @param exp_pkt The expected packet
+        @param port_number If set, only match packets from this port
+        @returns An Expectation whose result is (port_number, packet,
+        pkt_time), or None if it timed out or was cancelled
+        """
+        expectation = Expectation(self, str(exp_pkt), port_number)
+        with self.cvar:
+            for (rcv_port_number, queue) in self.packet_queues.items():
+                for i, (pkt, timestamp) in enumerate(queue):
+                    if expectation.matches(rcv_port_number, pkt):
+                        del queue[i]
+                        expectation.set_result((rcv_port_number, pkt, timestamp))
+                        return expectation
+            self.expectations.append(expectation)
+        return expectation
+
+    def _fulfil(self, port_number, pkt, timestamp):
+        """
+        Complete the oldest expectation matching a received packet
+
+        Must be called with cvar held.
+        @returns True if the packet was taken by an expectation
+        """
+        for expectation in self.expectations:
+            if expectation.matches(port_number, pkt):
+                self.expectations.remove(expectation)
+                expectation.set_result((port_number, pkt, timestamp))
+                return True
+        return False
+
     def kill(self):
         """
         Stop the dataplane thread.
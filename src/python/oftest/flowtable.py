@@ -0,0 +1,613 @@
+"""
+Controller side model of the switch's flow tables
+
+ShadowFlowTable follows the flow_mods sent through a controller and keeps
+the flows the switch should contain.  It can predict which flow, and
+which output ports, a packet should hit, and compare itself with a flow
+stats dump:
+
+    shadow = ShadowFlowTable(self.controller)
+    for flow_mod in flow_mods:
+        self.controller.message_send(flow_mod)
+    do_barrier(self.controller)
+    ports = shadow.predict(packet_to_flow_match(self, pkt), in_port)
+    verify_flow_table(self, shadow)
+
+Matches are kept as a map from field name to (value, mask), so OpenFlow
+1.0 wildcards, OpenFlow 1.1 masks and OXM masks are handled alike.  Each
+table is a tuple space classifier: flows with the same set of field masks
+share a subtable hashed on the masked values, so a lookup costs one hash
+probe per distinct mask set rather than one comparison per flow.
+
+The model assumes every flow_mod succeeds.  Flows removed by timeouts
+stay in the model until flow_removed is called for them.
+"""
+
+import time
+from threading import Lock
+
+import loxi
+import ofp as cfg_ofp
+from flowtrack import OF10_WILDCARD_FIELDS
+
+# Mask used for exactly matched fields; wider than any field
+FULL_MASK = (1 << 128) - 1
+
+# OpenFlow 1.1 wildcard flag -> match field it wildcards
+OF11_WILDCARD_FIELDS = [
+    ("OFPFW_IN_PORT", "in_port"),
+    ("OFPFW_DL_VLAN", "vlan_vid"),
+    ("OFPFW_DL_VLAN_PCP", "vlan_pcp"),
+    ("OFPFW_DL_TYPE", "eth_type"),
+    ("OFPFW_NW_TOS", "ip_dscp"),
+    ("OFPFW_NW_PROTO", "ip_proto"),
+    ("OFPFW_TP_SRC", "tcp_src"),
+    ("OFPFW_TP_DST", "tcp_dst"),
+    ("OFPFW_MPLS_LABEL", "mpls_label"),
+    ("OFPFW_MPLS_TC", "mpls_tc"),
+]
+
+# OpenFlow 1.1 masked match fields; a mask bit of 1 means don't care
+OF11_MASKED_FIELDS = ["eth_src", "eth_dst", "ipv4_src", "ipv4_dst", "metadata"]
+
+def field_int(value):
+    """
+    Convert a match field value (int, MAC address list or byte string) to
+    an int
+    """
+    if isinstance(value, (int, long)):
+        return value
+    if isinstance(value, str):
+        value = [ord(c) for c in value]
+    result = 0
+    for byte in value:
+        result = (result << 8) | byte
+    return result
+
+def match_fields(match, version):
+    """
+    Return the fields of a match as a map from name to (value, mask)
+
+    Fields the match does not constrain are left out.  Values are masked.
+    """
+    ofp = loxi.protocol(version)
+    fields = {}
+    if version == 1:
+        wildcards = match.wildcards
+        for (flag, field) in OF10_WILDCARD_FIELDS:
+            if not wildcards & getattr(ofp, flag):
+                fields[field] = (field_int(getattr(match, field)), FULL_MASK)
+        for (field, shift, mask) in \
+                (("ipv4_src", ofp.OFPFW_NW_SRC_SHIFT, ofp.OFPFW_NW_SRC_MASK),
+                 ("ipv4_dst", ofp.OFPFW_NW_DST_SHIFT, ofp.OFPFW_NW_DST_MASK)):
+            bits = (wildcards & mask) >> shift
+            if bits < 32:
+                field_mask = (0xffffffff << bits) & 0xffffffff
+                fields[field] = (getattr(match, field) & field_mask, field_mask)
+    elif version == 2:
+        for (flag, field) in OF11_WILDCARD_FIELDS:
+            if not match.wildcards & getattr(ofp, flag):
+                fields[field] = (field_int(getattr(match, field)), FULL_MASK)
+        for field in OF11_MASKED_FIELDS:
+            value = field_int(getattr(match, field))
+            ignore = field_int(getattr(match, field + "_mask"))
+            width = field == "metadata" and 64 or \
+                (field.startswith("eth") and 48 or 32)
+            field_mask = ~ignore & ((1 << width) - 1)
+            if field_mask:
+                fields[field] = (value & field_mask, field_mask)
+    else:
+        for oxm in match.oxm_list:
+            name = type(oxm).__name__
+            if name.endswith("_masked"):
+                field_mask = field_int(oxm.value_mask)
+                fields[name[:-len("_masked")]] = \
+                    (field_int(oxm.value) & field_mask, field_mask)
+            else:
+                fields[name] = (field_int(oxm.value), FULL_MASK)
+    return fields
+
+def match_key(fields):
+    """
+    Return (masks, values) for a map from field name to (value, mask)
+
+    masks is the sorted tuple of (field, mask) pairs, which identifies
+    the subtable, and values the tuple of masked values in that order.
+    """
+    masks = tuple(sorted([(field, mask) for (field, (value, mask))
+                          in fields.items()]))
+    values = tuple([fields[field][0] for (field, mask) in masks])
+    return (masks, values)
+
+def packet_fields(packet, version):
+    """
+    Return the field values of a packet as a map from name to int
+
+    @param packet A map from field name to value, or a match (such as
+    one made by testutils.packet_to_flow_match) whose fields are taken
+    as the packet's
+    """
+    if isinstance(packet, dict):
+        return dict([(field, field_int(value))
+                     for (field, value) in packet.items()])
+    return dict([(field, value) for (field, (value, mask))
+                 in match_fields(packet, version).items()])
+
+class FlowEntry(object):
+    """
+    A flow in the model
+
+    @var table_id Table the flow is in
+    @var priority Priority from the flow_mod
+    @var fields Map from field name to (value, mask)
+    @var cookie Cookie from the flow_add
+    @var actions Actions (OpenFlow 1.0) or instructions of the flow
+    @var flow_mod The flow_mod that installed the flow
+    @var install_time When the flow was installed
+    @var rank Priority used for lookups
+    """
+
+    def __init__(self, table_id, flow_mod, fields):
+        self.table_id = table_id
+        self.priority = flow_mod.priority
+        self.fields = fields
+        self.cookie = flow_mod.cookie
+        self.actions = flow_mod_actions(flow_mod)
+        self.flow_mod = flow_mod
+        self.install_time = time.time()
+        (self.masks, self.values) = match_key(fields)
+        # OpenFlow 1.0 exact match flows beat all wildcarded ones
+        self.rank = self.priority
+        if flow_mod.version == 1 and \
+                flow_mod.match.wildcards & loxi.of10.OFPFW_ALL == 0:
+            self.rank += 1 << 16
+
+    def key(self):
+        return (self.table_id, self.priority, self.masks, self.values)
+
+    def __repr__(self):
+        fields = []
+        for (field, (value, mask)) in sorted(self.fields.items()):
+            if mask == FULL_MASK:
+                fields.append("%s=%#x" % (field, value))
+            else:
+                fields.append("%s=%#x/%#x" % (field, value, mask))
+        return "FlowEntry(table %d, priority %d, %s)" % \
+            (self.table_id, self.priority, ", ".join(fields))
+
+def flow_mod_actions(msg):
+    """
+    Return the actions (OpenFlow 1.0) or instructions of a flow_mod or flow
+    stats entry
+    """
+    if hasattr(msg, "actions"):
+        return list(msg.actions)
+    return list(msg.instructions)
+
+class Subtable(object):
+    """
+    Flows of one table that constrain the same fields with the same masks
+
+    @var buckets Map from the tuple of masked values to the flows with
+    those values, highest rank first
+    @var ranks Map from rank to number of flows with it
+    """
+
+    def __init__(self, masks):
+        self.masks = masks
+        self.buckets = {}
+        self.ranks = {}
+        self.count = 0
+        self.max_rank = None
+
+    def add(self, entry):
+        bucket = self.buckets.setdefault(entry.values, [])
+        i = 0
+        while i < len(bucket) and bucket[i].rank >= entry.rank:
+            i += 1
+        bucket.insert(i, entry)
+        self.ranks[entry.rank] = self.ranks.get(entry.rank, 0) + 1
+        self.count += 1
+        if self.max_rank is None or entry.rank > self.max_rank:
+            self.max_rank = entry.rank
+            return True
+        return False
+
+    def remove(self, entry):
+        bucket = self.buckets[entry.values]
+        bucket.remove(entry)
+        if not bucket:
+            del self.buckets[entry.values]
+        self.ranks[entry.rank] -= 1
+        if not self.ranks[entry.rank]:
+            del self.ranks[entry.rank]
+        self.count -= 1
+        if entry.rank == self.max_rank and entry.rank not in self.ranks:
+            self.max_rank = max(self.ranks) if self.ranks else None
+            return True
+        return False
+
+    def lookup(self, packet):
+        """
+        Return the highest ranked flow matching a packet, or None
+        """
+        try:
+            values = tuple([packet[field] & mask for (field, mask) in self.masks])
+        except KeyError:
+            return None # The packet lacks a field this subtable needs
+        bucket = self.buckets.get(values)
+        return bucket and bucket[0] or None
+
+class FlowTable(object):
+    """
+    Tuple space classifier for one flow table
+    """
+
+    def __init__(self, table_id):
+        self.table_id = table_id
+        self.subtables = {}
+        self.order = None # Subtables by decreasing max_rank, or None
+        self.count = 0
+
+    def add(self, entry):
+        subtable = self.subtables.get(entry.masks)
+        if subtable is None:
+            subtable = self.subtables[entry.masks] = Subtable(entry.masks)
+        if subtable.add(entry):
+            self.order = None
+        self.count += 1
+
+    def remove(self, entry):
+        subtable = self.subtables[entry.masks]
+        if subtable.remove(entry):
+            self.order = None
+        if not subtable.count:
+            del self.subtables[entry.masks]
+            self.order = None
+        self.count -= 1
+
+    def find(self, priority, masks, values):
+        """
+        Return the flow with exactly this priority and match, or None
+        """
+        subtable = self.subtables.get(masks)
+        if subtable:
+            for entry in subtable.buckets.get(values, []):
+                if entry.priority == priority:
+                    return entry
+        return None
+
+    def covered(self, fields):
+        """
+        Yield the flows whose match is at least as specific as fields, as
+        selected by a non-strict modify or delete
+        """
+        for subtable in self.subtables.values():
+            masks = dict(subtable.masks)
+            positions = []
+            for (field, (value, mask)) in fields.items():
+                if masks.get(field, 0) & mask != mask:
+                    break
+                positions.append(([f for (f, m) in subtable.masks].index(field),
+                                  value, mask))
+            else:
+                for (values, bucket) in subtable.buckets.items():
+                    for (i, value, mask) in positions:
+                        if values[i] & mask != value:
+                            break
+                    else:
+                        for entry in bucket:
+                            yield entry
+
+    def overlaps(self, entry):
+        """
+        Return True if a flow of the same priority matches a packet that
+        entry also matches
+        """
+        for subtable in self.subtables.values():
+            for bucket in subtable.buckets.values():
+                for other in bucket:
+                    if other.priority != entry.priority:
+                        continue
+                    for (field, (value, mask)) in entry.fields.items():
+                        if field in other.fields:
+                            (other_value, other_mask) = other.fields[field]
+                            if (value ^ other_value) & mask & other_mask:
+                                break
+                    else:
+                        return True
+        return False
+
+    def lookup(self, packet):
+        """
+        Return the flow a packet hits, or None on a table miss
+
+        @param packet Map from field name to int value
+        """
+        if self.order is None:
+            self.order = sorted(self.subtables.values(),
+                                key=lambda subtable: subtable.max_rank,
+                                reverse=True)
+        best = None
+        for subtable in self.order:
+            if best and subtable.max_rank <= best.rank:
+                break
+            entry = subtable.lookup(packet)
+            if entry and (best is None or entry.rank > best.rank):
+                best = entry
+        return best
+
+    def __iter__(self):
+        for subtable in self.subtables.values():
+            for bucket in subtable.buckets.values():
+                for entry in bucket:
+                    yield entry
+
+class FlowTableDiff(object):
+    """
+    Differences between the model and a flow stats dump
+
+    @var missing FlowEntries not in the dump
+    @var unexpected Flow stats entries not in the model
+    @var changed List of (FlowEntry, flow stats entry) pairs with the same
+    match and priority but a different cookie or actions
+    """
+
+    def __init__(self):
+        self.missing = []
+        self.unexpected = []
+        self.changed = []
+
+    def __nonzero__(self):
+        return bool(self.missing or self.unexpected or self.changed)
+
+    def __str__(self):
+        s = "%d missing, %d unexpected, %d changed" % \
+            (len(self.missing), len(self.unexpected), len(self.changed))
+        for entry in self.missing[:5]:
+            s += "\n  missing: %r" % entry
+        for stats in self.unexpected[:5]:
+            s += "\n  unexpected: %s" % stats.show()
+        for (entry, stats) in self.changed[:5]:
+            s += "\n  changed: %r\n    switch: %s" % (entry, stats.show())
+        return s
+
+class ShadowFlowTable(object):
+    """
+    Model of the switch's flow tables built from the flow_mods sent
+
+    @var tables Map from table id to FlowTable
+    """
+
+    def __init__(self, controller=None, version=None):
+        """
+        @param controller If not None, follow every flow_mod sent through
+        this controller until close is called
+        @param version OpenFlow version; by default the configured one
+        """
+        self.controller = controller
+        self.version = version or cfg_ofp.OFP_VERSION
+        self.ofp = loxi.protocol(self.version)
+        self.lock = Lock()
+        self.tables = {}
+        if controller:
+            controller.add_tx_monitor(self._tx_monitor)
+
+    def close(self):
+        """
+        Stop following the controller's flow_mods
+        """
+        if self.controller:
+            self.controller.remove_tx_monitor(self._tx_monitor)
+
+    def _tx_monitor(self, msg):
+        if isinstance(msg, self.ofp.message.flow_mod):
+            self.flow_mod(msg)
+
+    def __len__(self):
+        return sum([table.count for table in self.tables.values()])
+
+    def __iter__(self):
+        with self.lock:
+            entries = [entry for table in self.tables.values() for entry in table]
+        return iter(entries)
+
+    def _table(self, table_id):
+        table = self.tables.get(table_id)
+        if table is None:
+            table = self.tables[table_id] = FlowTable(table_id)
+        return table
+
+    def _table_ids(self, msg):
+        if self.version == 1:
+            return [0]
+        if msg.table_id == self.ofp.OFPTT_ALL:
+            return self.tables.keys()
+        return [msg.table_id]
+
+    def flow_mod(self, msg):
+        """
+        Apply a flow_mod to the model
+        """
+        ofp = self.ofp
+        fields = match_fields(msg.match, self.version)
+        command = msg._command
+        with self.lock:
+            if command == ofp.OFPFC_ADD:
+                self._add(msg, fields)
+                return
+
+            strict = command in (ofp.OFPFC_MODIFY_STRICT,
+                                 ofp.OFPFC_DELETE_STRICT)
+            (masks, values) = match_key(fields)
+            selected = []
+            for table_id in self._table_ids(msg):
+                table = self.tables.get(table_id)
+                if table is None:
+                    continue
+                if strict:
+                    entry = table.find(msg.priority, masks, values)
+                    candidates = entry and [entry] or []
+                else:
+                    candidates = table.covered(fields)
+                for entry in candidates:
+                    if self._cookie_match(entry, msg):
+                        selected.append(entry)
+
+            if command in (ofp.OFPFC_MODIFY, ofp.OFPFC_MODIFY_STRICT):
+                for entry in selected:
+                    entry.actions = flow_mod_actions(msg)
+                if not selected and self.version <= 3:
+                    # Before OpenFlow 1.3 a modify that matches nothing adds
+                    self._add(msg, fields)
+            elif command in (ofp.OFPFC_DELETE, ofp.OFPFC_DELETE_STRICT):
+                for entry in selected:
+                    if self._out_match(entry, msg):
+                        self.tables[entry.table_id].remove(entry)
+
+    def _add(self, msg, fields):
+        table_id = self.version > 1 and msg.table_id or 0
+        entry = FlowEntry(table_id, msg, fields)
+        table = self._table(table_id)
+        existing = table.find(entry.priority, entry.masks, entry.values)
+        if existing:
+            table.remove(existing)
+        elif msg.flags & self.ofp.OFPFF_CHECK_OVERLAP and table.overlaps(entry):
+            return # The switch rejects the flow
+        table.add(entry)
+
+    def _cookie_match(self, entry, msg):
+        if self.version == 1:
+            return True
+        return entry.cookie & msg.cookie_mask == msg.cookie & msg.cookie_mask
+
+    def _out_match(self, entry, msg):
+        """
+        Check the out_port and out_group restrictions of a delete
+        """
+        ofp = self.ofp
+        if self.version == 1:
+            any_port = ofp.OFPP_NONE
+        else:
+            any_port = ofp.OFPP_ANY
+        if msg.out_port != any_port and \
+                msg.out_port not in [action.port for action in self._actions(entry)
+                                     if isinstance(action, ofp.action.output)]:
+            return False
+        if self.version > 1 and msg.out_group != ofp.OFPG_ANY and \
+                msg.out_group not in [action.group_id for action in self._actions(entry)
+                                      if isinstance(action, ofp.action.group)]:
+            return False
+        return True
+
+    def _actions(self, entry):
+        """
+        Return all actions of a flow, from any instruction
+        """
+        if self.version == 1:
+            return entry.actions
+        actions = []
+        for instruction in entry.actions:
+            actions.extend(getattr(instruction, "actions", []))
+        return actions
+
+    def flow_removed(self, msg):
+        """
+        Remove the flow a flow_removed message reports
+
+        @returns True if the flow was in the model
+        """
+        table_id = self.version > 1 and msg.table_id or 0
+        (masks, values) = match_key(match_fields(msg.match, self.version))
+        with self.lock:
+            table = self.tables.get(table_id)
+            entry = table and table.find(msg.priority, masks, values)
+            if entry:
+                table.remove(entry)
+            return entry is not None
+
+    def lookup(self, packet, table_id=0):
+        """
+        Return the FlowEntry a packet hits in a table, or None on a miss
+
+        @param packet Map from field name to value, or a match; see
+        packet_fields
+        """
+        fields = packet_fields(packet, self.version)
+        with self.lock:
+            table = self.tables.get(table_id)
+            return table and table.lookup(fields)
+
+    def predict(self, packet, in_port=None):
+        """
+        Return the output ports a packet should be sent to
+
+        Follows goto_table instructions and applies the action set at the
+        end of the pipeline.  Group actions and changes made by set field
+        actions are not modelled.
+
+        @param packet Map from field name to value, or a match; see
+        packet_fields
+        @param in_port If not None, the packet's in_port
+        @returns List of output port numbers, empty if the packet is
+        dropped, or None on a table miss
+        """
+        ofp = self.ofp
+        fields = packet_fields(packet, self.version)
+        if in_port is not None:
+            fields["in_port"] = in_port
+
+        with self.lock:
+            if self.version == 1:
+                entry = self.tables.get(0) and self.tables[0].lookup(fields)
+                if entry is None:
+                    return None
+                return [action.port for action in entry.actions
+                        if isinstance(action, ofp.action.output)]
+
+            ports = []
+            action_set = []
+            table_id = 0
+            while table_id is not None:
+                table = self.tables.get(table_id)
+                entry = table and table.lookup(fields)
+                if entry is None:
+                    return None
+                table_id = None
+                for instruction in entry.actions:
+                    if isinstance(instruction, ofp.instruction.apply_actions):
+                        ports.extend([action.port for action in instruction.actions
+                                      if isinstance(action, ofp.action.output)])
+                    elif isinstance(instruction, ofp.instruction.clear_actions):
+                        action_set = []
+                    elif isinstance(instruction, ofp.instruction.write_actions):
+                        action_set.extend(instruction.actions)
+                    elif isinstance(instruction, ofp.instruction.goto_table):
+                        table_id = instruction.table_id
+            # The action set holds at most one output action
+            outputs = [action.port for action in action_set
+                       if isinstance(action, ofp.action.output)]
+            return ports + outputs[-1:]
+
+    def diff(self, stats_entries):
+        """
+        Compare the model with the switch's flows
+
+        @param stats_entries Iterable of flow stats entries for all tables,
+        such as testutils.iter_flow_stats returns
+        @returns A FlowTableDiff, which is false if there is no difference
+        """
+        result = FlowTableDiff()
+        remaining = dict([(entry.key(), entry) for entry in self])
+        for stats in stats_entries:
+            table_id = self.version > 1 and stats.table_id or 0
+            (masks, values) = match_key(match_fields(stats.match, self.version))
+            entry = remaining.pop((table_id, stats.priority, masks, values), None)
+            if entry is None:
+                result.unexpected.append(stats)
+            elif entry.cookie != stats.cookie or \
+                    entry.actions != flow_mod_actions(stats):
+                result.changed.append((entry, stats))
+        result.missing = sorted(remaining.values(),
+                                key=lambda entry: entry.install_time)
+        return result
@@ -0,0 +1,242 @@
+"""
+Correlation of flow_removed messages with installed flows
+
+FlowRemovedTracker records every flow_add sent with OFPFF_SEND_FLOW_REM,
+indexed by cookie and by (cookie, priority, canonical match), and matches
+each arriving flow_removed against that index in constant time.  It
+measures how late each flow expired relative to its requested timeout and
+reports missing and unexpected removals in bulk:
+
+    tracker = FlowRemovedTracker(self.controller)
+    for flow_mod in flow_mods:
+        self.controller.message_send(flow_mod)
+    tracker.wait(timeout=30)
+    report = tracker.report()
+    self.assertEqual(report.missing, [])
+    tracker.close()
+"""
+
+import time
+import logging
+from collections import OrderedDict
+from threading import Condition
+
+import loxi
+import ofutils
+import ofp as cfg_ofp
+
+# OpenFlow 1.0 wildcard flag -> match field it wildcards
+OF10_WILDCARD_FIELDS = [
+    ("OFPFW_IN_PORT", "in_port"),
+    ("OFPFW_DL_VLAN", "vlan_vid"),
+    ("OFPFW_DL_SRC", "eth_src"),
+    ("OFPFW_DL_DST", "eth_dst"),
+    ("OFPFW_DL_TYPE", "eth_type"),
+    ("OFPFW_NW_PROTO", "ip_proto"),
+    ("OFPFW_TP_SRC", "tcp_src"),
+    ("OFPFW_TP_DST", "tcp_dst"),
+    ("OFPFW_DL_VLAN_PCP", "vlan_pcp"),
+    ("OFPFW_NW_TOS", "ip_dscp"),
+]
+
+def canonical_match(match, version):
+    """
+    Return a string that is equal for matches the switch treats as equal
+
+    For OpenFlow 1.0 the fields covered by wildcards are zeroed and the
+    IP prefix lengths are clamped.  For OXM matches the fields are sorted,
+    since the switch need not return them in the order they were sent.
+    """
+    ofp = loxi.protocol(version)
+    if version == 1:
+        wildcards = match.wildcards & ofp.OFPFW_ALL
+        fields = {}
+        for (flag, field) in OF10_WILDCARD_FIELDS:
+            if not wildcards & getattr(ofp, flag):
+                fields[field] = getattr(match, field)
+        for (field, shift, mask) in \
+                (("ipv4_src", ofp.OFPFW_NW_SRC_SHIFT, ofp.OFPFW_NW_SRC_MASK),
+                 ("ipv4_dst", ofp.OFPFW_NW_DST_SHIFT, ofp.OFPFW_NW_DST_MASK)):
+            bits = min((wildcards & mask) >> shift, 32)
+            wildcards = (wildcards & ~mask) | (bits << shift)
+            if bits < 32:
+                fields[field] = getattr(match, field) & \
+                    ~((1 << bits) - 1) & 0xffffffff
+        canonical = ofp.match(wildcards=wildcards, **fields)
+        return canonical.pack()
+    elif version == 2:
+        return match.pack()
+    else:
+        return ''.join(sorted([oxm.pack() for oxm in match.oxm_list]))
+
+class FlowRecord(object):
+    """
+    An installed flow and its removal
+
+    @var flow_mod The flow_add message
+    @var install_time When the flow_add was sent
+    @var removed The flow_removed message, or None if not yet received
+    @var removed_time When the flow_removed was received
+    @var expiry_error Seconds between the requested timeout and the
+    arrival of the flow_removed, positive if late; None unless the flow
+    was removed by an idle or hard timeout
+    """
+
+    def __init__(self, flow_mod, install_time, key):
+        self.flow_mod = flow_mod
+        self.key = key
+        self.install_time = install_time
+        self.removed = None
+        self.removed_time = None
+        self.expiry_error = None
+
+class FlowExpiryReport(object):
+    """
+    Outcome of tracking flow removals
+
+    @var matched List of FlowRecords that were removed
+    @var missing List of FlowRecords that were not removed
+    @var unexpected List of flow_removed messages not matching a tracked
+    flow
+    @var errors Map from removal reason to a list of expiry errors
+    """
+
+    def __init__(self, matched, missing, unexpected):
+        self.matched = matched
+        self.missing = missing
+        self.unexpected = unexpected
+        self.errors = {}
+        for record in matched:
+            if record.expiry_error is not None:
+                self.errors.setdefault(record.removed.reason, []).append(
+                    record.expiry_error)
+
+    def __str__(self):
+        s = "%d removed, %d missing, %d unexpected" % \
+            (len(self.matched), len(self.missing), len(self.unexpected))
+        for (reason, errors) in sorted(self.errors.items()):
+            s += "; reason %d expiry error min %.3fs mean %.3fs max %.3fs" % \
+                (reason, min(errors), sum(errors) / len(errors), max(errors))
+        return s
+
+class FlowRemovedTracker(object):
+    """
+    Match flow_removed messages to the flows that were installed
+
+    Watches the flow_adds sent through the controller and handles
+    OFPT_FLOW_REMOVED, so flow_removed messages no longer reach the poll
+    queue while the tracker is open.
+
+    A flow_removed is matched by cookie, priority and canonical match.  If
+    that fails but exactly one outstanding flow has its cookie, that flow
+    is taken, so a switch that rewrites the match still correlates.
+    """
+
+    def __init__(self, controller):
+        self.controller = controller
+        self.logger = logging.getLogger("flowtrack")
+        self.cv = Condition()
+        # Outstanding flows, each index mapping to an OrderedDict of
+        # FlowRecords in install order (values unused)
+        self.by_key = {} # (cookie, priority, canonical match)
+        self.by_cookie = {} # cookie
+        self.outstanding = 0
+        self.matched = []
+        self.unexpected = []
+        controller.add_tx_monitor(self._tx_monitor)
+        controller.register(cfg_ofp.OFPT_FLOW_REMOVED, self._handler)
+
+    def track(self, flow_mod, install_time=None):
+        """
+        Expect a flow_removed for a flow
+
+        Flow adds sent through the controller are tracked automatically;
+        this is only needed for flows installed some other way.
+        """
+        record = FlowRecord(flow_mod, install_time or time.time(),
+                            self._key(flow_mod))
+        with self.cv:
+            self.by_key.setdefault(record.key, OrderedDict())[record] = None
+            self.by_cookie.setdefault(flow_mod.cookie, OrderedDict())[record] = None
+            self.outstanding += 1
+        return record
+
+    def _key(self, msg):
+        return (msg.cookie, msg.priority, canonical_match(msg.match, msg.version))
+
+    def _tx_monitor(self, msg):
+        ofp = loxi.protocol(msg.version)
+        if isinstance(msg, ofp.message.flow_add) and \
+                msg.flags & ofp.OFPFF_SEND_FLOW_REM:
+            self.track(msg)
+
+    def _handler(self, controller, msg, rawmsg):
+        now = time.time()
+        with self.cv:
+            record = None
+            records = self.by_key.get(self._key(msg))
+            if records:
+                record = next(iter(records))
+            elif len(self.by_cookie.get(msg.cookie, ())) == 1:
+                record = next(iter(self.by_cookie[msg.cookie]))
+            if record is None:
+                self.logger.debug("Unexpected flow_removed cookie %d", msg.cookie)
+                self.unexpected.append(msg)
+                return True
+            self._remove(self.by_key, record.key, record)
+            self._remove(self.by_cookie, record.flow_mod.cookie, record)
+
+            record.removed = msg
+            record.removed_time = now
+            timeout = self._timeout(record.flow_mod, msg.reason, msg.version)
+            if timeout:
+                record.expiry_error = now - record.install_time - timeout
+            self.matched.append(record)
+            self.outstanding -= 1
+            self.cv.notify_all()
+        return True
+
+    def _remove(self, index, key, record):
+        records = index[key]
+        del records[record]
+        if not records:
+            del index[key]
+
+    def _timeout(self, flow_mod, reason, version):
+        ofp = loxi.protocol(version)
+        if reason == ofp.OFPRR_IDLE_TIMEOUT:
+            return flow_mod.idle_timeout
+        elif reason == ofp.OFPRR_HARD_TIMEOUT:
+            return flow_mod.hard_timeout
+        return None
+
+    def wait(self, timeout=-1):
+        """
+        Wait until every tracked flow has been removed
+
+        @param timeout Seconds to wait; if -1 use default.
+        @returns True if no tracked flow is outstanding
+        """
+        with self.cv:
+            ofutils.timed_wait(self.cv, lambda: self.outstanding == 0 or None,
+                               timeout=timeout)
+            return self.outstanding == 0
+
+    def report(self):
+        """
+        @returns A FlowExpiryReport of everything seen so far
+        """
+        with self.cv:
+            missing = []
+            for records in self.by_key.values():
+                missing.extend(records)
+            missing.sort(key=lambda record: record.install_time)
+            return FlowExpiryReport(list(self.matched), missing,
+                                    list(self.unexpected))
+
+    def close(self):
+        """
+        Stop tracking; flow_removed messages go to the poll queue again
+        """
+        self.controller.remove_tx_monitor(self._tx_monitor)
+        self.controller.register(cfg_ofp.OFPT_FLOW_REMOVED, None)
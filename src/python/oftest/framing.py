@@ -0,0 +1,112 @@
+"""
+OpenFlow message framing
+
+Split the byte stream read from a control channel socket into OpenFlow
+messages.
+"""
+
+import struct
+
+OFP_HEADER = struct.Struct("!BBHL")
+
+# Message types that are the same in all OpenFlow versions
+OFPT_ECHO_REQUEST = 2
+OFPT_ECHO_REPLY = 3
+
+class FrameBuffer(object):
+    """
+    Growable receive buffer for an OpenFlow byte stream
+
+    Data is received straight into a bytearray with recv_into, and complete
+    messages are handed out as memoryview slices of that bytearray.  The
+    slices are only valid until the buffer is next written to, so callers
+    must copy out anything they keep.
+
+    Consumed bytes are not moved on every read.  The unconsumed tail is
+    only compacted to the front when there is not enough free space left
+    at the end of the buffer, and the buffer only grows when the tail
+    itself does not fit.
+    """
+
+    def __init__(self, size=65536):
+        self.buf = bytearray(size)
+        self.start = 0 # First unconsumed byte
+        self.end = 0 # End of received data
+
+    def __len__(self):
+        """
+        Number of received bytes not yet framed into a message
+        """
+        return self.end - self.start
+
+    def reserve(self, nbytes):
+        """
+        Make room for nbytes at the end of the buffer
+        """
+        if len(self.buf) - self.end >= nbytes:
+            return
+
+        pending = self.end - self.start
+        if pending + nbytes > len(self.buf):
+            newbuf = bytearray(max(len(self.buf) * 2, pending + nbytes))
+            newbuf[:pending] = self.buf[self.start:self.end]
+            self.buf = newbuf
+        else:
+            self.buf[:pending] = self.buf[self.start:self.end]
+        self.start = 0
+        self.end = pending
+
+    def recv_into(self, sock, nbytes):
+        """
+        Receive up to nbytes from sock into the buffer
+
+        @returns The number of bytes received; 0 means the peer closed
+        the connection
+        """
+        self.reserve(nbytes)
+        count = sock.recv_into(memoryview(self.buf)[self.end:], nbytes)
+        self.end += count
+        return count
+
+    def feed(self, data):
+        """
+        Append already received bytes to the buffer
+        """
+        self.reserve(len(data))
+        self.buf[self.end:self.end + len(data)] = data
+        self.end += len(data)
+
+    def tail(self, nbytes):
+        """
+        Copy of the last nbytes received
+        """
+        return str(self.buf[self.end - nbytes:self.end])
+
+    def frames(self):
+        """
+        Yield each complete message in the buffer
+
+        Yields tuples (version, type, length, xid, frame) where frame is a
+        memoryview of the whole message including the header.  Any partial
+        message is left in the buffer for the next read.
+        """
+        view = memoryview(self.buf)
+        while self.end - self.start >= OFP_HEADER.size:
+            (version, msg_type, length, xid) = \
+                OFP_HEADER.unpack_from(self.buf, self.start)
+            if length < OFP_HEADER.size:
+                raise ValueError("invalid OpenFlow message length %d" % length)
+            if self.start + length > self.end:
+                break
+            frame = view[self.start:self.start + length]
+            self.start += length
+            yield (version, msg_type, length, xid, frame)
+
+        if self.start == self.end:
+            self.start = self.end = 0
+
+    def clear(self):
+        """
+        Drop any buffered data
+        """
+        self.start = self.end = 0
@@ -0,0 +1,146 @@
+"""
+Ingress policy for the control channel
+
+Decide whether to keep a received OpenFlow message by looking only at its
+header (and, for packet-ins, the in_port field), so that dropped messages
+are never fully decoded.
+"""
+
+import time
+import struct
+from threading import Lock
+
+OFPT_PACKET_IN = 10 # Same in all OpenFlow versions
+OXM_IN_PORT = 0x80000000 # OFPXMC_OPENFLOW_BASIC class, OFPXMT_OFB_IN_PORT field
+
+class TokenBucket(object):
+    """
+    Allow 'rate' events per second with bursts of up to 'burst' events
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.last = time.time()
+
+    def take(self):
+        """
+        @returns True if an event is allowed now
+        """
+        now = time.time()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+def packet_in_port(frame, version):
+    """
+    Extract the in_port of a raw packet-in without parsing it
+
+    @param frame Buffer holding the complete message
+    @param version OpenFlow wire version of the message
+    @returns The port number, or None if it cannot be found
+    """
+    if version == 1:
+        return struct.unpack_from("!H", frame, 14)[0]
+    elif version == 2:
+        return struct.unpack_from("!L", frame, 12)[0]
+
+    # OXM match; OpenFlow 1.3 added a cookie before it
+    offset = version == 3 and 16 or 24
+    if offset + 4 > len(frame):
+        return None
+    (match_type, match_len) = struct.unpack_from("!HH", frame, offset)
+    end = min(offset + match_len, len(frame))
+    offset += 4
+    while offset + 4 <= end:
+        (oxm_header,) = struct.unpack_from("!L", frame, offset)
+        if oxm_header & 0xfffffe00 == OXM_IN_PORT and offset + 8 <= end:
+            return struct.unpack_from("!L", frame, offset + 4)[0]
+        offset += 4 + (oxm_header & 0xff)
+    return None
+
+class IngressPolicy(object):
+    """
+    Rate limits and sampling for received messages
+
+    Rate limits are token buckets keyed by message type, or for packet-ins
+    optionally by (message type, in_port).  Sampling keeps one in every N
+    messages of a type.  A message must pass both checks to be kept.
+    While any limit or sampling is set, every message checked is counted
+    in 'seen', whether or not it is kept.
+
+    @var seen Map from message type to number of messages checked
+    @var dropped Map from message type to number of messages dropped
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.limits = {}
+        self.buckets = {}
+        self.sampling = {}
+        self.seen = {}
+        self.dropped = {}
+
+    def limit(self, msg_type, rate, burst=None, per_port=False):
+        """
+        Rate limit a message type
+
+        @param msg_type OFPT_* message type
+        @param rate Messages per second to keep, or None to remove the limit
+        @param burst Bucket size; defaults to one second's worth
+        @param per_port If true, give each packet-in in_port its own bucket
+        """
+        with self.lock:
+            self.buckets = dict((key, bucket) for (key, bucket)
+                                in self.buckets.items()
+                                if key[0] != msg_type)
+            if rate is None:
+                self.limits.pop(msg_type, None)
+            else:
+                self.limits[msg_type] = (rate, burst or max(rate, 1), per_port)
+
+    def sample(self, msg_type, n):
+        """
+        Keep only one in every n messages of a type; n <= 1 keeps all
+        """
+        with self.lock:
+            if n > 1:
+                self.sampling[msg_type] = n
+            else:
+                self.sampling.pop(msg_type, None)
+
+    def check(self, frame, version, msg_type):
+        """
+        @param frame Buffer holding the complete raw message
+        @returns True if the message should be dropped
+        """
+        if not self.limits and not self.sampling:
+            return False # No policy; don't take the lock
+
+        with self.lock:
+            seen = self.seen.get(msg_type, 0) + 1
+            self.seen[msg_type] = seen
+
+            drop = False
+            n = self.sampling.get(msg_type)
+            if n and seen % n != 1:
+                drop = True
+
+            limit = self.limits.get(msg_type)
+            if limit and not drop:
+                (rate, burst, per_port) = limit
+                key = (msg_type,)
+                if per_port and msg_type == OFPT_PACKET_IN:
+                    key = (msg_type, packet_in_port(frame, version))
+                bucket = self.buckets.get(key)
+                if bucket is None:
+                    bucket = self.buckets[key] = TokenBucket(rate, burst)
+                drop = not bucket.take()
+
+            if drop:
+                self.dropped[msg_type] = self.dropped.get(msg_type, 0) + 1
+            return drop
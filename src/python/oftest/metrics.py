@@ -0,0 +1,133 @@
+"""
+Control channel metrics
+
+Counters and latency histograms for the messages exchanged between the
+controller and the switch.  Message types are identified by their loxi
+class name, e.g. "barrier_request".
+"""
+
+import json
+import time
+from threading import Lock
+
+class Histogram(object):
+    """
+    Latency histogram with power-of-two buckets in microseconds
+
+    A sample of N microseconds is counted in the smallest bucket whose
+    upper bound is >= N.
+    """
+
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, seconds):
+        bound = 1
+        while bound < seconds * 1e6:
+            bound <<= 1
+        self.buckets[bound] = self.buckets.get(bound, 0) + 1
+        self.count += 1
+        self.total += seconds
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+        if self.max is None or seconds > self.max:
+            self.max = seconds
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "mean_us": self.count and self.total * 1e6 / self.count,
+            "min_us": (self.min or 0) * 1e6,
+            "max_us": (self.max or 0) * 1e6,
+            "buckets_us": dict((str(bound), count)
+                               for (bound, count) in self.buckets.items()),
+        }
+
+class ControlChannelMetrics(object):
+    """
+    Statistics for one controller connection
+
+    @var rx Map from message type to [count, bytes] received
+    @var tx Map from message type to [count, bytes] sent
+    @var rtt Map from request type to a Histogram of transaction times
+    @var queue_high_water Map from message type to the deepest its receive
+    queue has been
+    @var stage_time Map from processing stage ("decode", "handler") to the
+    total seconds spent in it
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.start_time = time.time()
+            self.rx = {}
+            self.tx = {}
+            self.rtt = {}
+            self.queue_high_water = {}
+            self.stage_time = {}
+
+    def record_rx(self, msg_type, length):
+        with self.lock:
+            counts = self.rx.setdefault(msg_type, [0, 0])
+            counts[0] += 1
+            counts[1] += length
+
+    def record_tx(self, msg_type, length):
+        with self.lock:
+            counts = self.tx.setdefault(msg_type, [0, 0])
+            counts[0] += 1
+            counts[1] += length
+
+    def record_rtt(self, msg_type, seconds):
+        with self.lock:
+            if msg_type not in self.rtt:
+                self.rtt[msg_type] = Histogram()
+            self.rtt[msg_type].add(seconds)
+
+    def record_queue_depth(self, msg_type, depth):
+        with self.lock:
+            if depth > self.queue_high_water.get(msg_type, 0):
+                self.queue_high_water[msg_type] = depth
+
+    def record_stage(self, stage, seconds):
+        with self.lock:
+            self.stage_time[stage] = self.stage_time.get(stage, 0.0) + seconds
+
+    def snapshot(self):
+        """
+        Return the current metrics as a dictionary of plain values
+        """
+        with self.lock:
+            elapsed = max(time.time() - self.start_time, 1e-9)
+
+            def rates(counters):
+                return dict((msg_type, {
+                    "count": count,
+                    "bytes": length,
+                    "msgs_per_sec": count / elapsed,
+                    "bytes_per_sec": length / elapsed,
+                }) for (msg_type, (count, length)) in counters.items())
+
+            return {
+                "elapsed": elapsed,
+                "rx": rates(self.rx),
+                "tx": rates(self.tx),
+                "rtt": dict((msg_type, histogram.snapshot())
+                            for (msg_type, histogram) in self.rtt.items()),
+                "queue_high_water": dict(self.queue_high_water),
+                "stage_time": dict(self.stage_time),
+            }
+
+    def dump(self, filename):
+        """
+        Write a snapshot to filename as JSON
+        """
+        with open(filename, "w") as f:
+            json.dump(self.snapshot(), f, indent=2, sort_keys=True)
@@ -8,6 +8,8 @@ import time
 import os
 import fcntl
 import logging
+import Queue
+from threading import Condition, Thread, current_thread
 
 default_timeout = None # set by oft
 default_negative_timeout = None # set by oft
@@ -62,3 +64,108 @@ class EventDescriptor():
 
     def fileno(self):
         return self.pipe_rd
+
+class Future(object):
+    """
+    Result slot filled in by one thread and waited on by another.
+
+    Each future has its own condition variable, so completing one only
+    wakes the threads waiting on that future. A cancelled future is done
+    with a result of None. Cancelling a future that is already done has
+    no effect.
+    """
+
+    def __init__(self):
+        self.cv = Condition()
+        self.value = None
+        self.finished = False
+
+    def set_result(self, value):
+        with self.cv:
+            self.value = value
+            self.finished = True
+            self.cv.notify_all()
+
+    def cancel(self):
+        with self.cv:
+            if not self.finished:
+                self.finished = True
+                self.cv.notify_all()
+
+    def done(self):
+        return self.finished
+
+    def result(self, timeout=-1):
+        """
+        Wait for the result. The timeout value -1 means use the default
+        timeout. Returns None on timeout.
+        """
+        with self.cv:
+            timed_wait(self.cv, lambda: self.finished or None, timeout=timeout)
+            return self.value
+
+class OrderedExecutor(object):
+    """
+    Pool of worker threads that runs tasks in order per key
+
+    Tasks submitted with the same key always run on the same worker, in
+    submission order. Each worker has a bounded queue. submit never
+    blocks: a task is refused while its worker's queue is full, so a task
+    that waits on the producer cannot deadlock it. Tasks submitted after
+    shutdown are refused too.
+    """
+
+    def __init__(self, workers, queue_size, name="executor"):
+        self.queues = [Queue.Queue(queue_size) for i in range(workers)]
+        self.threads = []
+        for (i, queue) in enumerate(self.queues):
+            thread = Thread(target=self._run, args=(queue,),
+                            name="%s-%d" % (name, i))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+        self.stopped = False
+
+    def submit(self, key, fn, *args):
+        """
+        Queue fn(*args) on the worker for key
+
+        @returns True if the task was queued, False if it was refused
+        """
+        if self.stopped:
+            return False
+        try:
+            self.queues[hash(key) % len(self.queues)].put_nowait((fn, args))
+        except Queue.Full:
+            return False
+        return True
+
+    def shutdown(self):
+        """
+        Stop the workers once they have run the tasks already submitted
+
+        Does not wait for the workers, so a task that never returns does
+        not block the caller.
+        """
+        if self.stopped:
+            return
+        self.stopped = True
+        for queue in self.queues:
+            try:
+                queue.put_nowait(None)
+            except Queue.Full:
+                pass # The worker stops when it has emptied the queue
+
+    def _run(self, queue):
+        while True:
+            task = queue.get()
+            if task is None:
+                break
+            (fn, args) = task
+            try:
+                fn(*args)
+            except:
+                logging.exception("Unhandled exception in %s",
+                                  current_thread().name)
+            if self.stopped and queue.empty():
+                break
@@ -1,13 +1,24 @@
 """
-Pcap file writer
+Pcap file writers
 """
 
 import struct
+import socket
+import Queue
+from threading import Thread
 
 PcapHeader = struct.Struct("<LHHLLLL")
 PcapPktHeader = struct.Struct("<LLLL")
 PPIPktHeader = struct.Struct("<BBHL")
 PPIAggregateField = struct.Struct("<HHL")
+EthHeader = struct.Struct("!6s6sH")
+IPv4Header = struct.Struct("!BBHHHBBH4s4s")
+TCPHeader = struct.Struct("!HHLLBBHHH")
+
+LINKTYPE_ETHERNET = 1
+LOCAL_MAC = "\x02\x00\x00\x00\x00\x01"
+REMOTE_MAC = "\x02\x00\x00\x00\x00\x02"
+TCP_SEGMENT_MAX = 65535 - IPv4Header.size - TCPHeader.size
 
 class PcapWriter(object):
     def __init__(self, filename):
@@ -53,6 +64,143 @@ class PcapWriter(object):
     def close(self):
         self.stream.close()
 
+def ip_checksum(header):
+    total = sum(struct.unpack("!%dH" % (len(header) / 2), header))
+    while total >> 16:
+        total = (total & 0xffff) + (total >> 16)
+    return ~total & 0xffff
+
+class TcpStreamPcapWriter(object):
+    """
+    Write both directions of a TCP stream to a pcap file
+
+    The payload is wrapped in synthesized Ethernet, IPv4 and TCP headers
+    with consistent sequence numbers, so that Wireshark reassembles the
+    stream and its OpenFlow dissector decodes the messages.  The local
+    side always has MAC address LOCAL_MAC and the remote side REMOTE_MAC.
+
+    Further streams, such as OpenFlow auxiliary connections, can be added
+    to the same file with add_stream and written with the stream key.
+
+    Writes go through a bounded queue to a background thread, so write()
+    never blocks on the disk.  If the queue is full the data is dropped
+    and counted in 'dropped'.
+    """
+
+    def __init__(self, filename, local_addr, remote_addr, queue_size=4096):
+        """
+        @param local_addr (ip, port) of the side whose writes are outgoing
+        @param remote_addr (ip, port) of the other side
+        """
+        self.stream = file(filename, 'w')
+        self.stream.write(PcapHeader.pack(
+            0xa1b2c3d4, # magic
+            2, # major
+            4, # minor
+            0, # timezone offset
+            0, # timezone accuracy
+            65535, # snapshot length
+            LINKTYPE_ETHERNET
+        ))
+        self.streams = {}
+        self.add_stream(None, local_addr, remote_addr)
+        self.ip_id = 0
+        self.dropped = 0
+        self.queue = Queue.Queue(queue_size)
+        self.thread = Thread(target=self._run, name="pcap-writer")
+        self.thread.daemon = True
+        self.thread.start()
+
+    @staticmethod
+    def _endpoint(addr, mac):
+        try:
+            ip = socket.inet_aton(addr[0])
+        except (socket.error, TypeError, IndexError):
+            ip = socket.inet_aton("127.0.0.1")
+        try:
+            port = int(addr[1])
+        except (TypeError, ValueError, IndexError):
+            port = 0
+        return (mac, ip, port)
+
+    def add_stream(self, key, local_addr, remote_addr):
+        """
+        Add a TCP stream to the capture
+
+        @param key Hashable key passed to write for this stream
+        @param local_addr (ip, port) of the side whose writes are outgoing
+        @param remote_addr (ip, port) of the other side
+        """
+        self.streams[key] = (self._endpoint(local_addr, LOCAL_MAC),
+                             self._endpoint(remote_addr, REMOTE_MAC),
+                             { True: 1, False: 1 }) # Next seq by direction
+
+    def has_stream(self, key):
+        return key in self.streams
+
+    def write(self, data, timestamp, outgoing, stream=None):
+        """
+        Queue stream data for writing
+
+        'data' should be a string containing the TCP payload.
+        'timestamp' should be a float.
+        'outgoing' should be True for data sent by the local side.
+        'stream' is the key given to add_stream, or None for the stream
+        given to the constructor.
+        """
+        try:
+            self.queue.put_nowait((data, timestamp, outgoing, stream))
+        except Queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            (data, timestamp, outgoing, stream) = item
+            for offset in range(0, len(data), TCP_SEGMENT_MAX):
+                self._write_segment(self.streams[stream],
+                                    data[offset:offset + TCP_SEGMENT_MAX],
+                                    timestamp, outgoing)
+
+    def _write_segment(self, stream, data, timestamp, outgoing):
+        (local, remote, seqs) = stream
+        if outgoing:
+            (src, dst) = (local, remote)
+        else:
+            (src, dst) = (remote, local)
+        seq = seqs[outgoing]
+        seqs[outgoing] = (seq + len(data)) & 0xffffffff
+        ack = seqs[not outgoing]
+        self.ip_id = (self.ip_id + 1) & 0xffff
+
+        ip_len = IPv4Header.size + TCPHeader.size + len(data)
+        ip = IPv4Header.pack(0x45, 0, ip_len, self.ip_id, 0x4000, 64,
+                             socket.IPPROTO_TCP, 0, src[1], dst[1])
+        ip = ip[:10] + struct.pack("!H", ip_checksum(ip)) + ip[12:]
+        tcp = TCPHeader.pack(src[2], dst[2], seq, ack,
+                             (TCPHeader.size / 4) << 4,
+                             0x18, # PSH, ACK
+                             65535, 0, 0)
+        frame = EthHeader.pack(dst[0], src[0], 0x0800) + ip + tcp + data
+
+        self.stream.write(PcapPktHeader.pack(
+            int(timestamp), # timestamp seconds
+            int((timestamp - int(timestamp)) * 10**6), # timestamp microseconds
+            len(frame), # truncated length
+            len(frame) # un-truncated length
+        ))
+        self.stream.write(frame)
+
+    def close(self):
+        """
+        Write out everything queued so far and close the file
+        """
+        self.queue.put(None)
+        self.thread.join()
+        self.stream.close()
+
 if __name__ == "__main__":
     import time
     print("Writing test pcap to test.pcap")
@@ -0,0 +1,276 @@
+"""
+Offline replay of recorded control channel sessions
+
+Reads a control channel capture, as written by Controller.start_pcap, and
+feeds the bytes the switch sent into a Controller or a
+loxi.connection.Connection with the original read boundaries.  No switch
+or socket is involved, so parser changes can be profiled against real
+traffic:
+
+    chunks = read_capture("basic.FlowMod.ofp.pcap")
+    result = replay_controller(chunks)
+    print result
+
+Captures from other tools work too if they are Ethernet/IPv4/TCP and the
+switch's TCP port is given with switch_port.
+
+The module can also be run as a script; see --help.
+"""
+
+import os
+import sys
+import time
+import struct
+import logging
+
+import pcap_writer
+from pcap_writer import PcapHeader, PcapPktHeader, EthHeader
+
+TCP_PORTS = struct.Struct("!HH")
+
+class ReplayResult(object):
+    """
+    Outcome of a replay
+
+    @var chunks Number of reads replayed
+    @var messages Number of messages decoded
+    @var bytes Number of bytes replayed
+    @var elapsed Wall clock seconds, including any pacing delay
+    @var busy Seconds spent processing the reads
+    @var decode Seconds spent in parse_message, if known
+    """
+
+    def __init__(self):
+        self.chunks = 0
+        self.messages = 0
+        self.bytes = 0
+        self.elapsed = 0.0
+        self.busy = 0.0
+        self.decode = None
+
+    def msgs_per_sec(self):
+        return self.busy and self.messages / self.busy
+
+    def bytes_per_sec(self):
+        return self.busy and self.bytes / self.busy
+
+    def usec_per_msg(self):
+        return self.messages and self.busy * 1e6 / self.messages
+
+    def __str__(self):
+        s = "%d messages, %d bytes in %d reads: %.3fs busy, " \
+            "%.0f msgs/s, %.1f MB/s, %.1f us/msg" % \
+            (self.messages, self.bytes, self.chunks, self.busy,
+             self.msgs_per_sec(), self.bytes_per_sec() / 1e6,
+             self.usec_per_msg())
+        if self.decode is not None:
+            s += " (%.1f us/msg decoding)" % \
+                (self.messages and self.decode * 1e6 / self.messages)
+        return s
+
+def read_capture(filename, switch_port=None):
+    """
+    Read the data sent by the switch from a capture
+
+    @param filename Pcap file with Ethernet link type
+    @param switch_port If None, the capture was written by Controller and
+    the switch is the side with MAC address REMOTE_MAC.  Only the first
+    connection from it is read, since auxiliary connections are captured
+    to the same file.  Otherwise the switch is the side using this TCP
+    port.
+    @returns List of (timestamp, data) pairs, one per TCP segment
+    """
+    with open(filename, 'rb') as f:
+        data = f.read()
+
+    (magic, _, _, _, _, _, linktype) = PcapHeader.unpack_from(data, 0)
+    if magic == 0xa1b2c3d4:
+        tick = 1e-6
+    elif magic == 0xa1b23c4d: # Nanosecond timestamps
+        tick = 1e-9
+    else:
+        raise ValueError("%s: not a little-endian pcap file" % filename)
+    if linktype != pcap_writer.LINKTYPE_ETHERNET:
+        raise ValueError("%s: unsupported link type %d" % (filename, linktype))
+
+    chunks = []
+    main_port = None # Switch port of the first connection
+    offset = PcapHeader.size
+    while offset + PcapPktHeader.size <= len(data):
+        (sec, frac, caplen, _) = PcapPktHeader.unpack_from(data, offset)
+        offset += PcapPktHeader.size
+        frame = data[offset:offset + caplen]
+        offset += caplen
+
+        (dst_mac, src_mac, ethertype) = EthHeader.unpack_from(frame, 0)
+        ip_offset = EthHeader.size
+        if ethertype == 0x8100:
+            (ethertype,) = struct.unpack_from("!H", frame, ip_offset + 2)
+            ip_offset += 4
+        if ethertype != 0x0800 or ord(frame[ip_offset + 9]) != 6:
+            continue # Not TCP over IPv4
+        ip_len = (ord(frame[ip_offset]) & 0xf) * 4
+        (total_len,) = struct.unpack_from("!H", frame, ip_offset + 2)
+        tcp_offset = ip_offset + ip_len
+        (src_port, dst_port) = TCP_PORTS.unpack_from(frame, tcp_offset)
+        tcp_len = (ord(frame[tcp_offset + 12]) >> 4) * 4
+        payload = frame[tcp_offset + tcp_len:ip_offset + total_len]
+
+        if switch_port is None:
+            from_switch = src_mac == pcap_writer.REMOTE_MAC
+            if from_switch and payload:
+                if main_port is None:
+                    main_port = src_port
+                from_switch = src_port == main_port
+        else:
+            from_switch = src_port == switch_port
+        if from_switch and payload:
+            chunks.append((sec + frac * tick, payload))
+    return chunks
+
+def _replay(chunks, process, speed):
+    """
+    Call process(data) for each chunk
+
+    @param speed If None, replay as fast as possible.  Otherwise keep the
+    original spacing of the reads divided by speed.
+    """
+    result = ReplayResult()
+    start_time = time.time()
+    for (timestamp, data) in chunks:
+        if speed:
+            delay = start_time + (timestamp - chunks[0][0]) / speed - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        process_start = time.time()
+        result.messages += process(data)
+        result.busy += time.time() - process_start
+        result.chunks += 1
+        result.bytes += len(data)
+    result.elapsed = time.time() - start_time
+    return result
+
+def replay_controller(chunks, speed=None):
+    """
+    Replay reads through Controller._pkt_handle
+
+    The controller is not started or connected.  Every message is consumed
+    by a handler, so the receive queues stay empty.
+
+    @param chunks List of (timestamp, data) pairs from read_capture
+    @param speed See _replay
+    @returns A ReplayResult
+    """
+    import controller # Needs the ofp module, see main
+
+    ctrl = controller.Controller(switch="replay")
+    ctrl.register("all", lambda ctrl, msg, rawmsg: True)
+
+    def process(data):
+        before = ctrl.packets_handled + ctrl.parse_errors
+        ctrl._pkt_handle(data)
+        return ctrl.packets_handled + ctrl.parse_errors - before
+
+    result = _replay(chunks, process, speed)
+    result.decode = ctrl.metrics.snapshot()["stage_time"].get("decode", 0.0)
+    return result
+
+class ReplaySocket(object):
+    """
+    Socket stand-in that receives from one recorded read at a time
+    """
+
+    def __init__(self):
+        self.data = ""
+
+    def recv(self, nbytes):
+        (data, self.data) = (self.data[:nbytes], self.data[nbytes:])
+        return data
+
+    def recv_into(self, buf, nbytes=0):
+        data = self.recv(nbytes or len(buf))
+        buf[:len(data)] = data
+        return len(data)
+
+def replay_connection(chunks, speed=None):
+    """
+    Replay reads through loxi.connection.Connection.process_read
+
+    The connection thread is not started.  Received messages are discarded
+    after each read.
+
+    @param chunks List of (timestamp, data) pairs from read_capture
+    @param speed See _replay
+    @returns A ReplayResult
+    """
+    from loxi.connection import Connection
+
+    sock = ReplaySocket()
+    cxn = Connection(sock)
+
+    def process(data):
+        sock.data = data
+        count = 0
+        while sock.data:
+            cxn.process_read()
+            count += len(cxn.rx)
+            cxn.rx.clear()
+            cxn.rx_by_xid.clear()
+            cxn.rx_by_class.clear()
+        return count
+
+    try:
+        return _replay(chunks, process, speed)
+    finally:
+        os.close(cxn.wakeup_rd)
+        os.close(cxn.wakeup_wr)
+
+def main():
+    from optparse import OptionParser
+
+    parser = OptionParser(usage="%prog [options] capture.pcap")
+    parser.add_option("--target", choices=["controller", "connection"],
+                      default="controller",
+                      help="Replay into Controller or loxi Connection")
+    parser.add_option("--speed", type="float", default=None,
+                      help="Pace reads by the capture timestamps divided "
+                      "by SPEED; default is as fast as possible")
+    parser.add_option("--switch-port", type="int", default=None,
+                      help="TCP port of the switch, for captures not "
+                      "written by oftest")
+    parser.add_option("--repeat", type="int", default=1,
+                      help="Number of times to replay the capture")
+    parser.add_option("--profile", default=None,
+                      help="Write cProfile statistics to this file")
+    (options, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.error("expected one capture file")
+
+    logging.basicConfig(level=logging.WARNING)
+    chunks = read_capture(args[0], options.switch_port)
+    if not chunks:
+        parser.error("no data from the switch in %s" % args[0])
+
+    import loxi
+    # The controller module expects oft to have picked the ofp module
+    sys.modules["ofp"] = loxi.protocol(ord(chunks[0][1][0]))
+
+    if options.target == "controller":
+        replay = replay_controller
+    else:
+        replay = replay_connection
+
+    profiler = None
+    if options.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    for i in range(options.repeat):
+        print replay(chunks, options.speed)
+    if profiler:
+        profiler.disable()
+        profiler.dump_stats(options.profile)
+
+if __name__ == "__main__":
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    main()
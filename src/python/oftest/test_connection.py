@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+import os
+import time
+import socket
+import unittest
+import threading
+import loxi.of13 as of13
+import loxi.connection
+
+def wait_until(fn, timeout=2):
+    end_time = time.time() + timeout
+    while not fn():
+        if time.time() > end_time:
+            raise AssertionError("timed out")
+        time.sleep(0.001)
+
+class ConnectionTest(unittest.TestCase):
+    def setUp(self):
+        (self.switch, sock) = socket.socketpair()
+        self.cxn = loxi.connection.Connection(sock)
+        self.cxn.daemon = True
+        self.cxn.start()
+        self.threads = []
+
+    def tearDown(self):
+        self.cxn.stop()
+        self.switch.close()
+
+    def send(self, *msgs):
+        self.switch.sendall(''.join([msg.pack() for msg in msgs]))
+
+    def waiting(self, count):
+        """
+        Wait until count threads are blocked in recv
+        """
+        def registered():
+            with self.cxn.rx_cv:
+                waiters = set()
+                for registry in (self.cxn.xid_waiters, self.cxn.class_waiters,
+                                 self.cxn.predicate_waiters):
+                    for entries in registry.values():
+                        waiters.update(entries)
+                return len(waiters) == count
+        wait_until(registered)
+
+    def background(self, fn, *args):
+        """
+        Run fn in a thread; returns a list that receives its result
+        """
+        result = []
+        thread = threading.Thread(target=lambda: result.append(fn(*args)))
+        thread.daemon = True
+        thread.start()
+        self.threads.append(thread)
+        return result
+
+    def join(self):
+        for thread in self.threads:
+            thread.join(2)
+
+class TestWaiters(ConnectionTest):
+    def test_out_of_order_xids(self):
+        first = self.background(self.cxn.recv_xid, 1, 2)
+        second = self.background(self.cxn.recv_xid, 2, 2)
+        self.waiting(2)
+        self.send(of13.message.echo_reply(xid=2, data='b'),
+                  of13.message.echo_reply(xid=1, data='a'))
+        self.join()
+        self.assertEquals(first[0].data, 'a')
+        self.assertEquals(second[0].data, 'b')
+
+    def test_same_xid_in_order(self):
+        first = self.background(self.cxn.recv_xid, 3, 2)
+        self.waiting(1)
+        second = self.background(self.cxn.recv_xid, 3, 2)
+        self.waiting(2)
+        self.send(of13.message.echo_reply(xid=3, data='a'),
+                  of13.message.echo_reply(xid=3, data='b'))
+        self.join()
+        self.assertEquals(first[0].data, 'a')
+        self.assertEquals(second[0].data, 'b')
+
+    def test_priority(self):
+        predicate = self.background(self.cxn.recv_any, 2)
+        self.waiting(1)
+        klass = self.background(self.cxn.recv_class, of13.message.stats_reply, 2)
+        self.waiting(2)
+        xid = self.background(self.cxn.recv_xid, 7, 2)
+        self.waiting(3)
+        self.send(of13.message.port_stats_reply(xid=7),
+                  of13.message.flow_stats_reply(xid=8),
+                  of13.message.echo_reply(xid=9))
+        self.join()
+        self.assertEquals(xid[0].xid, 7)
+        self.assertEquals(klass[0].xid, 8)
+        self.assertEquals(predicate[0].xid, 9)
+        self.waiting(0)
+
+    def test_timeout(self):
+        self.assertEquals(self.cxn.recv_xid(4, 0.01), None)
+        self.assertEquals(self.cxn.xid_waiters, {})
+        # A late reply is queued for the next recv
+        self.send(of13.message.echo_reply(xid=4))
+        self.assertEquals(self.cxn.recv_xid(4, 1).xid, 4)
+
+    def test_queued(self):
+        self.send(of13.message.echo_reply(xid=1),
+                  of13.message.port_stats_reply(xid=2),
+                  of13.message.echo_reply(xid=3))
+        wait_until(lambda: len(self.cxn.rx) == 3)
+        self.assertEquals(self.cxn.recv_xid(3).xid, 3)
+        self.assertEquals(self.cxn.recv_class(of13.message.stats_reply).xid, 2)
+        self.assertEquals(self.cxn.recv_any().xid, 1)
+        self.assertEquals(len(self.cxn.rx), 0)
+        self.assertEquals(self.cxn.rx_by_xid, {})
+        self.assertEquals(self.cxn.rx_by_class, {})
+
+    def test_recv_xids_before_recv_class(self):
+        fanout = self.background(self.cxn.recv_xids, [5, 6], 2)
+        self.waiting(1)
+        other = self.background(self.cxn.recv_class, of13.message.stats_reply, 2)
+        self.waiting(2)
+        self.send(of13.message.port_stats_reply(xid=6),
+                  of13.message.flow_stats_reply(xid=9))
+        self.join()
+        self.assertEquals(fanout[0].xid, 6)
+        self.assertEquals(other[0].xid, 9)
+        self.assertEquals(self.cxn.xid_waiters, {})
+
+    def test_recv_xids_woken_once(self):
+        fanout = self.background(self.cxn.recv_xids, [5, 6], 2)
+        self.waiting(1)
+        self.send(of13.message.port_stats_reply(xid=5),
+                  of13.message.port_stats_reply(xid=6))
+        self.join()
+        self.assertEquals(fanout[0].xid, 5)
+        # The second reply is queued, not lost to the finished waiter
+        self.assertEquals(self.cxn.recv_xids([5, 6], 1).xid, 6)
+        self.assertEquals(self.cxn.xid_waiters, {})
+
+class TestPeerClose(unittest.TestCase):
+    def check_reply(self, cxn, switch):
+        # A reply followed by a close can still be read after the close
+        switch.sendall(of13.message.echo_reply(xid=2).pack())
+        switch.shutdown(socket.SHUT_RDWR)
+        wait_until(lambda: not cxn.running())
+        self.assertEquals(cxn.recv_xid(2, 5).xid, 2)
+        start_time = time.time()
+        self.assertEquals(cxn.recv_xid(2, 5), None)
+        self.assertTrue(time.time() - start_time < 2)
+        cxn.stop()
+        switch.close()
+
+    def check(self, cxn, switch):
+        result = []
+        thread = threading.Thread(target=lambda: result.append(cxn.recv_xid(1, 5)))
+        thread.daemon = True
+        thread.start()
+        wait_until(lambda: cxn.xid_waiters)
+        start_time = time.time()
+        switch.shutdown(socket.SHUT_RDWR)
+        thread.join(5)
+        # The waiter returns at once instead of waiting out its timeout
+        self.assertEquals(result, [None])
+        self.assertTrue(time.time() - start_time < 2)
+        wait_until(lambda: not cxn.running())
+        cxn.stop()
+        switch.close()
+
+    def test_thread(self):
+        (switch, sock) = socket.socketpair()
+        cxn = loxi.connection.Connection(sock)
+        cxn.daemon = True
+        cxn.start()
+        self.check(cxn, switch)
+
+    def test_manager(self):
+        manager = loxi.connection.ConnectionManager()
+        (switch, sock) = socket.socketpair()
+        cxn = loxi.connection.Connection(sock)
+        manager.add(cxn)
+        self.check(cxn, switch)
+        self.assertEquals(manager.connections, {})
+        manager.stop()
+
+    def test_reply_then_close_thread(self):
+        (switch, sock) = socket.socketpair()
+        cxn = loxi.connection.Connection(sock)
+        cxn.daemon = True
+        cxn.start()
+        self.check_reply(cxn, switch)
+
+    def test_reply_then_close_manager(self):
+        manager = loxi.connection.ConnectionManager()
+        (switch, sock) = socket.socketpair()
+        cxn = loxi.connection.Connection(sock)
+        manager.add(cxn)
+        self.check_reply(cxn, switch)
+        manager.stop()
+
+class TestFraming(unittest.TestCase):
+    """
+    Feed the connection's socket in chunks and read it with process_read
+    """
+    def setUp(self):
+        (self.switch, sock) = socket.socketpair()
+        self.cxn = loxi.connection.Connection(sock)
+
+    def tearDown(self):
+        self.cxn.sock.close()
+        self.switch.close()
+        os.close(self.cxn.wakeup_rd)
+        os.close(self.cxn.wakeup_wr)
+
+    def read(self, data):
+        self.switch.sendall(data)
+        received = 0
+        while received < len(data):
+            received += self.cxn.process_read()
+
+    def received(self):
+        return [(type(msg).__name__, msg.xid) for msg in self.cxn.rx.values()]
+
+    def test_split_header(self):
+        data = of13.message.echo_reply(xid=1, data='abc').pack()
+        self.read(data[:3])
+        self.assertEquals(self.received(), [])
+        self.read(data[3:9])
+        self.assertEquals(self.received(), [])
+        self.read(data[9:])
+        self.assertEquals(self.received(), [('echo_reply', 1)])
+        self.assertEquals(self.cxn.read_start, self.cxn.read_end)
+
+    def test_split_across_reads(self):
+        msgs = [of13.message.echo_reply(xid=i, data='x' * (i * 11))
+                for i in range(1, 40)]
+        stream = ''.join([msg.pack() for msg in msgs])
+        for offset in range(0, len(stream), 97):
+            self.read(stream[offset:offset + 97])
+        self.assertEquals(self.received(),
+                          [('echo_reply', i) for i in range(1, 40)])
+        self.assertEquals([msg.data for msg in self.cxn.rx.values()],
+                          [msg.data for msg in msgs])
+
+    def test_large_message(self):
+        data = 'y' * (3 * loxi.connection.RECV_SIZE_MIN)
+        self.read(of13.message.echo_reply(xid=1).pack()[:4])
+        self.read(of13.message.echo_reply(xid=1).pack()[4:] +
+                  of13.message.echo_reply(xid=2, data=data).pack())
+        self.assertEquals(self.received(), [('echo_reply', 1), ('echo_reply', 2)])
+        self.assertEquals(self.cxn.rx.values()[1].data, data)
+
+    def test_eof(self):
+        self.switch.shutdown(socket.SHUT_WR)
+        self.assertEquals(self.cxn.process_read(), 0)
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
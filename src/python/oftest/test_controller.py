@@ -0,0 +1,311 @@
+#!/usr/bin/env python
+import sys
+import time
+import select
+import socket
+import unittest
+import threading
+import loxi.of13 as of13
+sys.modules.setdefault('ofp', of13)
+import controller
+
+PACKET_IN = of13.OFPT_PACKET_IN
+
+def payload(i, size=64):
+    return ("%04d" % i) * (size / 4)
+
+def packet_in(data, in_port=1, reason=of13.OFPR_ACTION):
+    msg = of13.message.packet_in(xid=1, reason=reason, data=data,
+                                 match=of13.match([of13.oxm.in_port(in_port)]))
+    return msg
+
+class TestPacketInIndex(unittest.TestCase):
+    def setUp(self):
+        # No switch connection; messages are fed straight to _enqueue
+        self.ctrl = controller.Controller(switch="test")
+
+    def enqueue(self, msg):
+        self.ctrl._enqueue(PACKET_IN, msg, msg.pack())
+
+    def poll(self, data, in_port=None, reason=None, timeout=0):
+        (msg, pkt) = self.ctrl.poll_packet_in(data, in_port, reason, timeout)
+        return msg
+
+    def test_indexed_hit(self):
+        for i in range(10):
+            self.enqueue(packet_in(payload(i), in_port=i % 3 + 1))
+        msg = self.poll(payload(5), in_port=3, reason=of13.OFPR_ACTION)
+        self.assertEquals(msg.data, payload(5))
+        self.assertEquals(self.ctrl.queued_count(), 9)
+        # Wrong in_port or reason does not match
+        self.assertEquals(self.poll(payload(4), in_port=1, reason=of13.OFPR_ACTION), None)
+        self.assertEquals(self.poll(payload(4), in_port=2, reason=of13.OFPR_NO_MATCH), None)
+        self.assertEquals(self.ctrl.queued_count(), 9)
+
+    def test_unindexed_hit(self):
+        for i in range(5):
+            self.enqueue(packet_in(payload(i), in_port=2))
+        self.assertEquals(self.poll(payload(3)).data, payload(3))
+        self.assertEquals(self.poll(payload(1), in_port=2).data, payload(1))
+        self.assertEquals(self.ctrl.queued_count(), 3)
+
+    def test_short_data(self):
+        self.enqueue(packet_in("short", in_port=4))
+        self.enqueue(packet_in(payload(1), in_port=4))
+        self.assertEquals(self.poll("short", in_port=4, reason=of13.OFPR_ACTION).data, "short")
+        self.assertEquals(self.ctrl.queued_count(), 1)
+
+    def test_truncated_and_padded(self):
+        data = payload(7, 128)
+        self.enqueue(packet_in(data[:40]))
+        self.enqueue(packet_in(payload(8, 40) + "\0" * 24))
+        msg = self.poll(data, in_port=1, reason=of13.OFPR_ACTION)
+        self.assertEquals(msg.data, data[:40])
+        msg = self.poll(payload(8, 40), in_port=1, reason=of13.OFPR_ACTION)
+        self.assertEquals(msg.data[:40], payload(8, 40))
+
+    def test_duplicates_in_order(self):
+        for xid in range(3):
+            msg = packet_in(payload(1))
+            msg.xid = xid
+            self.enqueue(msg)
+        xids = [self.ctrl.poll_packet_in(payload(1), 1, of13.OFPR_ACTION, 0)[0].xid
+                for i in range(3)]
+        self.assertEquals(xids, [0, 1, 2])
+
+    def test_poll_skips_taken(self):
+        for i in range(3):
+            self.enqueue(packet_in(payload(i)))
+        self.poll(payload(0), in_port=1, reason=of13.OFPR_ACTION)
+        self.poll(payload(1), in_port=1, reason=of13.OFPR_ACTION)
+        (msg, pkt) = self.ctrl.poll(of13.message.packet_in, timeout=0)
+        self.assertEquals(msg.data, payload(2))
+        self.assertEquals(self.ctrl.queued_count(), 0)
+
+    def test_trim(self):
+        for i in range(4):
+            self.enqueue(packet_in(payload(i)))
+        queue = self.ctrl.queues[PACKET_IN]
+        self.poll(payload(1), in_port=1, reason=of13.OFPR_ACTION)
+        self.assertEquals(len(queue), 4) # Taken from the middle
+        self.poll(payload(0), in_port=1, reason=of13.OFPR_ACTION)
+        self.assertEquals([msg.data for (_, msg, _) in queue], [payload(2), payload(3)])
+
+    def test_compact(self):
+        count = 2 * controller.PKT_IN_COMPACT_SLACK
+        for i in range(count):
+            self.enqueue(packet_in(payload(i)))
+        # Take all but the first so that the taken ones cannot be trimmed
+        for i in range(1, count):
+            self.poll(payload(i), in_port=1, reason=of13.OFPR_ACTION)
+        for i in range(count, count + 10):
+            self.enqueue(packet_in(payload(i)))
+        queue = self.ctrl.queues[PACKET_IN]
+        live = len(self.ctrl.pkt_in_live)
+        self.assertEquals(live, 11)
+        self.assertTrue(len(queue) <= 2 * live + controller.PKT_IN_COMPACT_SLACK)
+        self.ctrl._pkt_in_compact()
+        queue = self.ctrl.queues[PACKET_IN]
+        self.assertEquals(len(queue), live)
+        self.assertEquals(self.ctrl.pkt_in_indexed, live)
+        self.assertEquals(self.poll(payload(0), in_port=1, reason=of13.OFPR_ACTION).data,
+                          payload(0))
+        self.assertEquals(self.poll(payload(count + 5)).data, payload(count + 5))
+
+    def test_queue_limit(self):
+        self.ctrl.queue_limits[PACKET_IN] = 5
+        for i in range(8):
+            self.enqueue(packet_in(payload(i)))
+        self.assertEquals(self.ctrl.queued_count(), 5)
+        self.assertEquals(self.ctrl.packets_expired, 3)
+        self.assertEquals(self.poll(payload(0), in_port=1, reason=of13.OFPR_ACTION), None)
+        self.assertEquals(self.poll(payload(3), in_port=1, reason=of13.OFPR_ACTION).data,
+                          payload(3))
+
+    def test_hand_off(self):
+        result = []
+        def waiter():
+            result.append(self.poll(payload(9), in_port=2,
+                                    reason=of13.OFPR_ACTION, timeout=5))
+        thread = threading.Thread(target=waiter)
+        thread.start()
+        for i in range(500):
+            if self.ctrl.pkt_in_waiters:
+                break
+            time.sleep(0.01)
+        self.enqueue(packet_in(payload(8), in_port=2))
+        self.enqueue(packet_in(payload(9), in_port=2))
+        thread.join()
+        self.assertEquals(result[0].data, payload(9))
+        # The matching packet in went to the waiter without being queued
+        self.assertEquals(self.ctrl.queued_count(), 1)
+        self.assertEquals(self.ctrl.pkt_in_waiters, {})
+
+class TestFilterPacketIn(unittest.TestCase):
+    def test_threads(self):
+        ctrl = controller.Controller(switch="test")
+        ctrl.filter_packet_in = True
+        ctrl.pkt_in_filter_limit = 100
+        raw = packet_in(payload(1)).pack()
+        passed = []
+        def reader():
+            count = 0
+            for i in range(2000):
+                if not ctrl.filter_packet(raw, 4, PACKET_IN):
+                    count += 1
+            passed.append(count)
+        threads = [threading.Thread(target=reader) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # Every packet in is either passed or counted as dropped
+        self.assertEquals(sum(passed) + ctrl.pkt_in_dropped, 8000)
+        self.assertTrue(sum(passed) < 200)
+
+class TestHandlerPool(unittest.TestCase):
+    def setUp(self):
+        self.ctrl = controller.Controller(switch="test", handler_workers=2)
+        self.release = threading.Event()
+        self.handled = []
+        self.ctrl.register(PACKET_IN, self.handler)
+
+    def tearDown(self):
+        self.release.set()
+        self.ctrl.handler_pool.shutdown()
+
+    def handler(self, ctrl, msg, rawmsg):
+        self.release.wait(5)
+        self.handled.append(msg.xid)
+        return msg.xid % 2 == 0
+
+    def receive(self, *msgs):
+        self.ctrl._pkt_handle(''.join([msg.pack() for msg in msgs]))
+
+    def queued(self, msg_type):
+        return [(seq, msg.xid) for (seq, msg, _) in self.ctrl.queues.get(msg_type, [])]
+
+    def test_unhandled_in_order(self):
+        pkt_in = packet_in(payload(1))
+        pkt_in.xid = 1
+        self.receive(pkt_in, of13.message.bad_request_error_msg(xid=2),
+                     of13.message.barrier_reply(xid=3))
+        # Queued by the reader while the handler is still busy
+        [(error_seq, _)] = self.queued(of13.OFPT_ERROR)
+        [(barrier_seq, _)] = self.queued(of13.OFPT_BARRIER_REPLY)
+        self.assertTrue(error_seq < barrier_seq)
+        self.assertEquals(self.handled, [])
+        self.release.set()
+        for i in range(500):
+            if self.queued(PACKET_IN):
+                break
+            time.sleep(0.01)
+        self.assertEquals(self.handled, [1])
+        self.assertEquals([xid for (_, xid) in self.queued(PACKET_IN)], [1])
+
+    def test_backlogged(self):
+        count = controller.HANDLER_QUEUE_SIZE + 10
+        msgs = []
+        for i in range(count):
+            msg = packet_in(payload(i))
+            msg.xid = i
+            msgs.append(msg)
+        # Does not wait for the blocked handler
+        self.receive(*msgs)
+        drops = self.ctrl.handler_drops
+        self.assertTrue(drops >= 9)
+        self.assertEquals(self.ctrl.queued_count(), drops)
+        self.release.set()
+        for i in range(500):
+            if len(self.handled) == count - drops:
+                break
+            time.sleep(0.01)
+        self.assertEquals(self.handled, range(count - drops))
+
+class SendmsgSocket(object):
+    """
+    Socket with a sendmsg that writes only the first buffer
+    """
+    def __init__(self, sock):
+        self.sock = sock
+        self.calls = []
+
+    def sendmsg(self, buffers):
+        self.calls.append(len(buffers))
+        return self.sock.send(buffers[0])
+
+    def sendall(self, data):
+        return self.sock.sendall(data)
+
+class TestCoalesce(unittest.TestCase):
+    def setUp(self):
+        self.ctrl = controller.Controller(switch="test", tx_coalesce=10)
+        (self.switch, self.ctrl.switch_socket) = socket.socketpair()
+        # Coalesce as if the event loop were running to flush on deadline
+        self.ctrl.is_alive = lambda: True
+
+    def tearDown(self):
+        self.switch.close()
+
+    def received(self):
+        data = ''
+        while select.select([self.switch], [], [], 0)[0]:
+            data += self.switch.recv(65536)
+        return data
+
+    def send(self, count, start=1):
+        msgs = [of13.message.port_stats_request(xid=xid)
+                for xid in range(start, start + count)]
+        for msg in msgs:
+            self.ctrl.message_send(msg)
+        return ''.join([msg.pack() for msg in msgs])
+
+    def test_flush_in_order(self):
+        data = self.send(5)
+        self.assertEquals(self.received(), '')
+        self.assertEquals(len(self.ctrl.tx_pending), 5)
+        self.ctrl.flush()
+        self.assertEquals(self.received(), data)
+        self.assertEquals(self.ctrl.tx_pending, [])
+        self.assertEquals(self.ctrl.tx_deadline, None)
+
+    def test_barrier_writes_held(self):
+        data = self.send(3)
+        barrier = of13.message.barrier_request(xid=4)
+        self.ctrl.message_send(barrier)
+        self.assertEquals(self.received(), data + barrier.pack())
+
+    def test_poll_writes_held(self):
+        data = self.send(2)
+        self.ctrl.poll(of13.message.port_stats_reply, timeout=0)
+        self.assertEquals(self.received(), data)
+
+    def test_batch_bytes(self):
+        data = ''
+        while len(data) < controller.TX_BATCH_BYTES:
+            msg = of13.message.packet_out(xid=len(data), data='x' * 4096,
+                                          buffer_id=of13.OFP_NO_BUFFER)
+            self.ctrl.message_send(msg)
+            data += msg.pack()
+        self.assertEquals(self.ctrl.tx_pending, [])
+        self.assertEquals(self.received(), data)
+
+    def test_no_coalescing(self):
+        self.ctrl.tx_coalesce = 0
+        data = self.send(1)
+        self.assertEquals(self.received(), data)
+        self.ctrl.tx_coalesce = 5
+        self.ctrl.reset()
+        self.assertEquals(self.ctrl.tx_coalesce, 10)
+
+    def test_sendmsg(self):
+        sock = SendmsgSocket(self.ctrl.switch_socket)
+        self.ctrl.switch_socket = sock
+        data = self.send(3)
+        self.ctrl.flush()
+        # The rest is written with sendall after a short sendmsg
+        self.assertEquals(sock.calls, [3])
+        self.assertEquals(self.received(), data)
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
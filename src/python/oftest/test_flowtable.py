@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+import sys
+import random
+import unittest
+import loxi.of10 as of10
+import loxi.of13 as of13
+sys.modules.setdefault('ofp', of13)
+import flowtable
+
+def brute_lookup(shadow, packet, table_id=0):
+    """
+    Return the highest ranked flow matching packet by comparing every flow
+    """
+    best = None
+    for entry in shadow:
+        if entry.table_id != table_id:
+            continue
+        for (field, (value, mask)) in entry.fields.items():
+            if field not in packet or packet[field] & mask != value:
+                break
+        else:
+            if best is None or entry.rank > best.rank:
+                best = entry
+    return best
+
+def random_flow(rng, cookie):
+    oxms = []
+    if rng.random() < 0.7:
+        oxms.append(of13.oxm.in_port(rng.randint(1, 4)))
+    if rng.random() < 0.8:
+        oxms.append(of13.oxm.eth_type(0x0800))
+    if rng.random() < 0.6:
+        plen = rng.choice([8, 16, 24, 32])
+        mask = (0xffffffff << (32 - plen)) & 0xffffffff
+        value = rng.randint(0, 3) << 24 | rng.randint(0, 3) << 16 | rng.randint(0, 3)
+        oxms.append(of13.oxm.ipv4_src_masked(value & mask, mask))
+    if rng.random() < 0.3:
+        oxms.append(of13.oxm.eth_dst([0, 0, 0, 0, 0, rng.randint(1, 3)]))
+    rng.shuffle(oxms)
+    return of13.message.flow_add(
+        priority=rng.randint(0, 20), cookie=cookie, match=of13.match(oxms),
+        instructions=[of13.instruction.apply_actions(
+            [of13.action.output(port=cookie % 7 + 1)])])
+
+def random_packet(rng):
+    return dict(in_port=rng.randint(1, 4),
+                eth_type=rng.choice([0x0800, 0x0806]),
+                ipv4_src=rng.randint(0, 3) << 24 | rng.randint(0, 3) << 16 | rng.randint(0, 3),
+                eth_dst=rng.randint(1, 4))
+
+class TestLookup(unittest.TestCase):
+    def test_brute_force(self):
+        rng = random.Random(1)
+        shadow = flowtable.ShadowFlowTable(version=4)
+        for i in range(2000):
+            shadow.flow_mod(random_flow(rng, i))
+        # Delete some flows so that subtables lose their top ranked flows
+        shadow.flow_mod(of13.message.flow_delete(
+            table_id=of13.OFPTT_ALL, out_port=3, out_group=of13.OFPG_ANY))
+        for i in range(1000):
+            packet = random_packet(rng)
+            expected = brute_lookup(shadow, packet)
+            result = shadow.lookup(packet)
+            if expected is None:
+                self.assertEquals(result, None)
+            else:
+                self.assertNotEquals(result, None)
+                self.assertEquals(result.rank, expected.rank)
+
+    def test_priority_zero(self):
+        shadow = flowtable.ShadowFlowTable(version=4)
+        for priority in (0, 5):
+            shadow.flow_mod(of13.message.flow_add(
+                priority=priority, match=of13.match([of13.oxm.in_port(priority + 1)])))
+        shadow.flow_mod(of13.message.flow_delete_strict(
+            priority=5, match=of13.match([of13.oxm.in_port(6)]),
+            out_port=of13.OFPP_ANY, out_group=of13.OFPG_ANY))
+        (subtable,) = shadow.tables[0].subtables.values()
+        self.assertEquals(subtable.max_rank, 0)
+        self.assertEquals(shadow.lookup(dict(in_port=1)).priority, 0)
+
+class TestFlowMod(unittest.TestCase):
+    def setUp(self):
+        self.shadow = flowtable.ShadowFlowTable(version=4)
+        for (i, prefix) in enumerate([0x0a000000, 0x0a010000, 0x0b000000]):
+            self.shadow.flow_mod(of13.message.flow_add(
+                priority=10, cookie=i,
+                match=of13.match([of13.oxm.eth_type(0x0800),
+                                  of13.oxm.ipv4_src_masked(prefix, 0xffff0000)]),
+                instructions=[of13.instruction.apply_actions(
+                    [of13.action.output(port=i + 1)])]))
+
+    def test_delete_nonstrict(self):
+        self.shadow.flow_mod(of13.message.flow_delete(
+            table_id=of13.OFPTT_ALL, out_port=of13.OFPP_ANY,
+            out_group=of13.OFPG_ANY,
+            match=of13.match([of13.oxm.eth_type(0x0800),
+                              of13.oxm.ipv4_src_masked(0x0a000000, 0xff000000)])))
+        self.assertEquals([entry.cookie for entry in self.shadow], [2])
+
+    def test_delete_strict(self):
+        self.shadow.flow_mod(of13.message.flow_delete_strict(
+            table_id=0, priority=10, out_port=of13.OFPP_ANY,
+            out_group=of13.OFPG_ANY,
+            match=of13.match([of13.oxm.ipv4_src_masked(0x0a010000, 0xffff0000),
+                              of13.oxm.eth_type(0x0800)])))
+        self.assertEquals(sorted([entry.cookie for entry in self.shadow]), [0, 2])
+
+    def test_delete_out_port(self):
+        self.shadow.flow_mod(of13.message.flow_delete(
+            table_id=of13.OFPTT_ALL, out_port=2, out_group=of13.OFPG_ANY))
+        self.assertEquals(sorted([entry.cookie for entry in self.shadow]), [0, 2])
+
+    def test_delete_cookie(self):
+        self.shadow.flow_mod(of13.message.flow_delete(
+            table_id=of13.OFPTT_ALL, out_port=of13.OFPP_ANY,
+            out_group=of13.OFPG_ANY, cookie=2, cookie_mask=0xff))
+        self.assertEquals(sorted([entry.cookie for entry in self.shadow]), [0, 1])
+
+    def test_diff(self):
+        stats = [of13.flow_stats_entry(table_id=entry.table_id,
+                                       priority=entry.priority,
+                                       cookie=entry.cookie,
+                                       match=entry.flow_mod.match,
+                                       instructions=entry.actions)
+                 for entry in self.shadow]
+        self.assertFalse(self.shadow.diff(stats))
+        stats[0].cookie = 99
+        stats.pop()
+        stats.append(of13.flow_stats_entry(table_id=3))
+        diff = self.shadow.diff(stats)
+        self.assertEquals(len(diff.changed), 1)
+        self.assertEquals(len(diff.missing), 1)
+        self.assertEquals(len(diff.unexpected), 1)
+
+class TestPredict(unittest.TestCase):
+    def test_goto_table(self):
+        shadow = flowtable.ShadowFlowTable(version=4)
+        shadow.flow_mod(of13.message.flow_add(
+            table_id=0, priority=1, match=of13.match([of13.oxm.in_port(1)]),
+            instructions=[
+                of13.instruction.apply_actions([of13.action.output(port=5)]),
+                of13.instruction.write_actions([of13.action.output(port=6)]),
+                of13.instruction.goto_table(1)]))
+        shadow.flow_mod(of13.message.flow_add(
+            table_id=1, priority=1, match=of13.match([]),
+            instructions=[of13.instruction.write_actions(
+                [of13.action.output(port=7)])]))
+        self.assertEquals(shadow.predict({}, in_port=1), [5, 7])
+        self.assertEquals(shadow.predict({}, in_port=2), None)
+
+    def test_of10_exact_match(self):
+        shadow = flowtable.ShadowFlowTable(version=1)
+        wildcards = of10.OFPFW_ALL & ~of10.OFPFW_IN_PORT & \
+            ~of10.OFPFW_NW_SRC_MASK | (8 << of10.OFPFW_NW_SRC_SHIFT)
+        shadow.flow_mod(of10.message.flow_add(
+            priority=100,
+            match=of10.match(wildcards=wildcards, in_port=1, ipv4_src=0x0a0000ff),
+            actions=[of10.action.output(port=2)]))
+        shadow.flow_mod(of10.message.flow_add(
+            priority=1,
+            match=of10.match(wildcards=0, in_port=1, ipv4_src=0x0a000001,
+                             eth_src=[0, 0, 0, 0, 0, 1]),
+            actions=[of10.action.output(port=3)]))
+        packet = dict(in_port=1, ipv4_src=0x0a000001, eth_src=[0, 0, 0, 0, 0, 1],
+                      eth_dst=0, vlan_vid=0, vlan_pcp=0, eth_type=0, ip_dscp=0,
+                      ip_proto=0, tcp_src=0, tcp_dst=0, ipv4_dst=0)
+        # The exact match flow wins despite its lower priority
+        self.assertEquals(shadow.predict(packet), [3])
+        self.assertEquals(shadow.predict(dict(packet, ipv4_src=0x0a000002)), [2])
+        self.assertEquals(shadow.predict(dict(packet, in_port=2)), None)
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
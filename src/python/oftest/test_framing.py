@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+import unittest
+import framing
+
+def message(msg_type, xid, body=''):
+    return framing.OFP_HEADER.pack(4, msg_type, framing.OFP_HEADER.size + len(body),
+                                   xid) + body
+
+class ChunkSocket(object):
+    """
+    Socket whose reads return the given chunks one at a time
+    """
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+
+    def recv_into(self, buf, nbytes):
+        if not self.chunks:
+            return 0
+        data = self.chunks.pop(0)
+        assert len(data) <= nbytes
+        buf[:len(data)] = data
+        return len(data)
+
+def frames(buf):
+    return [(msg_type, xid, frame.tobytes())
+            for (version, msg_type, length, xid, frame) in buf.frames()]
+
+class TestFrameBuffer(unittest.TestCase):
+    def test_partial_header(self):
+        buf = framing.FrameBuffer(64)
+        msg = message(2, 7, 'abc')
+        buf.feed(msg[:5])
+        self.assertEquals(frames(buf), [])
+        self.assertEquals(len(buf), 5)
+        buf.feed(msg[5:])
+        self.assertEquals(frames(buf), [(2, 7, msg)])
+        self.assertEquals(len(buf), 0)
+
+    def test_split_across_reads(self):
+        msgs = [message(10, i, 'x' * (i * 7)) for i in range(20)]
+        stream = ''.join(msgs)
+        sock = ChunkSocket([stream[i:i + 13] for i in range(0, len(stream), 13)])
+        buf = framing.FrameBuffer(32)
+        result = []
+        while buf.recv_into(sock, 13):
+            result.extend(frames(buf))
+        self.assertEquals([frame for (_, _, frame) in result], msgs)
+        self.assertEquals([xid for (_, xid, _) in result], range(20))
+        self.assertEquals(len(buf), 0)
+
+    def test_several_in_one_read(self):
+        msgs = [message(3, 1), message(2, 2, 'ping'), message(10, 3, 'data')]
+        buf = framing.FrameBuffer(16)
+        buf.feed(''.join(msgs) + msgs[0][:3])
+        self.assertEquals([frame for (_, _, frame) in frames(buf)], msgs)
+        self.assertEquals(len(buf), 3)
+
+    def test_grow(self):
+        msg = message(10, 1, 'y' * 1000)
+        buf = framing.FrameBuffer(16)
+        buf.feed(msg)
+        self.assertEquals(frames(buf), [(10, 1, msg)])
+
+    def test_tail(self):
+        sock = ChunkSocket(['abc', 'defgh'])
+        buf = framing.FrameBuffer(64)
+        buf.recv_into(sock, 16)
+        self.assertEquals(buf.tail(3), 'abc')
+        count = buf.recv_into(sock, 16)
+        self.assertEquals(buf.tail(count), 'defgh')
+
+    def test_clear(self):
+        msg = message(10, 5, 'z')
+        buf = framing.FrameBuffer(64)
+        buf.feed(msg[:6])
+        buf.clear()
+        self.assertEquals(len(buf), 0)
+        buf.feed(msg)
+        self.assertEquals(frames(buf), [(10, 5, msg)])
+
+    def test_eof(self):
+        buf = framing.FrameBuffer(64)
+        self.assertEquals(buf.recv_into(ChunkSocket([]), 16), 0)
+
+    def test_invalid_length(self):
+        buf = framing.FrameBuffer(64)
+        buf.feed(framing.OFP_HEADER.pack(4, 0, 4, 1))
+        self.assertRaises(ValueError, frames, buf)
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+import unittest
+import loxi.of10 as of10
+import loxi.of11 as of11
+import loxi.of12 as of12
+import loxi.of13 as of13
+import ingress
+
+PACKET_IN = ingress.OFPT_PACKET_IN
+
+def packet_in(version, in_port):
+    if version == 1:
+        msg = of10.message.packet_in(in_port=in_port, data='abc')
+    elif version == 2:
+        msg = of11.message.packet_in(in_port=in_port, data='abc')
+    else:
+        ofp = {3: of12, 4: of13}[version]
+        oxms = [ofp.oxm.eth_type(0x0800), ofp.oxm.in_port(in_port)]
+        msg = ofp.message.packet_in(match=ofp.match(oxms), data='abc')
+    msg.xid = 1
+    return msg.pack()
+
+class TestPacketInPort(unittest.TestCase):
+    def test_versions(self):
+        for version in (1, 2, 3, 4):
+            self.assertEquals(ingress.packet_in_port(packet_in(version, 7), version), 7)
+
+    def test_no_in_port(self):
+        msg = of13.message.packet_in(xid=1, match=of13.match([of13.oxm.eth_type(0x0800)]))
+        self.assertEquals(ingress.packet_in_port(msg.pack(), 4), None)
+
+    def test_truncated(self):
+        frame = packet_in(4, 7)
+        self.assertEquals(ingress.packet_in_port(frame[:20], 4), None)
+        self.assertEquals(ingress.packet_in_port(frame[:38], 4), None)
+
+class TestTokenBucket(unittest.TestCase):
+    def test_burst(self):
+        bucket = ingress.TokenBucket(rate=1, burst=3)
+        self.assertEquals([bucket.take() for i in range(4)], [True, True, True, False])
+
+    def test_refill(self):
+        bucket = ingress.TokenBucket(rate=10, burst=2)
+        bucket.take()
+        bucket.take()
+        self.assertFalse(bucket.take())
+        bucket.last -= 0.15 # As if 150ms had passed
+        self.assertTrue(bucket.take())
+        self.assertFalse(bucket.take())
+
+    def test_refill_capped(self):
+        bucket = ingress.TokenBucket(rate=10, burst=2)
+        bucket.last -= 100
+        self.assertEquals([bucket.take() for i in range(3)], [True, True, False])
+
+class TestIngressPolicy(unittest.TestCase):
+    def test_no_policy(self):
+        policy = ingress.IngressPolicy()
+        self.assertFalse(policy.check(packet_in(4, 1), 4, PACKET_IN))
+        self.assertEquals(policy.seen, {})
+
+    def test_sample(self):
+        policy = ingress.IngressPolicy()
+        policy.sample(PACKET_IN, 3)
+        drops = [policy.check(packet_in(4, 1), 4, PACKET_IN) for i in range(6)]
+        self.assertEquals(drops, [False, True, True, False, True, True])
+        self.assertEquals(policy.seen[PACKET_IN], 6)
+        self.assertEquals(policy.dropped[PACKET_IN], 4)
+        # Other types are not sampled
+        self.assertFalse(policy.check('', 4, 19))
+        policy.sample(PACKET_IN, 1)
+        self.assertFalse(policy.check(packet_in(4, 1), 4, PACKET_IN))
+
+    def test_limit(self):
+        policy = ingress.IngressPolicy()
+        policy.limit(PACKET_IN, rate=1, burst=2)
+        drops = [policy.check(packet_in(4, port), 4, PACKET_IN) for port in (1, 2, 3)]
+        self.assertEquals(drops, [False, False, True])
+        policy.limit(PACKET_IN, None)
+        self.assertFalse(policy.check(packet_in(4, 1), 4, PACKET_IN))
+
+    def test_limit_per_port(self):
+        policy = ingress.IngressPolicy()
+        policy.limit(PACKET_IN, rate=1, burst=1, per_port=True)
+        drops = [policy.check(packet_in(1, port), 1, PACKET_IN) for port in (1, 2, 1, 2)]
+        self.assertEquals(drops, [False, False, True, True])
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
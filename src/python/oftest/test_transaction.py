@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+import sys
+import socket
+import unittest
+import threading
+import loxi.of13 as of13
+sys.modules.setdefault('ofp', of13)
+import controller
+import framing
+
+def stats_reply(xid, ports, more=False):
+    return of13.message.port_stats_reply(
+        xid=xid, flags=more and of13.OFPSF_REPLY_MORE or 0,
+        entries=[of13.port_stats_entry(port_no=port) for port in ports])
+
+def error(xid):
+    return of13.message.bad_request_error_msg(
+        xid=xid, code=of13.OFPBRC_BAD_STAT)
+
+class TransactionTest(unittest.TestCase):
+    def setUp(self):
+        # Requests are read from the switch end of a socketpair and the
+        # replies fed straight to _pkt_handle, without a controller thread
+        self.ctrl = controller.Controller(switch="test")
+        (self.switch, self.ctrl.switch_socket) = socket.socketpair()
+        self.switch.settimeout(2)
+        self.rx_buffer = framing.FrameBuffer(1024)
+
+    def tearDown(self):
+        self.switch.close()
+        self.ctrl.switch_socket.close()
+
+    def start(self, xid, multipart=True):
+        return self.ctrl._transaction_start(
+            of13.message.port_stats_request(xid=xid), multipart)
+
+    def receive(self, *msgs):
+        self.ctrl._pkt_handle(''.join([msg.pack() for msg in msgs]))
+
+    def requests(self, count):
+        """
+        Read count requests sent to the switch and return their xids
+        """
+        xids = []
+        while len(xids) < count:
+            for (_, _, _, xid, _) in self.rx_buffer.frames():
+                xids.append(xid)
+            if len(xids) < count:
+                self.rx_buffer.recv_into(self.switch, 1024)
+        return xids
+
+    def background(self, fn, *args):
+        """
+        Run fn in a thread; returns the thread and a list that receives
+        its result
+        """
+        result = []
+        thread = threading.Thread(target=lambda: result.append(fn(*args)))
+        thread.daemon = True
+        thread.start()
+        return (thread, result)
+
+class TestTransact(TransactionTest):
+    def test_out_of_order(self):
+        results = [self.background(self.ctrl.transact,
+                                   of13.message.echo_request(xid=xid, data=str(xid)), 2)
+                   for xid in (1, 2, 3)]
+        self.assertEquals(sorted(self.requests(3)), [1, 2, 3])
+        self.receive(*[of13.message.echo_reply(xid=xid, data=str(xid))
+                       for xid in (3, 1, 2)])
+        for (thread, result) in results:
+            thread.join(2)
+        replies = [result[0][0] for (thread, result) in results]
+        self.assertEquals([msg.data for msg in replies], ['1', '2', '3'])
+        self.assertEquals(self.ctrl.transactions, {})
+        self.assertEquals(self.ctrl.queued_count(), 0)
+
+    def test_timeout(self):
+        reply = self.ctrl.transact(of13.message.echo_request(xid=4), timeout=0.01)
+        self.assertEquals(reply, (None, None))
+        self.assertEquals(self.ctrl.transactions, {})
+        # A late reply is queued like any other message
+        self.receive(of13.message.echo_reply(xid=4))
+        (msg, pkt) = self.ctrl.poll(of13.message.echo_reply, timeout=0)
+        self.assertEquals(msg.xid, 4)
+
+    def test_reply_not_queued(self):
+        (thread, result) = self.background(
+            self.ctrl.transact, of13.message.port_stats_request(xid=5), 2)
+        self.requests(1)
+        self.receive(of13.message.port_stats_reply(xid=6),
+                     of13.message.port_stats_reply(xid=5))
+        thread.join(2)
+        self.assertEquals(result[0][0].xid, 5)
+        # Only the reply nobody was waiting for reaches the poll queue
+        self.assertEquals(self.ctrl.queued_count(), 1)
+        (msg, pkt) = self.ctrl.poll(of13.message.port_stats_reply, timeout=0)
+        self.assertEquals(msg.xid, 6)
+
+class TestDeliver(TransactionTest):
+    def test_multipart(self):
+        future = self.start(1)
+        self.receive(stats_reply(1, [1, 2], more=True))
+        self.assertFalse(future.done())
+        self.receive(stats_reply(1, [3]))
+        (msg, pkt) = future.result(0)
+        self.assertEquals([entry.port_no for entry in msg.entries], [1, 2, 3])
+        self.assertEquals(msg.flags, 0)
+        self.assertEquals(len(future.replies), 2)
+        self.assertEquals(self.ctrl.transactions, {})
+
+    def test_multipart_ends_in_error(self):
+        future = self.start(2)
+        self.receive(stats_reply(2, [1], more=True), error(2))
+        (msg, pkt) = future.result(0)
+        self.assertTrue(isinstance(msg, of13.message.bad_request_error_msg))
+        self.assertEquals(pkt, error(2).pack())
+        self.assertEquals(self.ctrl.transactions, {})
+
+    def test_deliver_fails(self):
+        future = self.start(3)
+        def deliver(msg, rawmsg):
+            raise AttributeError("deliver")
+        future.deliver = deliver
+        self.receive(stats_reply(3, [1]), of13.message.echo_reply(xid=4))
+        # The transaction is cancelled and later messages still arrive
+        self.assertTrue(future.done())
+        self.assertEquals(future.result(0), None)
+        self.assertEquals(self.ctrl.transactions, {})
+        (msg, pkt) = self.ctrl.poll(of13.message.echo_reply, timeout=0)
+        self.assertEquals(msg.xid, 4)
+
+class TestWaitAll(TransactionTest):
+    def test_own_transactions(self):
+        first = self.ctrl.send_async(of13.message.port_stats_request(xid=1))
+        second = self.ctrl.send_async(of13.message.port_stats_request(xid=2))
+        # A transaction started by another thread, as by transact
+        other = self.start(3)
+        self.receive(stats_reply(1, [1]))
+        self.assertFalse(self.ctrl.wait_all(timeout=0.01))
+        self.assertEquals(first.result(0)[0].xid, 1)
+        self.assertTrue(second.done())
+        self.assertEquals(second.result(0), None)
+        self.assertFalse(other.done())
+        self.assertEquals(self.ctrl.transactions.keys(), [3])
+
+    def test_other_thread(self):
+        (thread, result) = self.background(
+            self.ctrl.send_async, of13.message.port_stats_request(xid=4))
+        thread.join(2)
+        self.assertTrue(self.ctrl.wait_all(timeout=0.01))
+        self.assertFalse(result[0].done())
+        self.receive(stats_reply(4, [1]))
+        self.assertEquals(result[0].result(0)[0].xid, 4)
+
+class TestMultipartStream(TransactionTest):
+    def send(self, xid, timeout=2):
+        return self.ctrl.send_multipart(
+            of13.message.port_stats_request(xid=xid), timeout)
+
+    def ports(self, parts):
+        return [[entry.port_no for entry in msg.entries] for (msg, pkt) in parts]
+
+    def test_streaming(self):
+        stream = self.send(1)
+        parts = iter(stream)
+        self.receive(stats_reply(1, [1, 2], more=True))
+        (msg, pkt) = parts.next()
+        self.assertEquals(self.ports([(msg, pkt)]), [[1, 2]])
+        self.assertEquals(pkt, stats_reply(1, [1, 2], more=True).pack())
+        # Parts are released as they are read
+        self.assertEquals(len(stream.parts), 0)
+        self.assertFalse(stream.done())
+        self.receive(stats_reply(1, [3], more=True), stats_reply(1, [4]))
+        self.assertEquals(self.ports(parts), [[3], [4]])
+        self.assertTrue(stream.done())
+        self.assertFalse(stream.timed_out)
+        self.assertEquals(self.ctrl.transactions, {})
+
+    def test_timeout(self):
+        stream = self.send(2, timeout=0.01)
+        self.receive(stats_reply(2, [1], more=True))
+        self.assertEquals(self.ports(stream), [[1]])
+        self.assertTrue(stream.timed_out)
+        self.assertEquals(self.ctrl.transactions, {})
+
+    def test_early_exit(self):
+        stream = self.send(3)
+        self.receive(stats_reply(3, [1], more=True), stats_reply(3, [2], more=True))
+        for (msg, pkt) in stream:
+            break
+        # As done by testutils.iter_stats when its consumer stops early
+        stream.cancel()
+        self.assertEquals(len(stream.parts), 0)
+        self.assertEquals(stream.get(0), (None, None))
+        self.assertEquals(self.ctrl.transactions, {})
+        # Later parts are queued like any other message
+        self.receive(stats_reply(3, [3]))
+        self.assertEquals(len(stream.parts), 0)
+        (msg, pkt) = self.ctrl.poll(of13.message.port_stats_reply, timeout=0)
+        self.assertEquals(msg.xid, 3)
+
+    def test_error(self):
+        stream = self.send(4)
+        self.receive(stats_reply(4, [1], more=True), error(4))
+        parts = list(stream)
+        self.assertEquals(len(parts), 2)
+        self.assertTrue(isinstance(parts[1][0], of13.message.bad_request_error_msg))
+        self.assertEquals(stream.result(0), parts[1])
+        self.assertFalse(stream.timed_out)
+        self.assertEquals(self.ctrl.transactions, {})
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
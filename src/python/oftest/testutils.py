@@ -28,10 +28,17 @@ MINSIZE = 0
 def delete_all_flows(ctrl, send_barrier=True):
     """
     Delete all flows on the switch
+
+    If the controller tags flows with a session cookie (OpenFlow 1.1+),
+    only the tagged flows are deleted; see delete_session_flows.
+
     @param ctrl The controller object for the test
     @param send_barrier Whether or not to send a barrier message
     """
 
+    if ctrl.flow_cookie is not None and ofp.OFP_VERSION >= 2:
+        return delete_session_flows(ctrl, send_barrier)
+
     logging.info("Deleting all flows")
     msg = ofp.message.flow_delete()
     if ofp.OFP_VERSION in [1, 2]:
@@ -48,6 +55,50 @@ def delete_all_flows(ctrl, send_barrier=True):
         do_barrier(ctrl)
     return 0 # for backwards compatibility
 
+def delete_session_flows(ctrl, send_barrier=True):
+    """
+    Delete the flows tagged with the controller's session cookie
+
+    One cookie masked delete is sent per table that tagged flows were
+    added to since the last cleanup, so flows installed by anything else
+    survive and the cost follows what the tests installed.  Flows whose
+    cookie could not be tagged are deleted by their exact cookie.  The
+    controller forgets the tables and flows only once the deletes have
+    been sent and, with send_barrier, confirmed.  Requires OpenFlow 1.1+.
+
+    @param ctrl The controller object for the test
+    @param send_barrier Whether or not to send a barrier message
+    """
+
+    tables_all = oftest.controller.FLOW_TABLES_ALL
+    added = set(ctrl.flow_tables)
+    untagged = sorted(ctrl.flow_untagged)
+    tables = sorted(added)
+    if tables_all in tables:
+        tables = [tables_all]
+    logging.info("Deleting flows with cookie %#x from tables %s",
+                 ctrl.flow_cookie, tables)
+    for table_id in tables:
+        msg = ofp.message.flow_delete(table_id=table_id,
+                                      cookie=ctrl.flow_cookie,
+                                      cookie_mask=oftest.controller.FLOW_COOKIE_MASK)
+        msg.buffer_id = 0xffffffff
+        msg.out_port = ofp.OFPP_ANY
+        msg.out_group = ofp.OFPG_ANY
+        ctrl.message_send(msg)
+    for (table_id, cookie) in untagged:
+        msg = ofp.message.flow_delete(table_id=table_id, cookie=cookie,
+                                      cookie_mask=0xffffffffffffffff)
+        msg.buffer_id = 0xffffffff
+        msg.out_port = ofp.OFPP_ANY
+        msg.out_group = ofp.OFPG_ANY
+        ctrl.message_send(msg)
+    if send_barrier and (tables or untagged):
+        do_barrier(ctrl)
+    ctrl.flow_tables.difference_update(added)
+    ctrl.flow_untagged.difference_update(untagged)
+    return 0 # for backwards compatibility
+
 def delete_all_groups(ctrl):
     """
     Delete all groups on the switch
@@ -601,30 +652,18 @@ def port_config_get(controller, port_no):
     """
     Get a port's configuration
 
-    Gets the switch feature configuration and grabs one port's
-    configuration
+    Refreshes the port descriptions in the controller's capability cache,
+    since the switch may change a port's state on its own, and grabs one
+    port's configuration
 
     @returns (hwaddr, config, advert) The hwaddress, configuration and
     advertised values
     """
 
-    if ofp.OFP_VERSION <= 3:
-        request = ofp.message.features_request()
-        reply, _ = controller.transact(request)
-        if reply is None:
-            logging.warn("Get feature request failed")
-            return None, None, None
-        logging.debug(reply.show())
-        ports = reply.ports
-    else:
-        request = ofp.message.port_desc_stats_request()
-        # TODO do multipart correctly
-        reply, _ = controller.transact(request)
-        if reply is None:
-            logging.warn("Port desc stats request failed")
-            return None, None, None
-        logging.debug(reply.show())
-        ports = reply.entries
+    ports = controller.capabilities.get("port_desc", refresh=True)
+    if ports is None:
+        logging.warn("Port description request failed")
+        return None, None, None
 
     for port in ports:
         if port.port_no == port_no:
@@ -1354,6 +1393,14 @@ def disabled(cls):
     cls._disabled = True
     return cls
 
+def fresh_controller(cls):
+    """
+    Testcase decorator that gives the test a controller connection of its
+    own, even when one connection is otherwise kept across tests.
+    """
+    cls._fresh_controller = True
+    return cls
+
 def group(name):
     """
     Testcase decorator that adds the test to a group.
@@ -1406,28 +1453,41 @@ assert(parse_version("1.0") == set(["1.0"]))
 assert(parse_version("1.0,1.2,1.3") == set(["1.0", "1.2", "1.3"]))
 assert(parse_version("1.0+") == set(["1.0", "1.1", "1.2", "1.3"]))
 
+def iter_stats(test, req, timeout=-1):
+    """
+    Yield stats entries as the replies arrive. Handles OFPSF_REPLY_MORE.
+
+    Replies are matched to the request by xid and each one is released
+    once its entries have been yielded, so large dumps can be processed
+    without holding them in memory.  Stopping early cancels the request.
+
+    @param timeout Seconds to wait for each reply; if -1 use default.
+    """
+    stream = test.controller.send_multipart(req, timeout)
+    try:
+        received = False
+        for (reply, _) in stream:
+            received = True
+            test.assertEquals(reply.type, ofp.OFPT_STATS_REPLY,
+                              "Response had unexpected message type")
+            for entry in reply.entries:
+                yield entry
+        test.assertTrue(received and not stream.timed_out,
+                        "No response to stats request")
+    finally:
+        stream.cancel()
+
 def get_stats(test, req):
     """
     Retrieve a list of stats entries. Handles OFPSF_REPLY_MORE.
     """
-    msgtype = ofp.OFPT_STATS_REPLY
-    more_flag = ofp.OFPSF_REPLY_MORE
-    stats = []
-    reply, _ = test.controller.transact(req)
-    test.assertTrue(reply is not None, "No response to stats request")
-    test.assertEquals(reply.type, msgtype, "Response had unexpected message type")
-    stats.extend(reply.entries)
-    while reply.flags & more_flag != 0:
-        reply, pkt = test.controller.poll(exp_msg=msgtype)
-        test.assertTrue(reply is not None, "No response to stats request")
-        stats.extend(reply.entries)
-    return stats
+    return list(iter_stats(test, req))
 
-def get_flow_stats(test, match, table_id=None,
-                   out_port=None, out_group=None,
-                   cookie=0, cookie_mask=0):
+def iter_flow_stats(test, match, table_id=None,
+                    out_port=None, out_group=None,
+                    cookie=0, cookie_mask=0):
     """
-    Retrieve a list of flow stats entries.
+    Yield flow stats entries as the replies arrive.  See iter_stats.
     """
 
     if table_id == None:
@@ -1454,7 +1514,27 @@ def get_flow_stats(test, match, table_id=None,
         req.cookie = cookie
         req.cookie_mask = cookie_mask
 
-    return get_stats(test, req)
+    return iter_stats(test, req)
+
+def get_flow_stats(test, match, table_id=None,
+                   out_port=None, out_group=None,
+                   cookie=0, cookie_mask=0):
+    """
+    Retrieve a list of flow stats entries.
+    """
+    return list(iter_flow_stats(test, match, table_id, out_port, out_group,
+                                cookie, cookie_mask))
+
+def verify_flow_table(test, shadow):
+    """
+    Assert that the switch's flows are those of a model
+
+    @param test Instance of base_tests.SimpleProtocol
+    @param shadow oftest.flowtable.ShadowFlowTable following the flow_mods
+    the test sent
+    """
+    diff = shadow.diff(iter_flow_stats(test, ofp.match()))
+    test.assertFalse(diff, "Flow table differs from the model: %s" % diff)
 
 def get_port_stats(test, port_no):
     """
@@ -1650,7 +1730,8 @@ def verify_packet_in(test, data, in_port, reason, controller=None):
     """
     Assert that the controller receives a packet_in message matching data 'data'
     from port 'in_port' with reason 'reason'. Does not trigger the packet_in
-    itself, that's up to the test case.
+    itself, that's up to the test case.  Other packet_in messages are left
+    queued.
 
     @param test Instance of base_tests.SimpleProtocol
     @param pkt String to expect as the packet_in data
@@ -1663,16 +1744,7 @@ def verify_packet_in(test, data, in_port, reason, controller=None):
     if controller == None:
         controller = test.controller
 
-    end_time = time.time() + oftest.ofutils.default_timeout
-
-    while True:
-        msg, _ = controller.poll(ofp.OFPT_PACKET_IN, end_time - time.time())
-        if not msg:
-            # Timeout
-            break
-        elif packet_in_match(msg, data, in_port, reason):
-            # Found a matching message
-            break
+    msg, _ = controller.poll_packet_in(data, in_port, reason)
 
     test.assertTrue(msg is not None, 'Packet in message not received on port %r' % in_port)
     return msg
@@ -1696,14 +1768,7 @@ def verify_no_packet_in(test, data, in_port, controller=None):
     time.sleep(oftest.ofutils.default_negative_timeout)
 
     # Check every packet_in queued in the controller
-    while True:
-        msg, _ = controller.poll(ofp.OFPT_PACKET_IN, timeout=0)
-        if msg == None:
-            # No more queued packet_in messages
-            break
-        elif packet_in_match(msg, data, in_port, None):
-            # Found a matching message
-            break
+    msg, _ = controller.poll_packet_in(data, in_port, timeout=0)
 
     if in_port == None:
         test.assertTrue(msg == None, "Did not expect a packet-in message on any port")
@@ -1798,10 +1863,9 @@ def verify_capability(test, capability):
                   "Capability code %d does not exist." % capability)
     capability_str = ofp.const.ofp_capabilities_map[capability]
     
-    logging.info(("Sending features_request to test if capability "
+    logging.info(("Checking features_reply to test if capability "
                   "%s is supported."), capability_str)
-    req = ofp.message.features_request()
-    res, raw = test.controller.transact(req)
+    res = test.controller.capabilities.get("features")
     test.assertIsNotNone(res, "Did not receive a response from the DUT.")
     test.assertEqual(res.type, ofp.OFPT_FEATURES_REPLY,
                      ("Unexpected packet type %d received in response to "
@@ -1830,16 +1894,10 @@ def verify_configuration_flag(test, flag):
                   "flag  %s does not exist." % flag)
     flag_str = ofp.const.ofp_config_flags_map[flag]
 
-    logging.info("Sending OFPT_GET_CONFIG_REQUEST.")    
-    req = ofp.message.get_config_request()
-    rv = test.controller.message_send(req)
-    test.assertNotEqual(rv, -1, "Not able to send get_config_request.")
-
-    logging.info("Expecting OFPT_GET_CONFIG_REPLY ")
-    (res, pkt) = test.controller.poll(exp_msg=ofp.OFPT_GET_CONFIG_REPLY,
-                                      timeout=2)
+    logging.info("Getting switch configuration.")
+    res = test.controller.capabilities.get("config", timeout=2,
+                                           refresh=True)
     test.assertIsNotNone(res, "Did not receive OFPT_GET_CONFIG_REPLY")
-    logging.info("Received OFPT_GET_CONFIG_REPLY ")
 
     if res.flags == flag:
         logging.info("%s flag is set.", flag_str)
@@ -575,13 +575,10 @@ def send_packet(obj, pkt, ingress_port, egress_port):
 def sw_supported_actions(parent,use_cache=False):
 #Returns the switch's supported actions
 
-    cache_supported_actions = None
-    if cache_supported_actions is None or not use_cache:
-        request = ofp.message.features_request()
-        (reply, pkt) = parent.controller.transact(request)
-        parent.assertTrue(reply is not None, "Did not get response to ftr req")
-        cache_supported_actions = reply.actions
-    return cache_supported_actions
+    reply = parent.controller.capabilities.get("features",
+                                               refresh=not use_cache)
+    parent.assertTrue(reply is not None, "Did not get response to ftr req")
+    return reply.actions
 
 ##############################################################################################################################################################
 
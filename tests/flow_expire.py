@@ -15,6 +15,7 @@ import ofp
 import oftest.dataplane as dataplane
 import oftest.parse as parse
 import oftest.base_tests as base_tests
+import oftest.flowtrack as flowtrack
 
 from oftest.testutils import *
 from time import sleep
@@ -84,3 +85,55 @@ class FlowExpire(base_tests.SimpleDataPlane):
                          'Flow table entry does not match')
         
         sleep(1)
+
+@nonstandard
+class FlowExpireMany(base_tests.SimpleProtocol):
+    """
+    Verify flow expire messages for many flows at once
+
+    Install flow_count flows (test parameter, default 1000) with idle
+    timeouts of 1 to 3 seconds
+    Verify a flow expiration message is received for each of them
+    Report how late the flows expired
+    """
+    def runTest(self):
+        flow_count = test_param_get("flow_count", default=1000)
+
+        of_ports = config["port_map"].keys()
+        of_ports.sort()
+        self.assertTrue(len(of_ports) > 1, "Not enough ports for test")
+
+        delete_all_flows(self.controller)
+
+        tracker = flowtrack.FlowRemovedTracker(self.controller)
+        try:
+            for i in range(flow_count):
+                match = ofp.match(wildcards=ofp.OFPFW_ALL & ~(ofp.OFPFW_IN_PORT |
+                                                              ofp.OFPFW_DL_TYPE |
+                                                              ofp.OFPFW_NW_PROTO |
+                                                              ofp.OFPFW_TP_SRC),
+                                  in_port=of_ports[0], eth_type=0x0800,
+                                  ip_proto=6, tcp_src=i + 1)
+                request = ofp.message.flow_add(
+                    match=match,
+                    cookie=i,
+                    buffer_id=0xffffffff,
+                    idle_timeout=1 + i % 3,
+                    flags=ofp.OFPFF_SEND_FLOW_REM,
+                    actions=[ofp.action.output(port=of_ports[1])])
+                self.controller.message_send(request)
+            do_barrier(self.controller)
+
+            tracker.wait(timeout=60)
+            report = tracker.report()
+        finally:
+            tracker.close()
+
+        logging.info("Flow expiry: %s", report)
+        self.assertEqual(len(report.missing), 0,
+                         "%d flows were not removed" % len(report.missing))
+        self.assertEqual(len(report.unexpected), 0,
+                         "%d unexpected flow removed messages" % len(report.unexpected))
+        for record in report.matched:
+            self.assertEqual(record.removed.reason, ofp.OFPRR_IDLE_TIMEOUT,
+                             "Flow table entry removal reason is not idle_timeout")